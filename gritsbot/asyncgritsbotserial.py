@@ -0,0 +1,328 @@
+import gritsbot.gritsbotserial as gritsbotserial
+import serial
+import asyncio
+import logging
+import os
+
+global logger
+logger = logging.getLogger('root')
+
+
+class AsyncGritsbotSerial:
+    """Encapsulates serial communications to the microcontroller on an asyncio event loop.
+
+    This is the asyncio counterpart of GritsbotSerial.  The serial device is configured by pyserial but read and written through its file descriptor
+    without blocking, so serial communications share one event loop with other services (e.g., MQTT and timers) rather than needing threads.
+
+    Like GritsbotSerial, requests are made one at a time, codecs are negotiated each time the device is (re)acquired, and the serial device is
+    restarted (at most once per second) if it encounters an error.  Unlike GritsbotSerial, a request that times out raises asyncio.TimeoutError, and
+    a request may be cancelled.  In either case, any partial response is discarded.
+
+    Attributes:
+        _serial_dev (str): Path to the serial device.
+        _baud_rate (int): The baud rate for the serial device.
+        _timeout (float): Timeout for a response in seconds.
+        _codecs (list): Preferred codecs, in order of preference.
+        _codec: The codec negotiated with the microcontroller.
+        _frames: Receive buffer for the negotiated codec.
+        _serial (serial.Serial): The pyserial object, used only to configure the device.
+        _fd (int): File descriptor of the serial device.
+        _waiter (asyncio.Future): Resolves to the next response frame, if a request is outstanding.
+        _lock (asyncio.Lock): Ensures only one request is outstanding.
+        _connected (asyncio.Event): Set while the serial device is usable.
+        _needs_restart (asyncio.Event): Set when the serial device should be restarted.
+        _serial_task_handle (asyncio.Task): Runs the internal restart task.
+        _stopped (bool): Whether the class has been stopped.
+        _started (bool): Whether the class has been started.
+
+    """
+
+    def __init__(self, serial_dev='/dev/ttyACM0', baud_rate=500000, timeout=2, codecs=None):
+        """Creates the serial communications object.
+
+        Args:
+            serial_dev (str, optional): The path to the serial device.
+            baud_rate (int, optional): Baud rate for the serial device.
+            timeout (float, optional): Default timeout for a response.
+            codecs (list, optional): Codecs to negotiate, in order of preference.  Defaults to JSON only.
+
+        Examples:
+            >>> AsyncGritsbotSerial(serial_dev='/dev/ttyACM0', codecs=[BinaryCodec(), JsonCodec()])
+
+        """
+        self._serial_dev = serial_dev
+        self._baud_rate = baud_rate
+        self._timeout = timeout
+        self._codecs = list(codecs) if codecs else [gritsbotserial.JsonCodec()]
+        self._codec = gritsbotserial.JsonCodec()
+        self._frames = self._codec.frame_buffer()
+
+        self._loop = None
+        self._serial = None
+        self._fd = None
+        self._waiter = None
+        self._lock = None
+        self._connected = None
+        self._needs_restart = None
+        self._serial_task_handle = None
+        self._stopped = False
+        self._started = False
+
+    async def request(self, msg, timeout=None):
+        """Makes a request on the serial line.
+
+        Args:
+            msg: A request encodable by the negotiated codec (e.g., from Request.to_json_encodable()).
+            timeout (float, optional): Time to wait for the serial device and the response.  Defaults to the timeout given at creation.
+
+        Raises:
+            RuntimeError: If the serial connection has not been started or has been stopped; if the serial device is unavailable; if the serial port
+            cannot be written to or read from.
+            asyncio.TimeoutError: If no complete response arrives within timeout, including the time spent waiting for earlier requests.
+
+        Returns:
+            dict: The decoded response, or None if the response could not be decoded.
+
+        Examples:
+            >>> response = await serial.request(request, timeout=1)
+
+        """
+        if(not self._started):
+            error_msg = 'Serial connection must be started prior to calling this method.'
+            logger.critical(error_msg)
+            raise RuntimeError(error_msg)
+
+        if(self._stopped):
+            error_msg = 'Serial connection stopped!  Cannot use anymore.'
+            logger.critical(error_msg)
+            raise RuntimeError(error_msg)
+
+        timeout = self._timeout if timeout is None else timeout
+        deadline = self._loop.time() + timeout
+
+        # Waiting for earlier requests counts against the timeout too, so a slow request doesn't hold up the ones queued behind it for longer
+        await asyncio.wait_for(self._lock.acquire(), timeout)
+        try:
+            try:
+                await asyncio.wait_for(self._connected.wait(), max(0, deadline - self._loop.time()))
+            except asyncio.TimeoutError:
+                error_msg = 'Serial connection timed out!'
+                logger.critical(error_msg)
+                raise RuntimeError(error_msg)
+
+            codec = self._codec
+            frame = await self._transact(codec.encode(msg), max(0, deadline - self._loop.time()))
+        finally:
+            self._lock.release()
+
+        result = None
+        try:
+            result = codec.decode(frame)
+        except Exception as e:
+            logger.warning('Unable to parse message from serial port')
+            logger.warning(repr(e))
+
+        return result
+
+    async def start(self, timeout=5):
+        """Starts the serial line by attempting to acquire the serial device.
+
+        This method should be called (on the event loop that will make requests) prior to other methods of this class.
+
+        Raises:
+            RuntimeError: If the serial connection cannot be established within timeout.
+
+        """
+        if(self._started):
+            logger.critical('Cannot start the serial connection more than once!')
+            raise RuntimeError()
+
+        if(self._stopped):
+            logger.critical('Cannot start the serial connection once stopped.')
+            raise RuntimeError()
+
+        self._started = True
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+        self._connected = asyncio.Event()
+        self._needs_restart = asyncio.Event()
+        self._needs_restart.set()
+        self._serial_task_handle = self._loop.create_task(self._serial_task())
+
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.critical('Initial serial connection timed out.')
+            await self.stop()
+            raise RuntimeError()
+
+    async def stop(self):
+        """Stops the serial connection and closes the serial device.  If the serial connection has not been started, does nothing."""
+        self._stopped = True
+
+        if(self._serial_task_handle is not None):
+            self._serial_task_handle.cancel()
+            try:
+                await self._serial_task_handle
+            except asyncio.CancelledError:
+                pass
+            self._serial_task_handle = None
+
+        self._close('Serial connection stopped.')
+
+    async def _transact(self, data, timeout):
+        """Writes a request and waits for one complete response frame.
+
+        Raises:
+            RuntimeError: If the serial port cannot be written to or read from.
+            asyncio.TimeoutError: If no complete frame arrives within timeout.
+
+        """
+        self._waiter = self._loop.create_future()
+
+        try:
+            await self._write(data)
+            return await asyncio.wait_for(self._waiter, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # A partial (or late) response must not be mistaken for the response to the next request
+            self._frames.clear()
+            raise
+        finally:
+            self._waiter = None
+
+    async def _write(self, data):
+        """Writes all of data without blocking the event loop.
+
+        Raises:
+            RuntimeError: If the serial port cannot be written to.
+
+        """
+        view = memoryview(data)
+
+        while(view):
+            try:
+                written = os.write(self._fd, view)
+                view = view[written:]
+            except BlockingIOError:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+            except (OSError, TypeError) as e:
+                # A closed device has no file descriptor, which surfaces as a TypeError
+                error_msg = 'Unable to write to the serial port.'
+                self._fail(error_msg, e)
+                raise RuntimeError(error_msg)
+
+    def _on_readable(self):
+        """Reads available bytes and hands complete frames to the outstanding request.  Called by the event loop."""
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail('Unable to read from the serial port.', e)
+            return
+
+        if(not data):
+            self._fail('Unable to read from the serial port.', EOFError('Serial device closed.'))
+            return
+
+        self._frames.feed(data)
+        frame = self._frames.next_frame()
+        while(frame is not None):
+            if(self._waiter is not None and not self._waiter.done()):
+                self._waiter.set_result(frame)
+            else:
+                logger.warning('Discarding a response with no outstanding request ({})'.format(frame))
+            frame = self._frames.next_frame()
+
+        if(len(self._frames) > gritsbotserial.MAX_FRAME_SIZE):
+            self._fail('Receive buffer exceeded maximum frame size ({})'.format(len(self._frames)), None)
+
+    def _fail(self, error_msg, e):
+        """Fails the outstanding request and signals that the serial device should be restarted."""
+        logger.critical(error_msg)
+        if(e is not None):
+            logger.critical(repr(e))
+
+        if(self._waiter is not None and not self._waiter.done()):
+            self._waiter.set_exception(RuntimeError(error_msg))
+
+        if(self._fd is not None):
+            self._loop.remove_reader(self._fd)
+
+        self._connected.clear()
+        self._needs_restart.set()
+
+    def _close(self, error_msg):
+        """Closes the serial device, failing any outstanding request."""
+        if(self._waiter is not None and not self._waiter.done()):
+            self._waiter.set_exception(RuntimeError(error_msg))
+
+        if(self._fd is not None):
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+
+        if(self._serial is not None):
+            self._serial.close()
+            self._serial = None
+
+        self._frames.clear()
+
+    def _open(self):
+        """Opens and configures the serial device, and starts watching it for incoming bytes."""
+        self._serial = serial.Serial(self._serial_dev, self._baud_rate, timeout=0)
+        self._fd = self._serial.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    async def _negotiate_codec(self):
+        """Picks the codec to use with the microcontroller, as in GritsbotSerial."""
+        json_codec = gritsbotserial.JsonCodec()
+        self._codec = json_codec
+        self._frames = json_codec.frame_buffer()
+
+        if(all(codec.name == json_codec.name for codec in self._codecs)):
+            return
+
+        supported = [json_codec.name]
+        try:
+            frame = await self._transact(json_codec.encode({'request': ['read'], 'iface': ['codec']}), gritsbotserial.NEGOTIATION_TIMEOUT)
+            supported += json_codec.decode(frame)['body'][0]['codec']
+        except RuntimeError:
+            raise
+        except Exception:
+            logger.info('Serial device did not report supported codecs; using JSON.')
+
+        for codec in self._codecs:
+            if(codec.name in supported):
+                self._codec = codec
+                self._frames = codec.frame_buffer()
+                break
+
+        logger.info('Using ({}) codec for serial device.'.format(self._codec.name))
+
+    async def _serial_task(self):
+        """Restarts the serial device when requested.  Only meant to be run by the internal task!"""
+        while(not self._stopped):
+            await self._needs_restart.wait()
+            start_time = self._loop.time()
+
+            self._close('Serial device restarting.')
+
+            try:
+                self._open()
+                await self._negotiate_codec()
+                self._needs_restart.clear()
+                self._connected.set()
+                continue
+            except Exception as e:
+                logger.critical('Could not get serial device ({})'.format(self._serial_dev))
+                logger.critical(repr(e))
+                self._close('Serial device restarting.')
+
+            # Wait at least one second between retries
+            await asyncio.sleep(max(0, 1 - (self._loop.time() - start_time)))
@@ -0,0 +1,309 @@
+import gritsbot.benchmarks.mqtt_broker as mqtt_broker
+import gritsbot.broadcast as broadcast
+import gritsbot.firmware as firmware
+import gritsbot.metrics as metrics
+import gritsbot.scheduler as scheduler
+import gritsbot.simulator as simulator
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+
+# Constants
+READY_TIMEOUT = 30
+REPORT_TIMEOUT = 10
+HISTOGRAMS = ('command_age', 'cycle', 'serial_roundtrip')
+
+
+def make_mac(index):
+    """Returns a locally administered MAC address for a simulated robot."""
+    return '02:00:00:{0:02x}:{1:02x}:{2:02x}'.format((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+
+
+def free_port():
+    """Returns a TCP port that is free on the loopback interface."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_broker(port):
+    """Runs the broker stand-in.  Target of the broker process."""
+    logging.getLogger('root').setLevel(logging.WARNING)
+    mqtt_broker.MqttBroker(port=port).serve_forever()
+
+
+def run_robot(index, mac_list_path, port, extra_args, reports, measure, stop):
+    """Runs one robot's firmware control loop against a simulated microcontroller.  Target of each robot process.
+
+    The robot is brought up as the firmware does, with a fake MAC address from the generated MAC list.  Once the measurement starts, the loop's
+    counters are noted; when it stops, the robot reports what happened in between.
+
+    Args:
+        index (int): Index of the robot, which is also its ID.
+        mac_list_path (str): Path of the generated MAC list.
+        port (int): Port of the broker stand-in.
+        extra_args (list): Extra command-line arguments for the firmware.
+        reports (multiprocessing.Queue): Where to send 'ready' and 'report' messages.
+        measure (multiprocessing.Event): Set when the measurement starts.
+        stop (multiprocessing.Event): Set when the measurement stops.
+
+    """
+    logging.getLogger('root').setLevel(logging.WARNING)
+    firmware.logger.setLevel(logging.WARNING)
+
+    device = simulator.SimulatedGritsbot(seed=index)
+    device.start()
+
+    args = firmware.parse_args([mac_list_path, '-host', '127.0.0.1', '-port', str(port), '-serial_dev', device.device] + extra_args)
+    robot_node, serial, controller = firmware.bring_up(args, make_mac(index))
+
+    thread = threading.Thread(target=controller.run, daemon=True)
+    thread.start()
+    reports.put(('ready', index, None))
+
+    measure.wait()
+    start = controller.loop_scheduler.stats()
+    stop.wait()
+    end = controller.loop_scheduler.stats()
+
+    reports.put(('report', index, {
+        'cycles': end['total_cycles'] - start['total_cycles'],
+        'overruns': end['total_overruns'] - start['total_overruns'],
+        'inputs': controller.inputs.stats(),
+        'histograms': {name: controller.metrics.histogram(name).merged() for name in HISTOGRAMS},
+    }))
+
+    controller.stop()
+    thread.join()
+    serial.stop()
+    robot_node.stop()
+    device.stop()
+
+
+class CommandGenerator:
+    """Publishes matlab_api command streams to every robot, like the workstation does.
+
+    Each robot gets a smoothly varying velocity command at the command rate, stamped with the send time and a sequence number, and an LED change
+    every few seconds.  The commands for all robots in a tick are sent in one write or, on a broadcast link, in one message.
+
+    Attributes:
+        sent (int): Number of commands sent.
+        _client (mqtt_broker.MqttClient): Connection to the broker.
+        _robot_ids (list): IDs of the robots to command.
+        _rate (float): Commands per second per robot.
+        _broadcast_link (str): Link to send one broadcast message per tick on, or None to send to each robot's link.
+        _stop (threading.Event): Set to stop publishing.
+        _thread (threading.Thread): Publishes the commands.
+
+    """
+
+    def __init__(self, client, robot_ids, rate, broadcast_link=None):
+        self.sent = 0
+        self._client = client
+        self._robot_ids = list(robot_ids)
+        self._rate = rate
+        self._broadcast_link = broadcast_link
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._publisher_task, daemon=True)
+
+    def start(self):
+        """Starts publishing commands."""
+        self._thread.start()
+
+    def stop(self):
+        """Stops publishing commands."""
+        self._stop.set()
+        self._thread.join()
+
+    def _publisher_task(self):
+        pacer = scheduler.PeriodicScheduler(1 / self._rate)
+        seq = 0
+
+        while(not self._stop.is_set()):
+            now = pacer.wait()
+            commands = {}
+            for i, robot_id in enumerate(self._robot_ids):
+                command = {'v': round(0.1*math.sin(now + i), 3), 'w': round(0.5*math.cos(now + i), 3)}
+                if(seq % max(1, int(5*self._rate)) == 0):
+                    command['left_led'] = command['right_led'] = [(seq + i) % 255, 0, 255]
+                commands[robot_id] = command
+
+            if(self._broadcast_link is not None):
+                packets = [mqtt_broker.encode_publish(self._broadcast_link, broadcast.encode(commands, t=time.time(), seq=seq))]
+            else:
+                packets = []
+                for robot_id, command in commands.items():
+                    command['t'] = time.time()
+                    command['seq'] = seq
+                    packets.append(mqtt_broker.encode_publish('matlab_api/' + robot_id, json.dumps(command).encode(encoding='UTF-8')))
+
+            self._client.send(b''.join(packets))
+            self.sent += len(packets)
+            seq += 1
+
+
+def run_step(n, args):
+    """Runs a measurement with n robots.
+
+    Args:
+        n (int): Number of robots.
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        dict: The aggregate results.
+
+    """
+    port = free_port()
+    broker = multiprocessing.Process(target=run_broker, args=(port,), daemon=True)
+    broker.start()
+
+    # Wait for the broker to come up
+    client = None
+    deadline = time.monotonic() + READY_TIMEOUT
+    while(client is None):
+        try:
+            client = mqtt_broker.MqttClient(port=port, client_id='load_harness')
+        except OSError:
+            if(time.monotonic() > deadline):
+                raise
+            time.sleep(0.1)
+
+    counts = {'status': 0, 'metrics': 0}
+    broker_stats = []
+
+    def on_message(topic, payload):
+        counts[topic.split('/')[-1]] += 1
+
+    client.subscribe('+/status', on_message)
+    client.subscribe('+/metrics', on_message)
+    client.subscribe(mqtt_broker.STATS_TOPIC, lambda topic, payload: broker_stats.append(json.loads(payload.decode(encoding='UTF-8'))))
+
+    robot_ids = [str(i) for i in range(1, n + 1)]
+    mac_list_fd, mac_list_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(mac_list_fd, 'w') as f:
+        json.dump({make_mac(i): str(i) for i in range(1, n + 1)}, f)
+
+    reports = multiprocessing.Queue()
+    measure = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    extra_args = ['-update_rate', str(args.update_rate), '-codec', args.codec] + (['-pipelined'] if args.pipelined else [])
+    broadcast_link = broadcast.DEFAULT_LINK if args.broadcast else None
+    if(broadcast_link is not None):
+        extra_args += ['-broadcast_link', broadcast_link]
+    robots = [multiprocessing.Process(target=run_robot, args=(i, mac_list_path, port, extra_args, reports, measure, stop), daemon=True)
+              for i in range(1, n + 1)]
+
+    try:
+        for robot in robots:
+            robot.start()
+
+        for _ in robots:
+            reports.get(timeout=READY_TIMEOUT)
+
+        generator = CommandGenerator(client, robot_ids, args.command_rate, broadcast_link=broadcast_link)
+        generator.start()
+        time.sleep(args.warmup)
+
+        measure.set()
+        start = time.monotonic()
+        first_counts = dict(counts)
+        first_broker = len(broker_stats)
+        sent = generator.sent
+
+        time.sleep(args.duration)
+
+        elapsed = time.monotonic() - start
+        sent = generator.sent - sent
+        last_counts = dict(counts)
+        last_broker = broker_stats[-1] if len(broker_stats) > first_broker else None
+        stop.set()
+        generator.stop()
+
+        results = []
+        for _ in robots:
+            try:
+                kind, index, report = reports.get(timeout=REPORT_TIMEOUT)
+                if(kind == 'report'):
+                    results.append(report)
+            except queue.Empty:
+                break
+    finally:
+        stop.set()
+        measure.set()
+        client.stop()
+        for robot in robots:
+            robot.join(timeout=REPORT_TIMEOUT)
+            if(robot.is_alive()):
+                robot.terminate()
+        broker.terminate()
+        os.remove(mac_list_path)
+
+    merged = {name: metrics.Histogram() for name in HISTOGRAMS}
+    for report in results:
+        for name, histogram in report['histograms'].items():
+            merged[name].merge(histogram)
+
+    broker_rate = (0, 0)
+    if(last_broker is not None and first_broker > 0):
+        before = broker_stats[first_broker - 1]
+        span = last_broker['time'] - before['time']
+        broker_rate = ((last_broker['received'] - before['received']) / span, (last_broker['sent'] - before['sent']) / span)
+
+    cycles = sum(x['cycles'] for x in results)
+    return {
+        'robots': n,
+        'reported': len(results),
+        'commands_per_s': sent / elapsed,
+        'broker_in_per_s': broker_rate[0],
+        'broker_out_per_s': broker_rate[1],
+        'status_per_s': (last_counts['status'] - first_counts['status']) / elapsed,
+        'loop_hz': cycles / elapsed / max(1, len(results)),
+        'overrun_pct': 100 * sum(x['overruns'] for x in results) / max(1, cycles),
+        'superseded': sum(x['inputs']['superseded'] for x in results),
+        'age_p50_ms': 1000 * merged['command_age'].percentile(50),
+        'age_p99_ms': 1000 * merged['command_age'].percentile(99),
+        'cycle_p99_ms': 1000 * merged['cycle'].percentile(99),
+        'serial_p99_ms': 1000 * merged['serial_roundtrip'].percentile(99),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Runs many simulated robots against a local broker stand-in and reports how the system scales')
+    parser.add_argument('-robots', type=int, nargs='+', help='Numbers of robots to run, one measurement each', default=[20, 50, 100])
+    parser.add_argument('-duration', type=float, help='Length of each measurement in seconds', default=20)
+    parser.add_argument('-warmup', type=float, help='Time to run commands before each measurement in seconds', default=2)
+    parser.add_argument('-command_rate', type=float, help='Commands per second sent to each robot', default=30)
+    parser.add_argument('-update_rate', type=float, help='Period of the main loop of each robot', default=0.016)
+    parser.add_argument('-codec', choices=['binary', 'json'], help='Preferred serial codec', default='binary')
+    parser.add_argument('-pipelined', action='store_true', help='Pipeline the serial requests of each robot')
+    parser.add_argument('-broadcast', action='store_true', help='Send the commands for all robots in one message on a broadcast link')
+    parser.add_argument('-save', help='Save the results to this JSON file', default=None)
+
+    args = parser.parse_args()
+
+    columns = ['robots', 'reported', 'commands_per_s', 'broker_in_per_s', 'broker_out_per_s', 'status_per_s', 'loop_hz', 'overrun_pct',
+               'superseded', 'age_p50_ms', 'age_p99_ms', 'cycle_p99_ms', 'serial_p99_ms']
+    print(' '.join('{:>16}'.format(c) for c in columns))
+
+    rows = []
+    for n in args.robots:
+        row = run_step(n, args)
+        rows.append(row)
+        print(' '.join('{:>16.6g}'.format(row[c]) for c in columns))
+
+    if(args.save is not None):
+        with open(args.save, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+
+global logger
+logger = logging.getLogger('root')
+
+# Constants
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+STATS_TOPIC = '$SYS/broker/stats'
+MAX_QUEUED = 1000
+U16 = struct.Struct('>H')
+
+
+def encode_packet(packet_type, flags, body):
+    """Encodes an MQTT packet.
+
+    Args:
+        packet_type (int): The packet type (e.g., PUBLISH).
+        flags (int): The flags in the low four bits of the fixed header.
+        body (bytes): The variable header and payload.
+
+    Returns:
+        bytes: The packet.
+
+    """
+    header = bytearray([(packet_type << 4) | flags])
+    length = len(body)
+    while(True):
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length > 0 else byte)
+        if(length == 0):
+            break
+
+    return bytes(header) + body
+
+
+def encode_string(value):
+    """Encodes a UTF-8 string prefixed by its length."""
+    data = value.encode(encoding='UTF-8')
+    return U16.pack(len(data)) + data
+
+
+def encode_publish(topic, payload):
+    """Encodes a QoS 0 PUBLISH packet.
+
+    Args:
+        topic (str): The topic.
+        payload (bytes): The payload.
+
+    Returns:
+        bytes: The packet.
+
+    """
+    return encode_packet(PUBLISH, 0, encode_string(topic) + payload)
+
+
+def topic_matches(topic_filter, topic):
+    """Returns whether a topic matches a topic filter, which may contain + and # wildcards."""
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+
+    # Wildcards don't match topics starting with $
+    if(topic.startswith('$') and filter_levels[0] in ('+', '#')):
+        return False
+
+    for i, level in enumerate(filter_levels):
+        if(level == '#'):
+            return True
+        if(i >= len(levels) or (level != '+' and level != levels[i])):
+            return False
+
+    return len(filter_levels) == len(levels)
+
+
+class MqttBroker:
+    """A minimal MQTT 3.1.1 broker on asyncio, standing in for the real broker in load tests.
+
+    The broker supports what vizier nodes use: connections, subscriptions with wildcards, QoS 0 and 1 publishes (delivered at QoS 0), retained
+    messages and pings.  It has no authentication, persistence or wills.  Every stats period, it publishes its message counts on STATS_TOPIC.
+    Subscribers for each topic are cached, so routing a publish is a dict lookup unless the subscriptions have changed.
+
+    Each client has a bounded queue of outgoing packets, written by its own task, which waits for the socket to drain.  A slow subscriber
+    therefore neither stalls the other clients nor makes the broker buffer without limit: publishes to a client whose queue is full are dropped
+    (they are QoS 0), and a client's own acks wait for room, which stops reading from that client.
+
+    Attributes:
+        _host (str): Address to listen on.
+        _port (int): Port to listen on.
+        _stats_period (float): Time between publishes of the message counts, in seconds.
+        _max_queued (int): Number of packets queued for a client before publishes to it are dropped.
+        _subscriptions (dict): Maps each client's outgoing queue to its set of topic filters.
+        _routes (dict): Caches the queues of the clients subscribed to each topic.  Cleared when subscriptions change.
+        _retained (dict): Maps topics to their retained payloads.
+        _received (int): Number of publishes received.
+        _sent (int): Number of publishes sent.
+        _dropped (int): Number of publishes dropped because the subscriber's queue was full.
+        _loop (asyncio.AbstractEventLoop): The event loop the broker runs on, once serving.
+        _stopping (asyncio.Event): Set to stop serving.
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=1883, stats_period=1, max_queued=MAX_QUEUED):
+        """Creates the broker.
+
+        Args:
+            host (str, optional): Address to listen on.
+            port (int, optional): Port to listen on.
+            stats_period (float, optional): Time between publishes of the message counts, in seconds.
+            max_queued (int, optional): Number of packets queued for a client before publishes to it are dropped.
+
+        Examples:
+            >>> MqttBroker(port=1884).serve_forever()
+
+        """
+        self._host = host
+        self._port = port
+        self._stats_period = stats_period
+        self._max_queued = max_queued
+        self._subscriptions = {}
+        self._routes = {}
+        self._retained = {}
+        self._received = 0
+        self._sent = 0
+        self._dropped = 0
+        self._loop = None
+        self._stopping = None
+
+    def _route(self, topic):
+        queues = self._routes.get(topic)
+        if(queues is None):
+            queues = [q for q, filters in self._subscriptions.items() if any(topic_matches(f, topic) for f in filters)]
+            self._routes[topic] = queues
+
+        return queues
+
+    def _publish(self, topic, payload, retain=False):
+        if(retain):
+            if(payload):
+                self._retained[topic] = payload
+            else:
+                self._retained.pop(topic, None)
+
+        packet = encode_publish(topic, payload)
+        for queue in self._route(topic):
+            try:
+                queue.put_nowait(packet)
+                self._sent += 1
+            except asyncio.QueueFull:
+                self._dropped += 1
+
+    async def _writer_task(self, writer, queue):
+        try:
+            while(True):
+                writer.write(await queue.get())
+                # Only waits if the socket's buffer is over its high-water mark
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _handle(self, reader, writer):
+        queue = asyncio.Queue(self._max_queued)
+        send = queue.put
+        writer_task = asyncio.ensure_future(self._writer_task(writer, queue))
+        self._subscriptions[queue] = set()
+
+        try:
+            while(True):
+                first = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while(True):
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if(not byte & 0x80):
+                        break
+
+                body = (await reader.readexactly(length)) if length > 0 else b''
+                packet_type = first[0] >> 4
+                flags = first[0] & 0x0F
+
+                if(packet_type == CONNECT):
+                    await send(encode_packet(CONNACK, 0, b'\x00\x00'))
+                elif(packet_type == PUBLISH):
+                    qos = (flags >> 1) & 0x03
+                    topic_length = U16.unpack_from(body)[0]
+                    topic = body[2:2 + topic_length].decode(encoding='UTF-8')
+                    offset = 2 + topic_length
+                    if(qos > 0):
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        await send(encode_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+                    self._received += 1
+                    self._publish(topic, body[offset:], retain=bool(flags & 0x01))
+                elif(packet_type == PUBREL):
+                    await send(encode_packet(PUBCOMP, 0, body[:2]))
+                elif(packet_type == SUBSCRIBE):
+                    offset = 2
+                    codes = bytearray()
+                    new = []
+                    while(offset < len(body)):
+                        filter_length = U16.unpack_from(body, offset)[0]
+                        new.append(body[offset + 2:offset + 2 + filter_length].decode(encoding='UTF-8'))
+                        offset += 3 + filter_length
+                        codes.append(0)
+                    self._subscriptions[queue].update(new)
+                    self._routes.clear()
+                    await send(encode_packet(SUBACK, 0, body[:2] + bytes(codes)))
+                    for topic, payload in self._retained.items():
+                        if(any(topic_matches(f, topic) for f in new)):
+                            await send(encode_packet(PUBLISH, 0x01, encode_string(topic) + payload))
+                elif(packet_type == UNSUBSCRIBE):
+                    offset = 2
+                    while(offset < len(body)):
+                        filter_length = U16.unpack_from(body, offset)[0]
+                        self._subscriptions[queue].discard(body[offset + 2:offset + 2 + filter_length].decode(encoding='UTF-8'))
+                        offset += 2 + filter_length
+                    self._routes.clear()
+                    await send(encode_packet(UNSUBACK, 0, body[:2]))
+                elif(packet_type == PINGREQ):
+                    await send(encode_packet(PINGRESP, 0, b''))
+                elif(packet_type == DISCONNECT):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._subscriptions[queue]
+            self._routes.clear()
+            writer_task.cancel()
+            writer.close()
+
+    async def _stats_task(self):
+        while(True):
+            await asyncio.sleep(self._stats_period)
+            self._publish(STATS_TOPIC, json.dumps({'time': time.time(), 'received': self._received, 'sent': self._sent,
+                                                   'dropped': self._dropped, 'clients': len(self._subscriptions)}).encode(encoding='UTF-8'))
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        server = await asyncio.start_server(self._handle, self._host, self._port)
+        stats_task = asyncio.ensure_future(self._stats_task())
+        logger.info('MQTT broker listening on ({0}:{1})'.format(self._host, self._port))
+
+        try:
+            await self._stopping.wait()
+        finally:
+            stats_task.cancel()
+            server.close()
+
+    def serve_forever(self):
+        """Runs the broker on a new event loop until the process is stopped or stop is called."""
+        asyncio.run(self._serve())
+
+    def stop(self):
+        """Stops serve_forever.  May be called from any thread once the broker is listening."""
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+
+class MqttClient:
+    """A minimal, blocking MQTT client for QoS 0 traffic.
+
+    Attributes:
+        _socket (socket.socket): Connection to the broker.
+        _callbacks (list): (topic filter, callback) for each subscription.
+        _lock (threading.Lock): Serializes writes to the socket.
+        _thread (threading.Thread): Reads packets from the broker.
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=1883, client_id='gritsbot', timeout=5):
+        """Connects to a broker.
+
+        Args:
+            host (str, optional): Address of the broker.
+            port (int, optional): Port of the broker.
+            client_id (str, optional): ID of the client.
+            timeout (float, optional): Time to wait for the connection in seconds.
+
+        Raises:
+            ConnectionError: If the broker refuses the connection.
+
+        Examples:
+            >>> client = MqttClient(port=1884)
+            >>> client.subscribe('+/status', lambda topic, payload: print(topic, payload))
+            >>> client.publish('matlab_api/1', b'{"v": 0.1, "w": 0}')
+
+        """
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._packet_id = 0
+
+        # Protocol name and level, clean session, no keepalive
+        self._socket.sendall(encode_packet(CONNECT, 0, encode_string('MQTT') + bytes([4, 0x02]) + U16.pack(0) + encode_string(client_id)))
+        packet_type, _, body = self._read_packet()
+        if(packet_type != CONNACK or body[1] != 0):
+            raise ConnectionError('Broker refused the connection.')
+
+        self._socket.settimeout(None)
+        self._thread = threading.Thread(target=self._reader_task, daemon=True)
+        self._thread.start()
+
+    def _read_exactly(self, n):
+        data = bytearray()
+        while(len(data) < n):
+            chunk = self._socket.recv(n - len(data))
+            if(not chunk):
+                raise ConnectionError('Broker closed the connection.')
+            data += chunk
+
+        return bytes(data)
+
+    def _read_packet(self):
+        first = self._read_exactly(1)[0]
+        length = 0
+        multiplier = 1
+        while(True):
+            byte = self._read_exactly(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if(not byte & 0x80):
+                break
+
+        return first >> 4, first & 0x0F, self._read_exactly(length) if length > 0 else b''
+
+    def _reader_task(self):
+        try:
+            while(True):
+                packet_type, flags, body = self._read_packet()
+                if(packet_type == PUBLISH):
+                    topic_length = U16.unpack_from(body)[0]
+                    topic = body[2:2 + topic_length].decode(encoding='UTF-8')
+                    offset = 2 + topic_length + (2 if (flags >> 1) & 0x03 else 0)
+                    for topic_filter, callback in self._callbacks:
+                        if(topic_matches(topic_filter, topic)):
+                            callback(topic, body[offset:])
+        except (ConnectionError, OSError):
+            pass
+
+    def send(self, packet):
+        """Sends an encoded packet (e.g., from encode_publish) to the broker."""
+        with self._lock:
+            self._socket.sendall(packet)
+
+    def publish(self, topic, payload):
+        """Publishes a payload (bytes) on a topic at QoS 0."""
+        self.send(encode_publish(topic, payload))
+
+    def subscribe(self, topic_filter, callback):
+        """Subscribes to a topic filter.  The callback is called with the topic and payload of each message, from the reader thread."""
+        self._callbacks.append((topic_filter, callback))
+        self._packet_id = self._packet_id % 65535 + 1
+        self.send(encode_packet(SUBSCRIBE, 0x02, U16.pack(self._packet_id) + encode_string(topic_filter) + b'\x00'))
+
+    def stop(self):
+        """Disconnects from the broker."""
+        try:
+            self.send(encode_packet(DISCONNECT, 0, b''))
+        except OSError:
+            pass
+        self._socket.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Runs a minimal MQTT broker for load tests')
+    parser.add_argument('-host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('-port', type=int, help='Port to listen on', default=1883)
+
+    args = parser.parse_args()
+    MqttBroker(args.host, args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import gritsbot.gritsbotserial as gritsbotserial
+import gritsbot.simulator as simulator
+from gritsbot.request import Request
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+
+# Constants
+PERCENTILES = (50, 99, 99.9)
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.032, 0.064, float('inf'))
+HISTOGRAM_WIDTH = 50
+
+
+def motor_mix():
+    """Motor command only, as sent when a new input arrives between status updates."""
+    return Request().add_write_request('motor', {'v': 0.1, 'w': 0.0})
+
+
+def motor_leds_mix():
+    """Motor command with both LEDs."""
+    return Request().add_write_request('motor', {'v': 0.1, 'w': 0.0}) \
+        .add_write_request('left_led', {'rgb': [255, 0, 0]}) \
+        .add_write_request('right_led', {'rgb': [0, 0, 255]})
+
+
+def motor_status_mix():
+    """Motor command with the status reads, as sent once per status update."""
+    return Request().add_read_request('batt_volt').add_read_request('charge_status') \
+        .add_write_request('motor', {'v': 0.1, 'w': 0.0})
+
+
+MIXES = {
+    'motor': motor_mix,
+    'motor_leds': motor_leds_mix,
+    'motor_status': motor_status_mix,
+}
+
+
+def percentile(samples, p):
+    """Returns the p-th percentile of sorted samples by the nearest-rank method.
+
+    Args:
+        samples (list): Sorted samples.
+        p (float): Percentile in [0, 100].
+
+    Returns:
+        float: The percentile.
+
+    """
+    rank = max(1, int(math.ceil(p / 100 * len(samples))))
+    return samples[rank - 1]
+
+
+def format_histogram(samples, buckets=HISTOGRAM_BUCKETS):
+    """Formats a text histogram of latency samples.
+
+    Args:
+        samples (list): Latency samples in seconds.
+        buckets (tuple): Upper bounds of the buckets in seconds.
+
+    Returns:
+        str: One line per bucket.
+
+    """
+    counts = [0]*len(buckets)
+    for sample in samples:
+        for i, bound in enumerate(buckets):
+            if(sample <= bound):
+                counts[i] += 1
+                break
+
+    most = max(counts) if samples else 1
+    lines = []
+    for bound, count in zip(buckets, counts):
+        label = '<= {:7.2f} ms'.format(bound*1000) if bound != float('inf') else '>  {:7.2f} ms'.format(buckets[-2]*1000)
+        lines.append('{0} | {1:<{2}} {3}'.format(label, '#'*int(round(HISTOGRAM_WIDTH*count/most)), HISTOGRAM_WIDTH, count))
+
+    return '\n'.join(lines)
+
+
+def run_mix(serial, mix, iterations, warmup=100):
+    """Drives serial_request with one request mix.
+
+    Args:
+        serial (GritsbotSerial): A started serial connection.
+        mix (function): Returns the Request to send.
+        iterations (int): Number of timed transactions.
+        warmup (int, optional): Number of untimed transactions to run first.
+
+    Returns:
+        dict: Latency percentiles, throughput, bytes and CPU time per transaction, and the raw latency samples.
+
+    """
+    msg = mix().to_json_encodable()
+
+    for _ in range(warmup):
+        serial.serial_request(msg)
+
+    samples = []
+    failures = 0
+    start_stats = serial.stats()
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+
+    for _ in range(iterations):
+        t = time.perf_counter()
+        try:
+            response = serial.serial_request(msg)
+        except RuntimeError:
+            response = None
+        samples.append(time.perf_counter() - t)
+        if(response is None):
+            failures += 1
+
+    elapsed = time.perf_counter() - start_time
+    cpu = time.process_time() - start_cpu
+    stats = serial.stats()
+    samples.sort()
+
+    result = {'p{}'.format(p): percentile(samples, p) for p in PERCENTILES}
+    result.update({
+        'mean': sum(samples) / len(samples),
+        'tps': iterations / elapsed,
+        'bytes_written': (stats['bytes_written'] - start_stats['bytes_written']) / iterations,
+        'bytes_read': (stats['bytes_read'] - start_stats['bytes_read']) / iterations,
+        'cpu': cpu / iterations,
+        'failures': failures,
+        'samples': samples,
+    })
+
+    return result
+
+
+def _serve_simulator(link, baud_rate, latency, jitter):
+    """Runs the stand-in device in its own process, so its CPU time isn't attributed to the serial stack."""
+    device = simulator.SimulatedGritsbot(link=link, baud_rate=baud_rate, latency=latency, jitter=jitter)
+    device.start()
+    while True:
+        time.sleep(1)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-serial_dev', help='Serial device to benchmark.  If not given, a simulated device is started.', default=None)
+    parser.add_argument('-mix', choices=sorted(MIXES), nargs='+', help='Request mixes to run', default=sorted(MIXES))
+    parser.add_argument('-n', type=int, help='Timed transactions per mix', default=5000)
+    parser.add_argument('-warmup', type=int, help='Untimed transactions per mix', default=100)
+    parser.add_argument('-codec', choices=['binary', 'json'], nargs='+', help='Serial codecs to benchmark, each on its own connection',
+                        default=['binary', 'json'])
+    parser.add_argument('-pipelined', action='store_true', help='Use the pipelined serial mode')
+    parser.add_argument('-baud_rate', type=int, help='Baud rate of the simulated device', default=500000)
+    parser.add_argument('-latency', type=float, help='Response latency of the simulated device', default=0.0005)
+    parser.add_argument('-jitter', type=float, help='Response jitter of the simulated device', default=0.0)
+    parser.add_argument('-histogram', action='store_true', help='Print a latency histogram for each mix')
+    parser.add_argument('-save', help='Save results to this JSON file', default=None)
+    parser.add_argument('-compare', help='Compare against results saved in this JSON file', default=None)
+    parser.add_argument('-tolerance', type=float, help='Allowed relative p99 regression when comparing', default=0.2)
+
+    args = parser.parse_args()
+
+    sim_process = None
+    serial_dev = args.serial_dev
+    if(serial_dev is None):
+        serial_dev = os.path.join(tempfile.mkdtemp(), 'ttyGRITS')
+        sim_process = multiprocessing.Process(target=_serve_simulator, args=(serial_dev, args.baud_rate, args.latency, args.jitter), daemon=True)
+        sim_process.start()
+        while(not os.path.exists(serial_dev)):
+            time.sleep(0.01)
+
+    # Results are labelled with the codec actually negotiated, which falls back to JSON if the device doesn't support the one asked for
+    results = {}
+    try:
+        for codec in args.codec:
+            codecs = [gritsbotserial.JsonCodec()]
+            if(codec == 'binary'):
+                codecs.insert(0, gritsbotserial.BinaryCodec())
+
+            serial = gritsbotserial.GritsbotSerial(serial_dev=serial_dev, baud_rate=500000, pipelined=args.pipelined, codecs=codecs)
+            serial.start()
+            try:
+                for name in args.mix:
+                    results['{0}/{1}'.format(name, serial._codec.name)] = run_mix(serial, MIXES[name], args.n, warmup=args.warmup)
+            finally:
+                serial.stop()
+    finally:
+        if(sim_process is not None):
+            sim_process.terminate()
+
+    print('{:<22}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>6}'.format('mix', 'p50 ms', 'p99 ms', 'p999 ms', 'tps', 'B out', 'B in', 'CPU us', 'fail'))
+    for name, r in results.items():
+        print('{:<22}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.0f}{:>10.1f}{:>10.1f}{:>10.1f}{:>6}'.format(
+              name, r['p50']*1e3, r['p99']*1e3, r['p99.9']*1e3, r['tps'], r['bytes_written'], r['bytes_read'], r['cpu']*1e6, r['failures']))
+        if(args.histogram):
+            print(format_histogram(r['samples']))
+
+    summary = {name: {k: v for k, v in r.items() if k != 'samples'} for name, r in results.items()}
+
+    if(args.save is not None):
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+    if(args.compare is not None):
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+        regressed = [name for name, r in summary.items()
+                     if name in baseline and r['p99'] > baseline[name]['p99']*(1 + args.tolerance)]
+        for name in regressed:
+            print('Regression in ({0}): p99 {1:.3f} ms vs. baseline {2:.3f} ms'.format(name, summary[name]['p99']*1e3, baseline[name]['p99']*1e3))
+
+        if(regressed):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
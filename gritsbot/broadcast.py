@@ -0,0 +1,142 @@
+import math
+import struct
+
+# Constants
+VERSION = 1
+HEADER = struct.Struct('<BxHdI')  # version, number of slots, send time, sequence number
+SLOT = struct.Struct('<HBff3B3B')  # robot ID, fields present, v, w, left LED RGB, right LED RGB
+ID = struct.Struct('<H')
+DEFAULT_LINK = 'matlab_api/broadcast'
+
+# Fields present in a slot
+MOTOR = 0x01
+LEFT_LED = 0x02
+RIGHT_LED = 0x04
+
+
+def encode(commands, t=None, seq=0):
+    """Packs commands for many robots into one broadcast message.
+
+    Each robot gets a fixed-size slot, so a robot finds its command without decoding anyone else's.  Slots are in ascending robot ID order.
+
+    Args:
+        commands (dict): Maps robot IDs (integers or strings of integers) to commands in the matlab_api format, e.g., {'v': 0.1, 'w': 0,
+            'left_led': [255, 0, 0]}.
+        t (float, optional): Time the message is sent, as in the matlab_api format.  Omitted if None.
+        seq (int, optional): Sequence number of the message.
+
+    Returns:
+        bytes: The message.
+
+    Examples:
+        >>> robot_node.put(DEFAULT_LINK, encode({'1': {'v': 0.1, 'w': 0}, '2': {'v': 0, 'w': 0.5}}, t=time.time(), seq=7))
+
+    """
+    slots = []
+    for robot_id in sorted(commands, key=int):
+        command = commands[robot_id]
+        fields = 0
+        v = w = 0.0
+        left = right = (0, 0, 0)
+
+        if('v' in command and 'w' in command):
+            fields |= MOTOR
+            v, w = command['v'], command['w']
+        if('left_led' in command):
+            fields |= LEFT_LED
+            left = command['left_led']
+        if('right_led' in command):
+            fields |= RIGHT_LED
+            right = command['right_led']
+
+        slots.append(SLOT.pack(int(robot_id), fields, v, w, *left, *right))
+
+    return HEADER.pack(VERSION, len(slots), float('nan') if t is None else t, seq % 2**32) + b''.join(slots)
+
+
+class SlotExtractor:
+    """Extracts one robot's command from broadcast messages.
+
+    The slot the robot was found in last time is checked first, so while the set of robots doesn't change, extraction is a single unpack.
+
+    Attributes:
+        _robot_id (int): ID of the robot.
+        _hint (int): Index of the slot the robot was found in last time.
+
+    """
+
+    def __init__(self, robot_id):
+        """Creates the extractor.
+
+        Args:
+            robot_id (int or str): ID of the robot.
+
+        Examples:
+            >>> extractor = SlotExtractor('3')
+            >>> broadcast_inputs = Mailbox(decode=extractor.extract)
+
+        """
+        self._robot_id = int(robot_id)
+        self._hint = 0
+
+    def _find(self, payload, count):
+        offset = HEADER.size + self._hint*SLOT.size
+        if(self._hint < count and ID.unpack_from(payload, offset)[0] == self._robot_id):
+            return self._hint
+
+        # Slots are in ID order, so search for the robot
+        lo, hi = 0, count
+        while(lo < hi):
+            mid = (lo + hi) // 2
+            if(ID.unpack_from(payload, HEADER.size + mid*SLOT.size)[0] < self._robot_id):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if(lo < count and ID.unpack_from(payload, HEADER.size + lo*SLOT.size)[0] == self._robot_id):
+            self._hint = lo
+            return lo
+
+        return None
+
+    def extract(self, payload):
+        """Extracts the robot's command from a broadcast message.
+
+        Args:
+            payload (bytes): The broadcast message.
+
+        Raises:
+            ValueError: If the message is malformed or of an unknown version.
+
+        Returns:
+            dict: The command in the matlab_api format (with 't' and 'seq' from the message), or None if the message has no slot for the robot.
+
+        """
+        if(len(payload) < HEADER.size):
+            raise ValueError('Broadcast message of {} bytes is too short.'.format(len(payload)))
+
+        version, count, t, seq = HEADER.unpack_from(payload)
+        if(version != VERSION):
+            raise ValueError('Unknown broadcast message version ({}).'.format(version))
+        if(len(payload) < HEADER.size + count*SLOT.size):
+            raise ValueError('Broadcast message of {0} bytes is too short for {1} slots.'.format(len(payload), count))
+
+        index = self._find(payload, count)
+        if(index is None):
+            return None
+
+        _, fields, v, w, lr, lg, lb, rr, rg, rb = SLOT.unpack_from(payload, HEADER.size + index*SLOT.size)
+
+        command = {'seq': seq}
+        if(not math.isnan(t)):
+            command['t'] = t
+        if(fields & MOTOR):
+            # Undo the float32 rounding noise (e.g., 0.1 -> 0.10000000149)
+            command['v'] = round(v, 6)
+            command['w'] = round(w, 6)
+        if(fields & LEFT_LED):
+            command['left_led'] = [lr, lg, lb]
+        if(fields & RIGHT_LED):
+            command['right_led'] = [rr, rg, rb]
+
+        return command
@@ -0,0 +1,69 @@
+class WriteCoalescer:
+    """Suppresses writes to the microcontroller that would not change anything.
+
+    A write is only added to a request if its body differs from the last body sent on that interface or, for interfaces with a keepalive, if the
+    keepalive period has passed since the last write.  Keepalives are only sent when a write is requested, so if commands stop arriving, writes stop
+    too and the microcontroller's watchdog still stops the robot.
+
+    Attributes:
+        _keepalive (dict): Maps interface names to keepalive periods in seconds.  Interfaces not in the dict are written only on change.
+        _last (dict): Maps interface names to the last body sent and the time it was sent.
+        _sent (int): Number of writes added to requests.
+        _suppressed (int): Number of writes suppressed.
+
+    """
+
+    def __init__(self, keepalive=None):
+        """Creates the coalescer.
+
+        Args:
+            keepalive (dict, optional): Maps interface names to keepalive periods in seconds.
+
+        Examples:
+            >>> WriteCoalescer(keepalive={'motor': 0.1})
+
+        """
+        self._keepalive = dict(keepalive) if keepalive else {}
+        self._last = {}
+        self._sent = 0
+        self._suppressed = 0
+
+    def add_write(self, request, handlers, iface, body, handler, now):
+        """Adds a write to a request unless it would be redundant.
+
+        Args:
+            request (Request): The request for this cycle.
+            handlers (list): Handlers for the request, one per request entry.
+            iface (str): The interface to write.
+            body (dict): The body to write.
+            handler (function): Handler for the response to the write.
+            now (float): The current monotonic time.
+
+        Returns:
+            bool: Whether the write was added.
+
+        """
+        last = self._last.get(iface)
+        keepalive = self._keepalive.get(iface)
+
+        if(last is not None and last[0] == body and (keepalive is None or now - last[1] < keepalive)):
+            self._suppressed += 1
+            return False
+
+        request.add_write_request(iface, body)
+        handlers.append(handler)
+        self._last[iface] = (body, now)
+        self._sent += 1
+        return True
+
+    def invalidate(self):
+        """Forgets what was last sent, so every interface is written on its next request.
+
+        Should be called when writes may not have reached the microcontroller (e.g., after a serial error).
+
+        """
+        self._last.clear()
+
+    def stats(self):
+        """Returns the number of writes sent ('sent') and suppressed ('suppressed')."""
+        return {'sent': self._sent, 'suppressed': self._suppressed}
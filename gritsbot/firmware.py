@@ -1,17 +1,27 @@
 import gritsbot.gritsbotserial as gritsbotserial
+from gritsbot.request import Request
+import gritsbot.scheduler as scheduler
+import gritsbot.polling as polling
+import gritsbot.coalesce as coalesce
+import gritsbot.status as status
+import gritsbot.publisher as publisher
+import gritsbot.mailbox as mailbox
+import gritsbot.metrics as metrics
+import gritsbot.tracing as tracing
+import gritsbot.recording as recording
+import gritsbot.broadcast as broadcast
+import gritsbot.utils.nonblocking_log as nonblocking_log
 import json
-import vizier.node as node
+import logging
+import threading
 import time
 import argparse
-import queue
-import netifaces
-import vizier.log as log
+import collections
+import concurrent.futures
+import signal
 
 global logger
-logger = log.get_logger()
-
-# Constants
-MAX_QUEUE_SIZE = 100
+logger = logging.getLogger('root')
 
 
 def get_mac():
@@ -26,17 +36,21 @@ def get_mac():
 
     """
 
+    import netifaces
+
     interface = [x for x in netifaces.interfaces() if 'wlan' in x][0]
     return netifaces.ifaddresses(interface)[netifaces.AF_LINK][0]['addr']
 
 
-def create_node_descriptor(end_point):
+def create_node_descriptor(end_point, broadcast_link=None):
     """Returns a node descriptor for the robot based on the end_point.
 
-    The server_alive link is for the robot to check the MQTT connection periodically.
+    The server_alive link is for the robot to check the MQTT connection periodically.  The metrics link carries timing histograms for the control
+    loop.  The optional broadcast link carries commands for the whole fleet in one message.
 
     Args:
         end_point (str): The ID of the robot.
+        broadcast_link (str, optional): A broadcast command link to request as well.
 
     Returns:
         dict: A node descriptor of the vizier format for the robot.
@@ -51,6 +65,7 @@ def create_node_descriptor(end_point):
             'links':
             {
                 '/status': {'type': 'DATA'},
+                '/metrics': {'type': 'DATA'},
             },
             'requests':
             [
@@ -62,126 +77,605 @@ def create_node_descriptor(end_point):
             ]
         }
 
+    if(broadcast_link is not None):
+        node_descriptor['requests'].append({'link': broadcast_link, 'type': 'STREAM', 'required': False})
+
     return node_descriptor
 
-# Responses
-# Battery voltage response
-# response = {'status': 1, 'body': {'bat_volt': 4.3}}
 
+def decode_input(payload):
+    """Decodes a raw input message from the matlab_api link.
 
-class Request:
-    """Represents serial requests to the microcontroller.
+    Raises:
+        Exception: If the payload is not UTF-8 encoded JSON.
 
-    The serial communications operate on a request/response architecture.  For example, the request is of a form (when JSON encoded)
+    """
 
-    .. code-block:: python
+    return json.loads(payload.decode(encoding='UTF-8'))
 
-        {'request': ['read', 'write', 'read'], 'iface': [iface1, iface2, iface3], body: [body1, body2, body3]}
 
-    Attributes:
-        request (list): A list of requests (or actions) to perform.  Must be 'read' or 'write'.
-        iface (list): A list of interfaces on which to perform the request
-        body (list): A list of bodies for the requests.  These are empty if the request is a read.
+def handle_write_response(status, body):
+    return {}
+
+
+def handle_read_response(iface, status, body):
+
+    if(iface in body):
+        return {iface: body[iface]}
+    else:
+        logger.critical('Request for ({0}) not in body ({1}) after request.'.format(iface, body))
+        return {}
+
+
+def handle_response(response, handlers):
+    """Dispatches each status/body pair of a serial response to the handler for the corresponding request.
+
+    Args:
+        response (dict): The response from the microcontroller, containing 'status' and 'body' lists.
+        handlers (list): One handler per request, called with the status and body for that request.
+
+    Returns:
+        dict: The status data gathered by the handlers.
 
     """
 
-    def __init__(self):
-        """Initializes a request with optional iface, request, and body parameters.
+    updates = {}
 
-        Returns:
-            The created request.
+    # We'll have a status and body for each request
+    if(response is not None and 'status' in response and 'body' in response
+       and len(response['status']) == len(handlers) and len(response['body']) == len(handlers)):
+        status = response['status']
+        body = response['body']
+        # Ensure the appropriate handler gets each response
+        for i, handler in enumerate(handlers):
+            updates.update(handler(status[i], body[i]))
+    else:
+        logger.critical('Malformed response ({})'.format(response))
 
-        """
-        self.iface = []
-        self.request = []
-        self.body = []
+    return updates
 
-    def add_write_request(self, iface, body):
-        """Adds a write to the request.
 
-        Args:
-            iface (str): The interface to write.
-            body (dict): A JSON-encodable body to be written.
+def create_parser():
+    """Creates the parser for the firmware's command-line arguments.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mac_list", help="JSON file containing MAC to id mapping")
+    parser.add_argument("-port", type=int, help="MQTT Port", default=8080)
+    parser.add_argument("-host", help="MQTT Host IP", default="localhost")
+    parser.add_argument('-update_rate', type=float, help='Update rate for robot main loop', default=0.016)
+    parser.add_argument('-idle_after', type=float, help='Slow the main loop down after this many seconds without input commands (0 disables)',
+                        default=5)
+    parser.add_argument('-idle_update_rate', type=float, help='Update rate for robot main loop while idle', default=0.2)
+    parser.add_argument('-status_update_rate', type=float, help='How often to check status info', default=1)
+    parser.add_argument('-poll', nargs='*', metavar='IFACE:PERIOD', help='Additional interfaces to read periodically (e.g., encoders:0.01)',
+                        default=[])
+    parser.add_argument('-status_heartbeat', type=float, help='Publish status at least this often, even if unchanged', default=1)
+    parser.add_argument('-deadband', nargs='*', metavar='FIELD:VALUE', help='Smallest change of a status field that is published',
+                        default=['batt_volt:0.02'])
+    parser.add_argument('-motor_keepalive', type=float, help='Resend unchanged motor commands this often while commands arrive', default=0.1)
+    parser.add_argument('-overrun_policy', choices=[scheduler.SKIP, scheduler.CATCH_UP], help='What to do when the main loop overruns',
+                        default=scheduler.SKIP)
+    parser.add_argument('-poll_inputs', action='store_true', help='Only check for input commands on the loop schedule, instead of on arrival')
+    parser.add_argument('-pipelined', action='store_true', help='Keep serial requests in flight across loop iterations')
+    parser.add_argument('-serial_dev', help='Path to the serial device (e.g., a simulated device)', default='/dev/ttyACM0')
+    parser.add_argument('-vid', type=lambda x: int(x, 0), help='USB vendor ID to match the serial device by', default=None)
+    parser.add_argument('-pid', type=lambda x: int(x, 0), help='USB product ID to match the serial device by', default=None)
+    parser.add_argument('-serial_number', help='USB serial number to match the serial device by', default=None)
+    parser.add_argument('-metrics_period', type=float, help='How often to publish loop metrics', default=5)
+    parser.add_argument('-metrics_file', help='Also write loop metrics to this file in the Prometheus text format', default=None)
+    parser.add_argument('-max_command_age', type=float, help='Reject commands older than this many seconds when taken', default=None)
+    parser.add_argument('-log_interval', type=float, help='Collapse repeated warnings from the same place into one summary per interval',
+                        default=nonblocking_log.SUMMARY_INTERVAL)
+    parser.add_argument('-broadcast_link', help='Also take commands from this broadcast link (e.g., {})'.format(broadcast.DEFAULT_LINK),
+                        default=None)
+    parser.add_argument('-record', help='Record inputs and serial traffic to this ring file (e.g., for gritsbot.recording)', default=None)
+    parser.add_argument('-record_size', type=int, help='Size of the recording ring file in bytes', default=recording.RING_SIZE)
+    parser.add_argument('-codec', choices=['binary', 'json'], help='Preferred serial codec (falls back to JSON)', default='binary')
+
+    return parser
+
+
+def parse_args(argv=None):
+    """Parses the firmware's command-line arguments, checking the ones that depend on each other.
+
+    Args:
+        argv (list, optional): The arguments.  Defaults to the process's command line.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+
+    Examples:
+        >>> args = parse_args(['mac_list.json', '-poll', 'encoders:0.01', '-codec', 'json'])
+
+    """
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    # A request is encoded as a whole, so one interface the binary codec doesn't know would fail every request
+    if(args.codec == 'binary'):
+        unsupported = [x.split(':')[0] for x in args.poll if x.split(':')[0] not in gritsbotserial.BINARY_INTERFACES]
+        if(unsupported):
+            parser.error('The binary codec cannot read ({0}); use -codec json to poll them.'.format(', '.join(unsupported)))
+
+    return args
+
+
+class Controller:
+    """The robot's control loop.
+
+    Each cycle takes the newest input command, packs the writes it calls for and the reads that are due into one serial request, handles the
+    responses that have arrived and hands status data to a sender thread, which serializes and publishes it.  The loop itself only touches the
+    serial connection and in-memory state.  The controller only talks to the outside world through a serial connection and a put
+    function, so it can be driven by a vizier node, a recording or a load harness alike.
+
+    A new input command wakes the loop up right away, so it goes to the microcontroller without waiting for the next deadline.  Periodic work
+    (e.g., status reads) keeps its schedule.  While no input commands arrive for a while, the loop runs at a slower idle rate.  It returns to the
+    full rate on the first new command.
+
+    Attributes:
+        inputs (mailbox.Mailbox): Holds the newest input command.
+        broadcast_inputs (mailbox.Mailbox): Holds the newest broadcast command message, or None if there is no broadcast link.
+        _wake (threading.Event): Set when an input command arrives, to wake the loop up, or None if inputs are only checked on schedule.
+        loop_scheduler (scheduler.PeriodicScheduler): Paces the cycles.
+        _serial (gritsbotserial.GritsbotSerial): Serial connection to the microcontroller.
+        _put (function): Called with a link and a payload to publish.
+        _publisher (publisher.BackgroundPublisher): Publishes status data and loop metrics from its sender thread.
+        _args (argparse.Namespace): Parsed command-line arguments (see create_parser).
+        metrics (metrics.Metrics): Timing of the phases of each cycle.
+        _recorder (recording.Recorder): Records inputs and serial traffic, or None.
+        _logs (nonblocking_log.NonBlockingLogging): Background logging, whose stats are logged, or None.
+        _started_at (float): Monotonic time at which startup began, or None.
+        _idle (bool): Whether the loop is running at the idle rate.
+        _last_input_time (float): When the loop last took an input command.
+        _mode_cpu (dict): CPU time of the process spent in each mode ('active' and 'idle'), in seconds.
+        _mode_time (dict): Time spent in each mode, in seconds.
+        _mode_mark (tuple): CPU and monotonic time when the mode totals were last updated.
+        _first_command (bool): Whether no command has been accepted yet.
+
+    """
 
-        Returns:
-            The modified request containing the new interface and body.
+    def __init__(self, serial, put, robot_id, args, loop_metrics, recorder=None, logs=None, started_at=None):
+        """Creates the control loop.
+
+        Args:
+            serial (gritsbotserial.GritsbotSerial): A started serial connection to the microcontroller.
+            put (function): Called with a link and a payload to publish (e.g., a vizier node's put).
+            robot_id (str): The ID of the robot.
+            args (argparse.Namespace): Parsed command-line arguments (see create_parser).
+            loop_metrics (metrics.Metrics): Where to record the timing of the phases of each cycle.
+            recorder (recording.Recorder, optional): Records inputs and serial traffic.
+            logs (nonblocking_log.NonBlockingLogging, optional): Background logging, whose stats are logged.
+            started_at (float, optional): Monotonic time at which startup began, from which the time to the first command is measured.
 
         Examples:
-            >>> r = Request().add_write_request('motor', {'v': 0.1, 'w': 0.0})
+            >>> controller = Controller(serial, robot_node.put, '1', parse_args(), metrics.Metrics())
+            >>> robot_node.subscribe_with_callback('matlab_api/1', controller.on_input)
+            >>> controller.run()
 
         """
+        self._serial = serial
+        self._put = put
+        self._args = args
+        self.metrics = loop_metrics
+        self._recorder = recorder
+        self._logs = logs
+        self._started_at = started_at
+        self._first_command = True
+        self._running = True
+
+        self._status_link = robot_id + '/status'
+        self._metrics_link = robot_id + '/metrics'
+        self._metrics_labels = {'robot': robot_id}
+        self._phases = metrics.PhaseTimer(loop_metrics)
+
+        # Latency of commands from matlab_api to the microcontroller, using the optional send time ('t') and sequence number ('seq') of each command
+        self._tracer = tracing.CommandTracer(loop_metrics, max_age=args.max_command_age)
+
+        # Queues for STREAM links
+        # Only the newest input matters, so inputs overwrite each other in a single slot rather than queueing up.  They're decoded only when taken.
+        # Putting an input wakes the loop up, unless inputs are only checked on schedule.
+        self._wake = None if args.poll_inputs else threading.Event()
+        self.inputs = mailbox.Mailbox(decode=decode_input, wake=self._wake)
+
+        # Broadcast messages carry every robot's command; only this robot's slot is unpacked when taken
+        self.broadcast_inputs = None
+        if(args.broadcast_link is not None):
+            self._extractor = broadcast.SlotExtractor(robot_id)
+            self.broadcast_inputs = mailbox.Mailbox(decode=self._extractor.extract, wake=self._wake)
+
+        # The main loop runs against monotonic deadlines, so it neither drifts nor jumps with the wall clock
+        self.loop_scheduler = scheduler.PeriodicScheduler(args.update_rate, overrun_policy=args.overrun_policy)
+
+        # Interfaces read periodically.  Every read due in a cycle goes into that cycle's single serial request.
+        self._poller = polling.PollScheduler([polling.PolledInterface('batt_volt', args.status_update_rate),
+                                              polling.PolledInterface('charge_status', args.status_update_rate)])
+        for spec in args.poll:
+            iface, period = spec.split(':')
+            self._poller.register(polling.PolledInterface(iface, float(period)))
+
+        # Unchanged writes are suppressed.  Motor commands are refreshed so that the microcontroller's watchdog doesn't stop the robot.
+        self._writes = coalesce.WriteCoalescer(keepalive={'motor': args.motor_keepalive})
+
+        # Status is published when it changes (beyond the deadbands) and otherwise at the heartbeat
+        deadband = {field: float(value) for field, value in (x.split(':') for x in args.deadband)}
+        self._status_publisher = status.StatusPublisher(put, self._status_link, heartbeat=args.status_heartbeat, deadband=deadband)
+
+        # Serialization and network writes happen in a sender thread.  If it falls behind, only the newest status and metrics are published.
+        self._publisher = publisher.BackgroundPublisher()
+        self._publisher.register('status', self._status_publisher.update)
+        self._publisher.register('metrics', self._publish_metrics)
+
+        # Initialize times for various activities
+        self._print_time = time.monotonic()
+        self._metrics_time = time.monotonic()
+
+        # The loop slows down while no commands arrive, to save CPU and battery.  CPU time is accounted to the mode it was spent in.
+        self._idle = False
+        self._last_input_time = time.monotonic()
+        self._mode_cpu = {'active': 0, 'idle': 0}
+        self._mode_time = {'active': 0, 'idle': 0}
+        self._mode_mark = (time.process_time(), time.monotonic())
+
+        # Initialize data
+        self.status_data = {'batt_volt': -1, 'charge_status': False}
+        self._last_input_msg = {}
+
+        # Serial requests that have been submitted, along with their handlers, in submission order
+        self._in_flight = collections.deque()
+
+    def on_input(self, payload):
+        """Receives a raw input message from the matlab_api link.  Called from the node's thread.
 
-        self.iface.append(iface)
-        self.request.append('write')
-        self.body.append(body)
+        Args:
+            payload (bytes): The raw input message.
 
-        return self
+        """
+        if(self._recorder is not None):
+            self._recorder.record(recording.INPUT, payload)
 
-    def add_read_request(self, iface):
-        """Adds a read to the request.
+        self.inputs.put(payload)
+
+    def on_broadcast(self, payload):
+        """Receives a raw message from the broadcast link.  Called from the node's thread.
 
         Args:
-            iface (str): Interface from which to read.
+            payload (bytes): The raw broadcast message.
 
-        Returns:
-            The request with the added read.
+        """
+        if(self._recorder is not None):
+            # Only this robot's command is recorded, in the matlab_api format, so the recording replays like any other
+            try:
+                command = self._extractor.extract(payload)
+                if(command is not None):
+                    self._recorder.record(recording.INPUT, command)
+            except ValueError:
+                pass
+
+        self.broadcast_inputs.put(payload)
+
+    def _record_response(self, future):
+        if(not future.cancelled() and future.exception() is None):
+            self._recorder.record(recording.SERIAL_RESPONSE, future.result())
+
+    def cycle(self, start_time):
+        """Runs one cycle of the control loop.
+
+        Args:
+            start_time (float): The monotonic time at which the cycle started (e.g., its deadline).
 
         """
+        phases = self._phases
+        writes = self._writes
+        phases.start()
 
-        self.iface.append(iface)
-        self.request.append('read')
-        self.body.append({})
+        # Process input commands
+        try:
+            input_msg = self.inputs.take()
+        except Exception as e:
+            logger.warning('Got malformed JSON motor message.')
+            logger.warning(e)
+            # Set this to None for the next checks
+            input_msg = None
+        received_time = self.inputs.received_time
+        input_link = 'matlab_api'
+
+        if(self.broadcast_inputs is not None):
+            try:
+                broadcast_msg = self.broadcast_inputs.take()
+            except Exception as e:
+                logger.warning('Got malformed broadcast message.')
+                logger.warning(e)
+                broadcast_msg = None
+
+            # Act on whichever command arrived last
+            if(broadcast_msg is not None and (input_msg is None or self.broadcast_inputs.received_time > received_time)):
+                input_msg = broadcast_msg
+                received_time = self.broadcast_inputs.received_time
+                input_link = 'broadcast'
+
+        # Drop commands that are too old to act on
+        if(isinstance(input_msg, dict) and not self._tracer.accept(input_msg, received_time, link=input_link)):
+            logger.warning('Rejected stale command ({})'.format(input_msg))
+            input_msg = None
+
+        if(self._first_command and input_msg is not None):
+            self._first_command = False
+            if(self._started_at is not None):
+                elapsed = time.monotonic() - self._started_at
+                self.metrics.set_gauge('time_to_first_command', elapsed)
+                logger.info('First command {:.3f} s after startup began.'.format(elapsed))
+
+        # Return to the full rate on the first new command, and slow down once none have come for a while
+        if(input_msg is not None):
+            self._last_input_time = start_time
+            if(received_time is not None):
+                self.metrics.observe('wake_latency_idle' if self._idle else 'wake_latency_active', max(0, time.monotonic() - received_time))
+            if(self._idle):
+                self._set_idle(False)
+        elif(not self._idle and self._args.idle_after > 0 and (start_time - self._last_input_time) >= self._args.idle_after):
+            self._set_idle(True)
 
-        return self
+        phases.lap('input')
 
-    def to_json_encodable(self):
-        """Turns the request into a JSON-encodable dict.
+        # Serial requests
+        request = Request()
+        handlers = []
 
-        Raises:
-            Exception: If an underlying body element is not JSON-encodable.
+        # Retrieve status data (e.g., battery voltage and charging status) that is due this cycle
+        self._poller.add_due(request, handlers, start_time)
 
-        Returns:
-            dict: A JSON-encodable dict representing the request.
+        # If we got a valid JSON input msg, look for appropriate commands
+        command_written = False
+        if(input_msg is not None):
+            self._last_input_msg = input_msg
+            if('v' in input_msg and 'w' in input_msg):
+                # Handle response?
+                command_written |= writes.add_write(request, handlers, 'motor', {'v': input_msg['v'], 'w': input_msg['w']}, handle_write_response,
+                                                    start_time)
 
-        """
+            if('left_led' in input_msg):
+                command_written |= writes.add_write(request, handlers, 'left_led', {'rgb': input_msg['left_led']}, handle_write_response, start_time)
 
-        req = {'request': self.request, 'iface': self.iface}
+            if('right_led' in input_msg):
+                command_written |= writes.add_write(request, handlers, 'right_led', {'rgb': input_msg['right_led']}, handle_write_response,
+                                                    start_time)
 
-        if(self.body):
-            req['body'] = self.body
+        msg = request.to_json_encodable()
+        phases.lap('request_build')
 
-        return req
+        # Write to serial port.  Unless the serial connection is pipelined, the request has completed by the time submit returns.
+        if(len(handlers) > 0):
+            if(self._recorder is not None):
+                self._recorder.record(recording.SERIAL_REQUEST, msg)
 
+            try:
+                future = self._serial.submit(msg)
+                self._in_flight.append((future, handlers))
+                if(command_written):
+                    self._tracer.written(future)
+                if(self._recorder is not None):
+                    future.add_done_callback(self._record_response)
+            except Exception as e:
+                logger.critical('Serial exception.')
+                logger.critical(e)
+                # The writes may not have made it, so don't suppress them next time
+                writes.invalidate()
 
-def handle_write_response(status, body):
-    return {}
+        phases.lap('serial')
 
+        # Call handlers for whichever requests have completed, in order
+        in_flight = self._in_flight
+        while(in_flight and in_flight[0][0].done()):
+            future, request_handlers = in_flight.popleft()
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.critical('Serial exception.')
+                logger.critical(e)
+                writes.invalidate()
+                continue
 
-def handle_read_response(iface, status, body):
+            if(response is None):
+                writes.invalidate()
 
-    if(iface in body):
-        return {iface: body[iface]}
-    else:
-        logger.critical('Request for ({0}) not in body ({1}) after request.'.format(iface, body))
-        return {}
+            self.status_data.update(handle_response(response, request_handlers))
 
+        phases.lap('response')
 
-def main():
+        self._publisher.offer('status', dict(self.status_data), start_time)
+        phases.lap('publish')
+        phases.total('cycle')
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("mac_list", help="JSON file containing MAC to id mapping")
-    parser.add_argument("-port", type=int, help="MQTT Port", default=8080)
-    parser.add_argument("-host", help="MQTT Host IP", default="localhost")
-    parser.add_argument('-update_rate', type=float, help='Update rate for robot main loop', default=0.016)
-    parser.add_argument('-status_update_rate', type=float, help='How often to check status info', default=1)
+        # Publish loop metrics
+        if((start_time - self._metrics_time) >= self._args.metrics_period):
+            self._publisher.offer('metrics')
+            self._metrics_time = start_time
 
-    # Retrieve the MAC address for the robot
-    mac_address = get_mac()
+        # Print out status data
+        if((start_time - self._print_time) >= self._args.status_update_rate):
+            logger.info('Status data ({})'.format(self.status_data))
+            logger.info('Last input message received ({})'.format(self._last_input_msg))
+            logger.info('Input messages ({})'.format(self.inputs.stats()))
+            if(self.broadcast_inputs is not None):
+                logger.info('Broadcast messages ({})'.format(self.broadcast_inputs.stats()))
+            logger.info('Commands ({})'.format(self._tracer.stats()))
+            logger.info('Loop timing ({})'.format(self.loop_scheduler.stats()))
+            logger.info('Modes ({})'.format(self._mode_stats()))
+            logger.info('Serial writes ({})'.format(writes.stats()))
+            logger.info('Status publishes ({})'.format(self._status_publisher.stats()))
+            logger.info('Publishing ({})'.format(self._publisher.stats()))
+            if(self._logs is not None):
+                logger.info('Logging ({})'.format(self._logs.stats()))
+            if(self._recorder is not None):
+                logger.info('Recording ({})'.format(self._recorder.stats()))
+            self.loop_scheduler.reset_stats()
+            self._print_time = start_time
+
+    def _account_mode(self):
+        """Adds the CPU and wall time since the last update to the totals of the current mode."""
+        cpu, now = time.process_time(), time.monotonic()
+        mode = 'idle' if self._idle else 'active'
+        self._mode_cpu[mode] += cpu - self._mode_mark[0]
+        self._mode_time[mode] += now - self._mode_mark[1]
+        self._mode_mark = (cpu, now)
+
+        self.metrics.set_gauge('cpu_' + mode, self._mode_cpu[mode])
+        self.metrics.set_gauge('time_' + mode, self._mode_time[mode])
+
+    def _set_idle(self, idle):
+        """Switches the loop between the full rate and the idle rate."""
+        self._account_mode()
+        self._idle = idle
+        self.loop_scheduler.set_period(self._args.idle_update_rate if idle else self._args.update_rate)
+        logger.info('Loop is {0}, running every {1} s.'.format('idle' if idle else 'active', self.loop_scheduler.period))
+
+    def _mode_stats(self):
+        """Returns, for each mode, the time spent in it, the CPU usage of the process (in percent) and the p99 wake-up latency of commands."""
+        self._account_mode()
+        result = {}
+        for mode in ('active', 'idle'):
+            result[mode] = {
+                'time': round(self._mode_time[mode], 3),
+                'cpu_pct': round(100 * self._mode_cpu[mode] / self._mode_time[mode], 2) if self._mode_time[mode] > 0 else 0,
+                'wake_latency_p99': self.metrics.histogram('wake_latency_' + mode).merged().percentile(99),
+            }
+
+        return result
+
+    def _publish_metrics(self):
+        """Publishes the loop metrics and writes the metrics file.  Runs in the sender thread."""
+        self._put(self._metrics_link, self.metrics.to_json())
+        if(self._args.metrics_file is not None):
+            try:
+                self.metrics.write_prometheus(self._args.metrics_file, labels=self._metrics_labels)
+            except Exception as e:
+                logger.warning('Could not write metrics file ({})'.format(self._args.metrics_file))
+                logger.warning(repr(e))
 
-    # Parser and set CLI arguments
-    args = parser.parse_args()
-    update_rate = args.update_rate
-    status_update_rate = args.status_update_rate
+    def run(self):
+        """Runs the control loop until stopped, then publishes what is left, stops the sender thread and writes the rest of the recording."""
+        try:
+            while(self._running):
+                self.cycle(self.loop_scheduler.wait(self._wake))
+        finally:
+            self._publisher.stop()
+            if(self._recorder is not None):
+                self._recorder.stop()
+
+    def stop(self):
+        """Stops the control loop after the current cycle."""
+        self._running = False
+
+
+def retry(action, description, retry_min=gritsbotserial.RETRY_MIN, retry_max=gritsbotserial.RETRY_MAX):
+    """Calls an action until it succeeds, backing off exponentially between failed attempts.
+
+    Args:
+        action (function): The action.  Raises an exception if it fails.
+        description (str): What the action does, for the logs (e.g., 'start robot node').
+        retry_min (float, optional): Delay after the first failure in seconds.
+        retry_max (float, optional): Longest delay between attempts in seconds.
+
+    Returns:
+        The result of the action.
+
+    """
+
+    delay = retry_min
+    while True:
+        try:
+            return action()
+        except Exception as e:
+            logger.critical('Could not {}.'.format(description))
+            logger.critical(repr(e))
+
+        time.sleep(delay)
+        delay = min(2*delay, retry_max)
+
+
+def start_node(args, node_descriptor):
+    """Starts the robot's node, retrying until it connects.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments (see create_parser).
+        node_descriptor (dict): The robot's node descriptor.
+
+    Returns:
+        vizier.node.Node: The started node.
+
+    """
+
+    # Imported here, since the MQTT client takes a while to import and isn't needed until now
+    import vizier.node as node
+
+    def attempt():
+        robot_node = node.Node(args.host, args.port, node_descriptor)
+        try:
+            robot_node.start()
+        except Exception:
+            robot_node.stop()
+            raise
+        return robot_node
+
+    return retry(attempt, 'start robot node')
+
+
+def start_serial(args, loop_metrics):
+    """Acquires the serial device, retrying until it is found.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments (see create_parser).
+        loop_metrics (metrics.Metrics): Where the serial connection records its timing.
+
+    Returns:
+        gritsbotserial.GritsbotSerial: The started serial connection.
+
+    """
+
+    codecs = [gritsbotserial.JsonCodec()]
+    if(args.codec == 'binary'):
+        codecs.insert(0, gritsbotserial.BinaryCodec())
+
+    def attempt():
+        serial = gritsbotserial.GritsbotSerial(serial_dev=args.serial_dev, baud_rate=500000, pipelined=args.pipelined, codecs=codecs,
+                                               vid=args.vid, pid=args.pid, serial_number=args.serial_number, metrics=loop_metrics)
+        # This class stops itself if the device cannot be initially acquired, so we don't need to stop it.
+        serial.start()
+        return serial
+
+    return retry(attempt, 'acquire serial device')
+
+
+def bring_up(args, mac_address, logs=None, started_at=None):
+    """Brings up the robot: looks up its ID, starts its node, acquires the serial device and creates its control loop.
+
+    The node and the serial device are brought up at the same time, each retrying with backoff, so startup takes as long as the slower of the two.
+    How long each phase took is logged and kept as gauges in the loop metrics.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments (see create_parser).
+        mac_address (str): The MAC address of the robot (e.g., from get_mac), which is looked up in the MAC list.
+        logs (nonblocking_log.NonBlockingLogging, optional): Background logging, whose stats are logged.
+        started_at (float, optional): Monotonic time at which startup began.  Defaults to now.
+
+    Raises:
+        ValueError: If the MAC address is not in the MAC list.
+
+    Returns:
+        tuple: The robot's node, serial connection and Controller, which is subscribed to the robot's input link but not yet running.
+
+    Examples:
+        >>> robot_node, serial, controller = bring_up(parse_args(), get_mac())
+        >>> controller.run()
+
+    """
+
+    started_at = time.monotonic() if started_at is None else started_at
 
     # Retrieve the MAC list file, containing a mapping from MAC address to robot ID
     try:
@@ -200,143 +694,74 @@ def main():
     logger.info('This is robot: ({0}) with MAC address: ({1})'.format(robot_id, mac_address))
 
     # Create node descriptor for robot and set up links
-    node_descriptor = create_node_descriptor(mac_list[mac_address])
-    status_link = robot_id + '/status'
+    node_descriptor = create_node_descriptor(mac_list[mac_address], broadcast_link=args.broadcast_link)
     input_link = 'matlab_api/' + robot_id
 
-    started = False
-    robot_node = None
-    while (not started):
-        robot_node = node.Node(args.host, args.port, node_descriptor)
-        try:
-            robot_node.start()
-            started = True
-        except Exception as e:
-            logger.critical('Could not start robot node.')
-            logger.critical(repr(e))
-            robot_node.stop()
-
-        # Don't try to make nodes too quickly
-        time.sleep(1)
-
-    logger.info('Started robot node.')
-
-    started = False
-    serial = None
-    while (not started):
-        serial = gritsbotserial.GritsbotSerial(serial_dev='/dev/ttyACM0', baud_rate=500000)
-        try:
-            serial.start()
-            started = True
-        except Exception as e:
-            # This class stops itself if the device cannot be initially acquired, so we don't need to stop it.
-            logger.critical('Could not acquire serial device.')
-            logger.critical(repr(e))
+    # Time spent in each phase of the control loop (and on the serial line), over a rolling window
+    loop_metrics = metrics.Metrics()
+    startup = {}
 
-        # Don't try to acquire the serial device too quickly
-        time.sleep(1)
+    def timed(phase, action, *action_args):
+        result = action(*action_args)
+        startup[phase] = time.monotonic() - started_at
+        return result
 
-    logger.info('Acquired serial device.')
+    # Start the node in the background while acquiring the serial device
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        node_future = executor.submit(timed, 'startup_node', start_node, args, node_descriptor)
+        serial = timed('startup_serial', start_serial, args, loop_metrics)
+        logger.info('Acquired serial device.')
+        robot_node = node_future.result()
+        logger.info('Started robot node.')
 
-    # Queues for STREAM links
-    inputs = robot_node.subscribe(input_link)
+    # Record inputs and serial traffic, to reproduce problems offline
+    recorder = None
+    if(args.record is not None):
+        recorder = recording.Recorder(args.record, size=args.record_size)
 
-    # Initialize times for various activities
-    start_time = time.time()
-    print_time = time.time()
-    status_update_time = time.time()
-
-    # Initialize data
-    status_data = {'batt_volt': -1, 'charge_status': False}
-    last_input_msg = {}
-
-    # Main loop for the robot
-    while True:
-        start_time = time.time()
-
-        # Serial requests
-        request = Request()
-        handlers = []
+    controller = Controller(serial, robot_node.put, robot_id, args, loop_metrics, recorder=recorder, logs=logs, started_at=started_at)
+    robot_node.subscribe_with_callback(input_link, controller.on_input)
+    if(args.broadcast_link is not None):
+        robot_node.subscribe_with_callback(args.broadcast_link, controller.on_broadcast)
 
-        # Retrieve status data: battery voltage and charging status
-        if((start_time - status_update_time) >= status_update_rate):
-            request.add_read_request('batt_volt').add_read_request('charge_status')
-            handlers.append(lambda status, body: handle_read_response('batt_volt', status, body))
-            handlers.append(lambda status, body: handle_read_response('charge_status', status, body))
+    startup['startup_total'] = time.monotonic() - started_at
+    for phase, duration in startup.items():
+        loop_metrics.set_gauge(phase, duration)
+    logger.info('Startup took ({})'.format(', '.join('{0} {1:.3f} s'.format(k, v) for k, v in sorted(startup.items()))))
 
-            status_update_time = start_time
+    return robot_node, serial, controller
 
-        # Process input commands
-        input_msg = None
-        # Make sure that the queue has few enough messages
-        if(inputs.qsize() > MAX_QUEUE_SIZE):
-            logger.critical('Queue of motor messages is too large.')
 
-        try:
-            # Clear out the queue
-            while True:
-                input_msg = inputs.get_nowait()
-        except queue.Empty:
-            pass
+def main():
 
-        if(input_msg is not None):
-            try:
-                input_msg = json.loads(input_msg.decode(encoding='UTF-8'))
-            except Exception as e:
-                logger.warning('Got malformed JSON motor message ({})'.format(input_msg))
-                logger.warning(e)
-                # Set this to None for the next checks
-                input_msg = None
+    started_at = time.monotonic()
 
-        # If we got a valid JSON input msg, look for appropriate commands
-        if(input_msg is not None):
-            last_input_msg = input_msg
-            if('v' in input_msg and 'w' in input_msg):
-                # Handle response?
-                request.add_write_request('motor', {'v': input_msg['v'], 'w': input_msg['w']})
-                handlers.append(handle_write_response)
+    # Vizier, like netifaces (get_mac) and vizier.node (start_node), is only imported by the robot itself, not by replays or load tests
+    import vizier.log as log
+    global logger
+    logger = log.get_logger()
 
-            if('left_led' in input_msg):
-                request.add_write_request('left_led', {'rgb': input_msg['left_led']})
-                handlers.append(handle_write_response)
+    # Retrieve the MAC address for the robot
+    mac_address = get_mac()
 
-            if('right_led' in input_msg):
-                request.add_write_request('right_led', {'rgb': input_msg['right_led']})
-                handlers.append(handle_write_response)
+    # Parser and set CLI arguments
+    args = parse_args()
 
-        # Write to serial port
-        response = None
-        if(len(handlers) > 0):
-            try:
-                response = serial.serial_request(request.to_json_encodable())
-            except Exception as e:
-                logger.critical('Serial exception.')
-                logger.critical(e)
+    # Write logs from a background thread, so that logging (e.g., a warning every cycle during a serial fault) doesn't stall the main loop
+    logs = nonblocking_log.NonBlockingLogging([logging.getLogger(), logging.getLogger('root'), logger], interval=args.log_interval)
 
-        # Call handlers
-        # We'll have a status and body for each request
-        if(response is not None and 'status' in response and 'body' in response
-           and len(response['status']) == len(handlers) and len(response['body']) == len(handlers)):
-            status = response['status']
-            body = response['body']
-            # Ensure the appropriate handler gets each response
-            for i, handler in enumerate(handlers):
-                status_data.update(handler(status[i], body[i]))
-        else:
-            # If we should have responses, but we don't
-            if(len(handlers) > 0):
-                logger.critical('Malformed response ({})'.format(response))
-
-        robot_node.put(status_link, json.dumps(status_data))
+    robot_node, serial, controller = bring_up(args, mac_address, logs=logs, started_at=started_at)
 
-        # Print out status data
-        if((start_time - print_time) >= status_update_rate):
-            logger.info('Status data ({})'.format(status_data))
-            logger.info('Last input message received ({})'.format(last_input_msg))
-            print_time = time.time()
+    # Stop after the current cycle on SIGTERM (e.g., from systemd), as on Ctrl-C, so that the end of the recording and the logs are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: controller.stop())
 
-        # Sleep for whatever time is left at the end of the loop
-        time.sleep(max(0, update_rate - (time.time() - start_time)))
+    # Main loop for the robot
+    try:
+        controller.run()
+    finally:
+        serial.stop()
+        robot_node.stop()
+        logs.stop()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,13 @@
+import gritsbot.utils.detect_serial as detect_serial
 import serial
 import json
 import logging
 import threading
 import time
+import collections
+import concurrent.futures
+import os
+import struct
 
 global logger
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
@@ -11,6 +16,18 @@ logger.setLevel(logging.DEBUG)
 
 # Constants
 MAX_IN_WAITING = 500
+MAX_FRAME_SIZE = 1024
+SEQ_MODULUS = 65536
+NEGOTIATION_TIMEOUT = 0.5
+PIPELINE_READ_TIMEOUT = 0.01
+RETRY_MIN = 0.05
+RETRY_MAX = 1
+
+# Binary codec framing: magic byte, little-endian payload length, payload, and an 8-bit checksum (sum of the payload bytes)
+BINARY_MAGIC = 0xA5
+BINARY_HEADER = struct.Struct('<BH')
+BINARY_WRITE_FLAG = 0x80
+BINARY_SEQ_FLAG = 0x01
 
 
 def _json_to_bytes(message):
@@ -35,6 +52,334 @@ def _bytes_to_json(message):
     return json.loads(message.decode('ASCII'))
 
 
+class FrameBuffer:
+    """Reusable receive buffer that splits incoming serial bytes into complete frames.
+
+    Responses from the microcontroller are JSON objects, so a frame is a balanced top-level ``{...}``.  Any bytes before the opening brace
+    (e.g., line endings) are discarded.  The scan is incremental: bytes are only examined once, no matter how many reads a frame is split across.
+
+    Attributes:
+        _buffer (bytearray): Bytes received but not yet returned as a frame.
+        _scan (int): Index in the buffer up to which bytes have been scanned.
+        _depth (int): Current brace depth of the frame being scanned.
+        _in_string (bool): Whether the scan is inside a JSON string.
+        _escape (bool): Whether the previous byte was a backslash inside a string.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.clear()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def clear(self):
+        """Drops all buffered bytes and resets the scan state."""
+        del self._buffer[:]
+        self._scan = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, data):
+        """Appends received bytes to the buffer.
+
+        Args:
+            data (bytes): Bytes read from the serial port.
+
+        """
+        self._buffer.extend(data)
+
+    def next_frame(self):
+        """Removes and returns the next complete frame from the buffer.
+
+        Returns:
+            bytes: The complete frame, or None if the buffer does not yet hold one.
+
+        """
+        buf = self._buffer
+
+        if(self._depth == 0):
+            # Skip anything preceding the start of a frame
+            start = buf.find(b'{', self._scan)
+            if(start < 0):
+                del buf[:]
+                self._scan = 0
+                return None
+            del buf[:start]
+            self._scan = 0
+
+        i = self._scan
+        n = len(buf)
+        depth = self._depth
+        in_string = self._in_string
+        escape = self._escape
+
+        while(i < n):
+            c = buf[i]
+            i += 1
+            if(in_string):
+                if(escape):
+                    escape = False
+                elif(c == 0x5C):  # backslash
+                    escape = True
+                elif(c == 0x22):  # quote
+                    in_string = False
+            elif(c == 0x22):
+                in_string = True
+            elif(c == 0x7B):  # {
+                depth += 1
+            elif(c == 0x7D):  # }
+                depth -= 1
+                if(depth == 0):
+                    frame = bytes(buf[:i])
+                    del buf[:i]
+                    self._scan = 0
+                    self._depth = 0
+                    self._in_string = False
+                    self._escape = False
+                    return frame
+
+        self._scan = i
+        self._depth = depth
+        self._in_string = in_string
+        self._escape = escape
+        return None
+
+
+class BinaryFrameBuffer:
+    """Reusable receive buffer that splits incoming serial bytes into binary codec frames.
+
+    A frame is the magic byte, a two-byte payload length, the payload, and a checksum byte.  If the checksum does not match, the magic byte is
+    assumed to have been a payload byte and the buffer is rescanned from the next byte.
+
+    Attributes:
+        _buffer (bytearray): Bytes received but not yet returned as a frame.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def clear(self):
+        """Drops all buffered bytes."""
+        del self._buffer[:]
+
+    def feed(self, data):
+        """Appends received bytes to the buffer.
+
+        Args:
+            data (bytes): Bytes read from the serial port.
+
+        """
+        self._buffer.extend(data)
+
+    def next_frame(self):
+        """Removes and returns the payload of the next complete frame in the buffer.
+
+        Returns:
+            bytes: The payload of the frame, or None if the buffer does not yet hold a complete frame.
+
+        """
+        buf = self._buffer
+
+        while True:
+            start = buf.find(BINARY_MAGIC)
+            if(start < 0):
+                del buf[:]
+                return None
+            del buf[:start]
+
+            if(len(buf) < BINARY_HEADER.size):
+                return None
+
+            _, length = BINARY_HEADER.unpack_from(buf)
+            end = BINARY_HEADER.size + length + 1
+
+            if(length > MAX_FRAME_SIZE):
+                del buf[:1]
+                continue
+
+            if(len(buf) < end):
+                return None
+
+            payload = bytes(buf[BINARY_HEADER.size:end - 1])
+            if((sum(payload) & 0xFF) != buf[end - 1]):
+                del buf[:1]
+                continue
+
+            del buf[:end]
+            return payload
+
+
+class JsonCodec:
+    """Encodes requests to and decodes responses from the microcontroller as JSON.
+
+    Every microcontroller understands this codec, so it is the fallback if no other codec can be negotiated.
+
+    """
+
+    name = 'json'
+
+    def encode(self, msg):
+        """Encodes a JSON-encodable request.
+
+        Raises:
+            Exception: If the message cannot be JSON encoded.
+
+        """
+        return _json_to_bytes(msg)
+
+    def decode(self, frame):
+        """Decodes a response frame.
+
+        Raises:
+            Exception: If the frame cannot be JSON decoded.
+
+        """
+        return _bytes_to_json(frame)
+
+    def frame_buffer(self):
+        """Returns a receive buffer that splits bytes into frames of this codec."""
+        return FrameBuffer()
+
+
+class _BinaryInterface:
+    """Describes how the body of one interface is packed by the binary codec.
+
+    Attributes:
+        iface_id (int): Numeric ID of the interface (less than BINARY_WRITE_FLAG).
+        write_format (struct.Struct): Format of a write body, or None if the interface cannot be written.
+        read_format (struct.Struct): Format of a read response body, or None if the interface cannot be read.
+        pack (function): Turns a write body into a tuple for write_format.
+        unpack (function): Turns a tuple from read_format into a read response body.
+
+    """
+
+    def __init__(self, iface_id, write_format=None, read_format=None, pack=None, unpack=None):
+        self.iface_id = iface_id
+        self.write_format = struct.Struct(write_format) if write_format else None
+        self.read_format = struct.Struct(read_format) if read_format else None
+        self.pack = pack
+        self.unpack = unpack
+
+
+def _pack_rgb(body):
+    """Turns an LED write body into bytes, rounding and clamping each channel to 0-255, so that a float or out-of-range colour (which JSON would
+    carry) doesn't fail the whole request."""
+    return tuple(min(max(int(round(x)), 0), 255) for x in body['rgb'])
+
+
+BINARY_INTERFACES = {
+    'motor': _BinaryInterface(1, write_format='<ff', pack=lambda body: (body['v'], body['w'])),
+    'left_led': _BinaryInterface(2, write_format='<BBB', pack=_pack_rgb),
+    'right_led': _BinaryInterface(3, write_format='<BBB', pack=_pack_rgb),
+    # Undo the float32 rounding noise (e.g., 4.1 -> 4.099999904632568), so responses match JSON's
+    'batt_volt': _BinaryInterface(4, read_format='<f', unpack=lambda fields: {'batt_volt': round(fields[0], 6)}),
+    'charge_status': _BinaryInterface(5, read_format='<?', unpack=lambda fields: {'charge_status': fields[0]}),
+}
+
+
+class BinaryCodec:
+    """Encodes requests and responses with numeric interface IDs and packed bodies.
+
+    The payload of a request is a flags byte, an optional sequence number (uint16, if flags has BINARY_SEQ_FLAG set), a count of requests, and then,
+    for each request, a byte holding the interface ID (with BINARY_WRITE_FLAG set for writes) followed by the packed body of a write.  A response has
+    the same layout, except that each entry is the interface byte, a status byte, and the packed body of a read.  Decoded responses have the same
+    form as JSON responses, so callers don't depend on the codec.
+
+    Attributes:
+        _by_id (dict): Maps interface IDs to (name, interface description).
+
+    """
+
+    name = 'binary'
+
+    def __init__(self, interfaces=BINARY_INTERFACES):
+        self._interfaces = interfaces
+        self._by_id = {x.iface_id: (name, x) for name, x in interfaces.items()}
+
+    def encode(self, msg):
+        """Encodes a request of the form produced by Request.to_json_encodable().
+
+        Raises:
+            Exception: If the request contains an interface or body that the binary codec cannot encode.
+
+        """
+        payload = bytearray()
+        seq = msg.get('seq')
+
+        if(seq is None):
+            payload.append(0)
+        else:
+            payload.append(BINARY_SEQ_FLAG)
+            payload.extend(struct.pack('<H', seq))
+
+        requests = msg['request']
+        ifaces = msg['iface']
+        bodies = msg.get('body', [{}]*len(requests))
+        payload.append(len(requests))
+
+        for request, iface, body in zip(requests, ifaces, bodies):
+            desc = self._interfaces.get(iface)
+            if(desc is None):
+                raise ValueError('Interface ({}) is not supported by the binary codec.'.format(iface))
+            if(request == 'write'):
+                payload.append(desc.iface_id | BINARY_WRITE_FLAG)
+                payload.extend(desc.write_format.pack(*desc.pack(body)))
+            else:
+                payload.append(desc.iface_id)
+
+        return BINARY_HEADER.pack(BINARY_MAGIC, len(payload)) + payload + bytes([sum(payload) & 0xFF])
+
+    def decode(self, frame):
+        """Decodes the payload of a response frame into a dict with 'status' and 'body' lists (and 'seq', if present).
+
+        Raises:
+            Exception: If the payload is truncated or contains an unknown interface.
+
+        """
+        flags = frame[0]
+        offset = 1
+        result = {}
+
+        if(flags & BINARY_SEQ_FLAG):
+            result['seq'] = struct.unpack_from('<H', frame, offset)[0]
+            offset += 2
+
+        count = frame[offset]
+        offset += 1
+        status = []
+        body = []
+
+        for _ in range(count):
+            iface_byte, status_byte = frame[offset], frame[offset + 1]
+            offset += 2
+            _, desc = self._by_id[iface_byte & ~BINARY_WRITE_FLAG]
+
+            status.append(status_byte)
+            if(iface_byte & BINARY_WRITE_FLAG):
+                body.append({})
+            else:
+                body.append(desc.unpack(desc.read_format.unpack_from(frame, offset)))
+                offset += desc.read_format.size
+
+        if(offset != len(frame)):
+            raise ValueError('Binary response has ({}) trailing bytes.'.format(len(frame) - offset))
+
+        result['status'] = status
+        result['body'] = body
+        return result
+
+    def frame_buffer(self):
+        """Returns a receive buffer that splits bytes into frames of this codec."""
+        return BinaryFrameBuffer()
+
+
 class GritsbotSerial:
     """Encapsulates serial communications to the microcontroller.
 
@@ -43,34 +388,81 @@ class GritsbotSerial:
 
     This class is made to be robust to errors and will restart the serial device if it encounters an error (e.g., if the cable is un/replugged).
 
+    In pipelined mode, each request is tagged with a sequence number (the 'seq' key) and written immediately by submit(), which returns a future.  A
+    single reader thread matches responses to outstanding requests by the sequence number they echo, so several transactions may be in flight at
+    once.  Whether the microcontroller echoes sequence numbers is checked each time the serial device is (re)acquired.  If it doesn't, responses
+    can't be told apart, so only one request is kept in flight, and the receive buffers are flushed whenever a request times out, so that a late
+    response isn't taken for the next one.
+
+    Requests and responses are encoded by a codec, negotiated each time the serial device is (re)acquired.  The microcontroller is asked which codecs
+    it supports by reading the 'codec' interface (in JSON); the first of the preferred codecs that it reports is used, falling back to JSON.  The
+    microcontroller replies in the encoding of each request, so it keeps no codec state of its own.
+
+    The serial device may be given by path or matched by USB vendor ID, product ID and serial number, in which case the path is looked up on every
+    (re)connection.  The device's directory is watched for devices being added or removed: removal of the device restarts the connection
+    immediately, and a restart is attempted as soon as a device appears.  Otherwise, restarts are attempted immediately and then with exponential
+    backoff (from RETRY_MIN to RETRY_MAX seconds) while they keep failing.
+
     Attributes:
-        _serial_dev (str): Path to the serial device.
+        _serial_dev (str): Path to the serial device (if not matched by USB IDs).
+        _usb_match (dict): USB criteria (vid, pid, serial_number) to match the serial device by.
+        _device_path (str): Path of the currently (or last) opened serial device.
+        _device_added (bool): Whether a device has appeared since the last restart attempt.
+        _watcher (detect_serial.DeviceWatcher): Watches for serial devices being added or removed.
+        _metrics (metrics.Metrics): Records the time spent writing, reading and waiting for responses, if given.
         _baud_rate (int): The baud rate for the serial device.
-        _timeout (int): Timeout for the serial reads in seconds.
+        _timeout (int): Timeout for the serial reads in seconds.  In pipelined mode, the reader thread reads with PIPELINE_READ_TIMEOUT instead,
+            so that it expires outstanding requests on time.
         _serial_cv (threading.Condition): Condition variable for synchronizing class.
         _serial (serial.Serial): The pyserial object for serial communications.
         _serial_task_thread (threading.Thread): Runs the internal restart task.
         _stopped (bool): Whether the class has been stopped.
         _started (bool): Whether the class has been started.
         _needs_restart (bool): Whether the serial device should be restarted.
+        _frames (FrameBuffer): Receive buffer holding bytes read from the serial device.
+        _pipelined (bool): Whether requests are pipelined through the reader thread.
+        _max_in_flight (int): Maximum number of outstanding requests in pipelined mode.
+        _pending (collections.OrderedDict): Outstanding requests in write order, mapping sequence number to (future, deadline, write time).
+        _next_seq (int): Sequence number for the next request.
+        _seq_echo (bool): Whether the microcontroller echoes sequence numbers, so that several requests may be in flight.
+        _reader_thread (threading.Thread): Reads and dispatches responses in pipelined mode.
+        _codecs (list): Preferred codecs, in order of preference.
+        _codec: The codec negotiated with the microcontroller.
 
     """
 
-    def __init__(self, serial_dev='/dev/ttyACM0', baud_rate=500000, timeout=2):
+    def __init__(self, serial_dev='/dev/ttyACM0', baud_rate=500000, timeout=2, pipelined=False, max_in_flight=4, codecs=None,
+                 vid=None, pid=None, serial_number=None, watch=True, metrics=None):
         """Creates the serial communciations object.
 
         Args:
             serial_dev (str, optional): The path to the serial device.
             baud_rate (int): Baud rate for the serial device.
             timeout (int): Timeout for the serial read.
+            pipelined (bool, optional): Whether to allow several requests in flight at once.
+            max_in_flight (int, optional): Maximum number of outstanding requests in pipelined mode.
+            codecs (list, optional): Codecs to negotiate, in order of preference.  Defaults to JSON only.
+            vid (int, optional): USB vendor ID to match the serial device by, instead of serial_dev.
+            pid (int, optional): USB product ID to match the serial device by, instead of serial_dev.
+            serial_number (str, optional): USB serial number to match the serial device by, instead of serial_dev.
+            watch (bool, optional): Whether to watch for the serial device being added or removed.
+            metrics (metrics.Metrics, optional): Records serial_write, serial_read and serial_roundtrip times.
 
         Examples:
             >>> GritsbotSerial(serial_dev='/dev/ttyACM0', baud_rate=115200, timeout=5)
+            >>> GritsbotSerial(codecs=[BinaryCodec(), JsonCodec()])
+            >>> GritsbotSerial(vid=0x16c0, pid=0x0483, serial_number='1234')
 
         """
         self._serial_dev = serial_dev
         self._baud_rate = baud_rate
         self._timeout = timeout
+        self._usb_match = None
+        if(vid is not None or pid is not None or serial_number is not None):
+            self._usb_match = {'vid': vid, 'pid': pid, 'serial_number': serial_number}
+        self._watch = watch
+        self._watcher = None
+        self._metrics = metrics
 
         # Serial-related attributes.  ALL OF THESE SHOULD BE CONTROLLED WHILE HOLDING THE LOCK
         self._serial_cv = threading.Condition()
@@ -79,10 +471,32 @@ class GritsbotSerial:
         self._stopped = False
         self._started = False
         self._needs_restart = True
+        self._device_path = serial_dev
+        self._device_added = False
+        self._codecs = list(codecs) if codecs else [JsonCodec()]
+        self._codec = JsonCodec()
+        self._frames = self._codec.frame_buffer()
+
+        # Pipelining-related attributes.  Also controlled by the lock
+        self._pipelined = pipelined
+        self._max_in_flight = max_in_flight
+        self._pending = collections.OrderedDict()
+        self._next_seq = 0
+        self._seq_echo = False
+        self._reader_thread = None
+
+        # Counters for benchmarking and monitoring.  Also controlled by the lock
+        self._requests = 0
+        self._bytes_written = 0
+        self._bytes_read = 0
+        self._rejected = 0
 
     def serial_request(self, msg, timeout=5):
         """Makes a request on a serial line
 
+        The response is read incrementally into the receive buffer until exactly one complete frame is available.  Any bytes
+        following that frame are kept for the next request.
+
         Args:
             msg: A JSON-encodable (by json.dumps) object
 
@@ -96,6 +510,26 @@ class GritsbotSerial:
         Examples:
             >>> response = GritsbotSerial.serial_request(request, timeout=1)
 
+        """
+        if(self._pipelined):
+            future = self.submit(msg, timeout=timeout)
+            try:
+                return future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                error_msg = 'Serial request timed out.'
+                logger.critical(error_msg)
+                raise RuntimeError(error_msg)
+
+        return self._request(msg, timeout)
+
+    def _request(self, msg, timeout, future=None):
+        """Makes a request synchronously, as for serial_request when not pipelined.
+
+        Args:
+            msg: A JSON-encodable (by json.dumps) object
+            timeout (float): Time to wait for the serial device.
+            future (concurrent.futures.Future, optional): Future for the request, whose write_time is set just before the request is written.
+
         """
         with self._serial_cv:
             if(not self._started):
@@ -116,10 +550,15 @@ class GritsbotSerial:
                     logger.critical(error_msg)
                     raise RuntimeError(error_msg)
 
-            msg = _json_to_bytes(msg)
+            msg = self._codec.encode(msg)
 
+            if(future is not None):
+                future.write_time = time.monotonic()
+            write_start = time.perf_counter()
             try:
                 self._serial.write(msg)
+                self._requests += 1
+                self._bytes_written += len(msg)
             except Exception as e:
                 error_msg = 'Unable to write to the serial port.'
                 logger.critical(error_msg)
@@ -130,32 +569,263 @@ class GritsbotSerial:
                 self._serial_cv.notify_all()
                 raise RuntimeError(error_msg)
 
-            # Read to wait for bytes to be available
+            read_start = time.perf_counter()
+            frame = self._read_frame()
+
+            if(self._metrics is not None):
+                read_end = time.perf_counter()
+                self._metrics.observe('serial_write', read_start - write_start)
+                self._metrics.observe('serial_read', read_end - read_start)
+                self._metrics.observe('serial_roundtrip', read_end - write_start)
+
+            result = None
+            try:
+                result = self._codec.decode(frame)
+            except Exception as e:
+                logger.warning('Unable to parse message from serial port')
+                logger.warning(repr(e))
+
+            return result
+
+    def submit(self, msg, timeout=5):
+        """Submits a request on the serial line without waiting for the response.
+
+        If the class was not created in pipelined mode, the request is made synchronously and the returned future is already done.  Either way, the
+        future's write_time is the time.monotonic() time at which the request was written to the serial port (or None, if it never was), so the
+        write and the wait for the response can be timed separately.
+
+        Args:
+            msg: A JSON-encodable (by json.dumps) object
+            timeout (float, optional): Time to wait for the response (and, if not pipelined, for the serial device).
+
+        In pipelined mode, submit never waits: if the serial device is being restarted or max_in_flight requests are outstanding, it raises right
+        away, so the caller can carry on and try again later.
+
+        Raises:
+            RuntimeError: If the serial port has not been initialized; if the serial port cannot be written to; if the serial device is being
+            restarted; if too many requests are in flight.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the response dict (or None, if the response could not be parsed).  Fails with RuntimeError if the
+            response does not arrive within timeout or the serial device is restarted.
+
+        Examples:
+            >>> future = GritsbotSerial.submit(request, timeout=1)
+            >>> response = future.result()
+
+        """
+        future = concurrent.futures.Future()
+        future.write_time = None
+
+        if(not self._pipelined):
+            try:
+                future.set_result(self._request(msg, timeout, future))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self._serial_cv:
+            if(not self._started):
+                error_msg = 'Serial connection must be started prior to calling this method.'
+                logger.critical(error_msg)
+                raise RuntimeError(error_msg)
+
+            if(self._stopped):
+                error_msg = 'Serial connection stopped!  Cannot use anymore.'
+                logger.critical(error_msg)
+                raise RuntimeError(error_msg)
+
+            # Don't wait for the serial device or for room in the pipeline, so that the caller never blocks on the wire
+            if(self._needs_restart):
+                self._rejected += 1
+                raise RuntimeError('Serial device is being restarted.')
+
+            if(len(self._pending) >= (self._max_in_flight if self._seq_echo else 1)):
+                self._rejected += 1
+                raise RuntimeError('Too many serial requests in flight ({}).'.format(len(self._pending)))
+
+            seq = self._next_seq
+            self._next_seq = (seq + 1) % SEQ_MODULUS
+
+            tagged = dict(msg)
+            tagged['seq'] = seq
+            data = self._codec.encode(tagged)
+
+            future.write_time = time.monotonic()
+            write_start = time.perf_counter()
             try:
-                msg = self._serial.read()
+                self._serial.write(data)
+                self._requests += 1
+                self._bytes_written += len(data)
+                if(self._metrics is not None):
+                    self._metrics.observe('serial_write', time.perf_counter() - write_start)
             except Exception as e:
-                error_msg = 'Unable to read from serial port'
+                error_msg = 'Unable to write to the serial port.'
                 logger.critical(error_msg)
                 logger.critical(repr(e))
 
-                # Signal the serial_task thread that the serial device should be restarted
-                self._needs_restart = True
-                self._serial_cv.notify_all()
+                self._restart_pipeline(error_msg)
                 raise RuntimeError(error_msg)
 
-            if(self._serial.in_waiting > MAX_IN_WAITING):
-                error_msg = 'Too many incoming bytes waiting on serial port ({})'.format(self._serial.in_waiting)
-                logger.warning(error_msg)
+            self._pending[seq] = (future, time.monotonic() + timeout, write_start)
 
-                # Signal the serial_task thread that the serial device should be restarted
-                self._needs_restart = True
-                self._serial_cv.notify_all()
-                raise RuntimeError(error_msg)
+        return future
+
+    def _restart_pipeline(self, error_msg):
+        """Fails all outstanding requests and signals that the serial device should be restarted.
+
+        Must be called while holding the lock.
+
+        Args:
+            error_msg (str): Message for the RuntimeError given to each outstanding future.
+
+        """
+        while(self._pending):
+            _, (future, _, _) = self._pending.popitem(last=False)
+            future.set_exception(RuntimeError(error_msg))
+
+        self._needs_restart = True
+        self._serial_cv.notify_all()
+
+    def _dispatch_frame(self, frame):
+        """Resolves the outstanding request that a response frame belongs to.
+
+        Must be called while holding the lock.
+
+        Args:
+            frame (bytes): A complete response frame.
+
+        """
+        result = None
+        try:
+            result = self._codec.decode(frame)
+        except Exception as e:
+            logger.warning('Unable to parse message from serial port')
+            logger.warning(repr(e))
+
+        seq = result.get('seq') if isinstance(result, dict) else None
+        if(seq is not None or self._seq_echo):
+            if(seq not in self._pending):
+                # E.g., the response to a request that already timed out
+                logger.warning('Received a response with no outstanding request ({})'.format(frame))
+                return
+            future, _, submitted = self._pending.pop(seq)
+        elif(self._pending):
+            # Without sequence numbers, only one request is in flight, so this is its response
+            _, (future, _, submitted) = self._pending.popitem(last=False)
+        else:
+            logger.warning('Received a response with no outstanding request ({})'.format(frame))
+            return
+
+        if(self._metrics is not None):
+            self._metrics.observe('serial_roundtrip', time.perf_counter() - submitted)
+
+        future.set_result(result)
+        self._serial_cv.notify_all()
+
+    def _expire_pending(self):
+        """Fails outstanding requests whose deadlines have passed.
+
+        Must be called while holding the lock.
+
+        """
+        now = time.monotonic()
+        expired = [seq for seq, (_, deadline, _) in self._pending.items() if deadline <= now]
+
+        for seq in expired:
+            future, _, _ = self._pending.pop(seq)
+            future.set_exception(RuntimeError('Serial request ({}) timed out.'.format(seq)))
+
+        if(expired):
+            if(not self._seq_echo):
+                # A late response couldn't be told apart from the next one, so drop whatever has arrived for the expired request
+                self._frames.clear()
+                try:
+                    self._serial.reset_input_buffer()
+                except Exception as e:
+                    logger.warning('Unable to flush the serial input buffer.')
+                    logger.warning(repr(e))
+            self._serial_cv.notify_all()
+
+    def _reader_task(self):
+        """Reads responses and dispatches them to outstanding requests in pipelined mode.
+
+        Only meant to be run by the internal thread!  Reads happen outside of the lock, so that submit() never waits on the wire.
+
+        """
+        while True:
+            with self._serial_cv:
+                while(self._needs_restart and not self._stopped):
+                    self._serial_cv.wait()
+
+                if(self._stopped):
+                    break
+
+                ser = self._serial
+                self._expire_pending()
 
-            # Once bytes are available, read the rest in.  We assume that the entire message is on
-            # the line
             try:
-                msg += self._serial.read(self._serial.in_waiting)
+                data = ser.read(max(1, ser.in_waiting))
+            except Exception as e:
+                with self._serial_cv:
+                    # If the device was restarted or stopped while reading, the error is expected
+                    if(ser is self._serial and not self._stopped):
+                        error_msg = 'Unable to read from the serial port.'
+                        logger.critical(error_msg)
+                        logger.critical(repr(e))
+                        self._restart_pipeline(error_msg)
+                continue
+
+            with self._serial_cv:
+                if(ser is not self._serial):
+                    continue
+
+                self._bytes_read += len(data)
+                self._frames.feed(data)
+                frame = self._frames.next_frame()
+                while(frame is not None):
+                    self._dispatch_frame(frame)
+                    frame = self._frames.next_frame()
+
+                if(len(self._frames) > MAX_FRAME_SIZE):
+                    error_msg = 'Receive buffer exceeded maximum frame size ({})'.format(len(self._frames))
+                    logger.warning(error_msg)
+                    self._restart_pipeline(error_msg)
+
+    def _read_frame(self, timeout=None):
+        """Reads from the serial port until one complete frame is in the receive buffer.
+
+        Must be called while holding the lock.
+
+        Args:
+            timeout (float, optional): Time to wait for a complete frame.  Defaults to the serial timeout.
+
+        Raises:
+            RuntimeError: If the serial port cannot be read from or if too many bytes are waiting on the serial port.
+
+        Returns:
+            bytes: The frame, or empty bytes if no complete frame arrived within the serial timeout.
+
+        """
+        frame = self._frames.next_frame()
+        deadline = time.monotonic() + (self._timeout if timeout is None else timeout)
+
+        while(frame is None):
+            # Read at least one byte, so that the read blocks until data are available
+            try:
+                in_waiting = self._serial.in_waiting
+                if(in_waiting > MAX_IN_WAITING):
+                    error_msg = 'Too many incoming bytes waiting on serial port ({})'.format(in_waiting)
+                    logger.warning(error_msg)
+
+                    # Signal the serial_task thread that the serial device should be restarted
+                    self._needs_restart = True
+                    self._serial_cv.notify_all()
+                    raise RuntimeError(error_msg)
+
+                data = self._serial.read(max(1, in_waiting))
+            except RuntimeError:
+                raise
             except Exception as e:
                 error_msg = 'Unable to read from the serial port.'
                 logger.critical(error_msg)
@@ -166,14 +836,90 @@ class GritsbotSerial:
                 self._serial_cv.notify_all()
                 raise RuntimeError(error_msg)
 
-            result = None
-            try:
-                result = _bytes_to_json(msg)
-            except Exception as e:
-                logger.warning('Unable to parse JSON message from serial port')
-                logger.warning(repr(e))
+            if(data):
+                self._bytes_read += len(data)
+                self._frames.feed(data)
+                frame = self._frames.next_frame()
 
-            return result
+            if(frame is None and (not data or time.monotonic() >= deadline)):
+                # A partial frame can't be completed reliably, so drop it rather than corrupting the next response
+                logger.warning('Timed out waiting for a complete frame ({} bytes buffered)'.format(len(self._frames)))
+                self._frames.clear()
+                return b''
+
+            if(len(self._frames) > MAX_FRAME_SIZE):
+                error_msg = 'Receive buffer exceeded maximum frame size ({})'.format(len(self._frames))
+                logger.warning(error_msg)
+
+                self._frames.clear()
+                self._needs_restart = True
+                self._serial_cv.notify_all()
+                raise RuntimeError(error_msg)
+
+        return frame
+
+    def _read_timeout(self):
+        """Returns the timeout for reads from the serial device."""
+        return min(self._timeout, PIPELINE_READ_TIMEOUT) if self._pipelined else self._timeout
+
+    def _negotiate_codec(self):
+        """Picks the codec to use with the microcontroller.
+
+        Must be called while holding the lock, by the thread that (re)acquired the serial device.
+
+        Raises:
+            RuntimeError: If the serial port cannot be written to or read from.
+
+        """
+        json_codec = JsonCodec()
+        self._codec = json_codec
+        self._frames = json_codec.frame_buffer()
+        self._seq_echo = False
+
+        # There's nothing to negotiate if JSON is the only option, unless pipelining needs to know whether sequence numbers are echoed
+        if(not self._pipelined and all(codec.name == json_codec.name for codec in self._codecs)):
+            return
+
+        probe = {'request': ['read'], 'iface': ['codec']}
+        if(self._pipelined):
+            probe['seq'] = self._next_seq
+            self._next_seq = (self._next_seq + 1) % SEQ_MODULUS
+
+        try:
+            self._serial.write(json_codec.encode(probe))
+        except Exception as e:
+            logger.critical('Unable to write to the serial port.')
+            logger.critical(repr(e))
+            raise RuntimeError('Unable to write to the serial port.')
+
+        # Microcontrollers that predate codec negotiation may not answer at all, so don't wait for long
+        self._serial.timeout = NEGOTIATION_TIMEOUT
+        try:
+            frame = self._read_frame(timeout=NEGOTIATION_TIMEOUT)
+        finally:
+            if(self._serial is not None):
+                self._serial.timeout = self._read_timeout()
+
+        supported = [json_codec.name]
+        response = None
+        try:
+            response = json_codec.decode(frame)
+            supported += response['body'][0]['codec']
+        except Exception:
+            logger.info('Serial device did not report supported codecs; using JSON.')
+
+        if(self._pipelined):
+            self._seq_echo = isinstance(response, dict) and response.get('seq') == probe['seq']
+            if(not self._seq_echo):
+                logger.warning('Serial device does not echo sequence numbers; keeping one request in flight.')
+
+        for codec in self._codecs:
+            if(codec.name in supported):
+                self._codec = codec
+                self._frames = codec.frame_buffer()
+                break
+
+        logger.info('Using ({}) codec for serial device.'.format(self._codec.name))
 
     def start(self, timeout=5):
         """Starts the serial line by attempting to establish a serial for the specified device.
@@ -185,6 +931,7 @@ class GritsbotSerial:
 
         """
         # Wait for initial connection
+        timed_out = False
         with self._serial_cv:
             if(self._started):
                 logger.critical('Cannot start the serial connection more than once!')
@@ -199,17 +946,39 @@ class GritsbotSerial:
             self._serial_task_thread = threading.Thread(target=self._serial_task)
             self._serial_task_thread.start()
 
+            if(self._watch):
+                directory = '/dev' if self._usb_match is not None else (os.path.dirname(self._serial_dev) or '.')
+                self._watcher = detect_serial.DeviceWatcher(self._on_device_event, directory=directory)
+                self._watcher.start()
+
             # Wait to acquire the serial connection once
             while(self._needs_restart):
                 if(not self._serial_cv.wait(timeout=timeout)):
                     logger.critical('Initial serial connection timed out.')
-                    # If we're in this state, then we have the lock, and the serial_task thread cannot acquire it.
-                    # However, if we're very unlucky, the serial device my have been acquired by the time we get here.  Either way,
-                    # it should be safe to just call stop and exit.
+                    timed_out = True
+                    break
+
+            # Only start reading once the device is up, so that stopping a failed start never waits on the reader
+            if(self._pipelined and not timed_out):
+                self._reader_thread = threading.Thread(target=self._reader_task)
+                self._reader_thread.start()
 
-                    # We can call self.stop here, since the underlying lock is reentrant
-                    self.stop()
-                    raise RuntimeError()
+        if(timed_out):
+            # The serial_task thread may be waiting on the lock, so it must be released before stopping.  If we're very unlucky, the serial
+            # device may have been acquired by now.  Either way, it's safe to just call stop and exit.
+            self.stop()
+            raise RuntimeError()
+
+    def stats(self):
+        """Returns counters for the requests made on the serial line.
+
+        Returns:
+            dict: The number of requests written ('requests'), the bytes written and read ('bytes_written' and 'bytes_read') and the number of
+            pipelined requests rejected because the device was restarting or the pipeline was full ('rejected').
+
+        """
+        with self._serial_cv:
+            return {'requests': self._requests, 'bytes_written': self._bytes_written, 'bytes_read': self._bytes_read, 'rejected': self._rejected}
 
     def stop(self):
         """Stops the serial connection.
@@ -225,11 +994,72 @@ class GritsbotSerial:
             # If the serial connection was never started, don't shut it down
             if(self._started):
                 if(self._serial is not None):
+                    # Wake up the reader thread if it's blocked on a read
+                    if(self._pipelined):
+                        self._serial.cancel_read()
                     self._serial.close()
                     self._serial = None
 
+            while(self._pending):
+                _, (future, _, _) = self._pending.popitem(last=False)
+                future.set_exception(RuntimeError('Serial connection stopped.'))
+
+        if(self._watcher is not None):
+            self._watcher.stop()
+
         # Thread won't finish until lock can be acquired, so we need to put this outside the lock
-        self._serial_task_thread.join()
+        if(self._serial_task_thread is not None):
+            self._serial_task_thread.join()
+
+        if(self._reader_thread is not None and self._reader_thread is not threading.current_thread()):
+            self._reader_thread.join()
+
+    def _on_device_event(self, name, added):
+        """Handles a device being added to or removed from the watched directory.
+
+        Called by the device watcher's thread.
+
+        Args:
+            name (str): Name of the directory entry.
+            added (bool): Whether the entry was added (or changed) rather than removed.
+
+        """
+        # Any serial device could be the one matched by USB IDs
+        if(self._usb_match is not None):
+            relevant = name.startswith('tty')
+        else:
+            relevant = (name == os.path.basename(self._serial_dev))
+
+        if(not relevant):
+            return
+
+        with self._serial_cv:
+            if(added):
+                self._device_added = True
+                self._serial_cv.notify_all()
+            elif(name == os.path.basename(self._device_path) and not self._needs_restart):
+                logger.warning('Serial device ({}) removed.'.format(self._device_path))
+                if(self._pipelined):
+                    self._restart_pipeline('Serial device removed.')
+                else:
+                    self._needs_restart = True
+                    self._serial_cv.notify_all()
+
+    def _find_device(self):
+        """Returns the path of the serial device, looking it up by USB IDs if given.
+
+        Raises:
+            RuntimeError: If no serial device matches the USB IDs.
+
+        """
+        if(self._usb_match is None):
+            return self._serial_dev
+
+        path = detect_serial.find_port(**self._usb_match)
+        if(path is None):
+            raise RuntimeError('No serial device matches ({})'.format(self._usb_match))
+
+        return path
 
     def _serial_task(self):
         """Restarts the serial if the serial device stops responding.
@@ -237,29 +1067,44 @@ class GritsbotSerial:
         Only meant to be run by the interal thread!
 
         """
-        while (not self._stopped):
-            start_time = time.time()
+        backoff = 0
 
-            with self._serial_cv:
+        with self._serial_cv:
+            while (not self._stopped):
                 while (not self._needs_restart and not self._stopped):
                     self._serial_cv.wait()
 
+                # Back off after failed attempts, unless a device shows up in the meantime
+                deadline = time.monotonic() + backoff
+                while (not self._device_added and not self._stopped and time.monotonic() < deadline):
+                    self._serial_cv.wait(timeout=deadline - time.monotonic())
+                self._device_added = False
+
                 if(self._stopped):
                     break
-                else:
-                    # Need to restart serial
-                    if(self._serial is not None):
-                        self._serial.close()
-                        self._serial = None
-
-                    try:
-                        self._serial = serial.Serial(self._serial_dev, self._baud_rate, timeout=self._timeout)
-                        # If we succeeded, no longer need to restart serial
-                        self._needs_restart = False
-                        self._serial_cv.notify_all()
-                    except Exception as e:
-                        logger.critical('Could not get serial device ({})'.format(self._serial_dev))
-                        logger.critical(repr(e))
 
-            # Wait at least one second between retries
-            time.sleep(max(0, 1 - (time.time() - start_time)))
+                # Need to restart serial
+                if(self._serial is not None):
+                    if(self._pipelined):
+                        self._serial.cancel_read()
+                    self._serial.close()
+                    self._serial = None
+
+                # Bytes from the old connection are meaningless now
+                self._frames.clear()
+
+                try:
+                    self._device_path = self._find_device()
+                    self._serial = serial.Serial(self._device_path, self._baud_rate, timeout=self._read_timeout())
+                    # The device may have been swapped for one with different firmware, so negotiate on every connection
+                    self._negotiate_codec()
+                    # If we succeeded, no longer need to restart serial
+                    self._needs_restart = False
+                    self._serial_cv.notify_all()
+                    backoff = 0
+                    logger.info('Acquired serial device ({})'.format(self._device_path))
+                except Exception as e:
+                    logger.critical('Could not get serial device ({})'.format(self._device_path))
+                    logger.critical(repr(e))
+                    self._needs_restart = True
+                    backoff = min(RETRY_MAX, max(RETRY_MIN, 2*backoff))
@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+class Mailbox:
+    """Single-slot holder for the newest message on a STREAM link.
+
+    Each message overwrites the previous one, so a slow consumer only ever sees the newest message and nothing queues up.  Messages are kept as raw
+    payloads and only decoded when taken.
+
+    Attributes:
+        received_time (float): When the message last taken was put into the mailbox, or None if nothing has been taken.
+        _decode (function): Decodes a raw payload when it is taken.
+        _clock (function): Returns the current monotonic time.
+        _wake (threading.Event): Set whenever a message is put, or None.
+        _lock (threading.Lock): Protects the slot and counters.
+        _payload (bytes): The newest raw payload, or None if the mailbox is empty.
+        _put_time (float): When the newest raw payload was put into the mailbox.
+        _received (int): Number of messages put into the mailbox.
+        _superseded (int): Number of messages overwritten before they were taken.
+
+    """
+
+    def __init__(self, decode=None, clock=time.monotonic, wake=None):
+        """Creates an empty mailbox.
+
+        Args:
+            decode (function, optional): Decodes a raw payload when it is taken.  Defaults to returning the raw payload.
+            clock (function, optional): Returns the current monotonic time, for timestamping messages as they are put.
+            wake (threading.Event, optional): Set whenever a message is put, so a consumer can wait for messages (e.g., with
+                scheduler.PeriodicScheduler.wait).  May be shared by several mailboxes.
+
+        Examples:
+            >>> inputs = Mailbox(decode=lambda x: json.loads(x.decode(encoding='UTF-8')))
+            >>> robot_node.subscribe_with_callback(input_link, inputs.put)
+
+        """
+        self.received_time = None
+        self._decode = decode
+        self._clock = clock
+        self._wake = wake
+        self._lock = threading.Lock()
+        self._payload = None
+        self._put_time = None
+        self._received = 0
+        self._superseded = 0
+
+    def put(self, payload):
+        """Puts a raw payload into the mailbox, overwriting any message that hasn't been taken.
+
+        Args:
+            payload (bytes): The raw payload.
+
+        """
+        put_time = self._clock()
+        with self._lock:
+            if(self._payload is not None):
+                self._superseded += 1
+            self._payload = payload
+            self._put_time = put_time
+            self._received += 1
+
+        if(self._wake is not None):
+            self._wake.set()
+
+    def take_raw(self):
+        """Takes the newest raw payload, leaving the mailbox empty.
+
+        Returns:
+            bytes: The raw payload, or None if the mailbox is empty.
+
+        """
+        with self._lock:
+            payload = self._payload
+            if(payload is not None):
+                self.received_time = self._put_time
+            self._payload = None
+
+        return payload
+
+    def take(self):
+        """Takes and decodes the newest message, leaving the mailbox empty.
+
+        Raises:
+            Exception: If the payload cannot be decoded.
+
+        Returns:
+            The decoded message, or None if the mailbox is empty.
+
+        """
+        payload = self.take_raw()
+
+        if(payload is None or self._decode is None):
+            return payload
+
+        return self._decode(payload)
+
+    def stats(self):
+        """Returns the number of messages received ('received') and superseded before being taken ('superseded')."""
+        with self._lock:
+            return {'received': self._received, 'superseded': self._superseded}
@@ -0,0 +1,279 @@
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+# Constants
+BUCKETS = tuple(0.00001 * 2**i for i in range(18))  # 10 us to about 1.3 s
+WINDOW = 60
+SLICES = 6
+
+
+class Histogram:
+    """Counts observations in fixed, exponentially spaced buckets.
+
+    Attributes:
+        bounds (tuple): Upper bounds of the buckets.  Observations above the last bound are counted in an overflow bucket.
+        counts (list): Count for each bucket, plus the overflow bucket.
+        count (int): Number of observations.
+        sum (float): Sum of the observations.
+        max (float): Largest observation.
+
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        """Records an observation."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if(value > self.max):
+            self.max = value
+
+    def merge(self, other):
+        """Adds the observations of another histogram with the same bounds to this one."""
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Returns an upper bound for the p-th percentile, in [0, 100], or zero if there are no observations."""
+        if(self.count == 0):
+            return 0
+
+        target = p / 100 * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if(cumulative >= target and c > 0):
+                return self.bounds[i] if i < len(self.bounds) else self.max
+
+        return self.max
+
+
+class RollingHistogram:
+    """A histogram of the observations made in the last window seconds.
+
+    The window is split into slices; when a slice expires, its observations are dropped.
+
+    Attributes:
+        _window (float): Length of the window in seconds.
+        _slice (float): Length of each slice in seconds.
+        _clock (function): Returns the current monotonic time.
+        _slices (collections.deque): (start time, Histogram) for each live slice, oldest first.
+        _lock (threading.Lock): Protects the slices, since observations may come from several threads.
+
+    """
+
+    def __init__(self, window=WINDOW, slices=SLICES, bounds=BUCKETS, clock=time.monotonic):
+        self._window = window
+        self._slice = window / slices
+        self._bounds = bounds
+        self._clock = clock
+        self._slices = collections.deque()
+        self._lock = threading.Lock()
+
+    def _current(self, now):
+        """Returns the histogram for the current slice, rotating out expired slices.  Must be called while holding the lock."""
+        if(not self._slices or now - self._slices[-1][0] >= self._slice):
+            self._slices.append((now, Histogram(self._bounds)))
+
+        while(now - self._slices[0][0] >= self._window):
+            self._slices.popleft()
+
+        return self._slices[-1][1]
+
+    def observe(self, value):
+        """Records an observation."""
+        with self._lock:
+            self._current(self._clock()).observe(value)
+
+    def merged(self):
+        """Returns a Histogram of the observations in the window."""
+        total = Histogram(self._bounds)
+        with self._lock:
+            self._current(self._clock())
+            for _, histogram in self._slices:
+                total.merge(histogram)
+
+        return total
+
+
+class PhaseTimer:
+    """Times consecutive phases of a loop into Metrics.
+
+    Attributes:
+        _metrics (Metrics): Where phase times are recorded.
+        _start (float): When the current cycle started.
+        _last (float): When the current phase started.
+
+    """
+
+    def __init__(self, metrics):
+        self._metrics = metrics
+        self._start = 0
+        self._last = 0
+
+    def start(self):
+        """Starts timing a cycle (and its first phase)."""
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, name):
+        """Records the time since the previous phase ended as phase name, and starts the next phase."""
+        now = time.perf_counter()
+        self._metrics.observe(name, now - self._last)
+        self._last = now
+
+    def total(self, name):
+        """Records the time since the cycle started as name."""
+        self._metrics.observe(name, time.perf_counter() - self._start)
+
+
+class Metrics:
+    """Named rolling histograms, e.g., of the time spent in each phase of the control loop.
+
+    Timing is left to the caller (e.g., time.perf_counter() before and after a phase), so that instrumentation costs one observe() per phase.
+
+    Single values that don't vary from cycle to cycle (e.g., how long startup took) are kept as gauges.
+
+    Attributes:
+        _histograms (dict): Maps names to RollingHistograms.
+        _gauges (dict): Maps names to the latest value of each gauge, in seconds.
+        _lock (threading.Lock): Protects the creation of histograms and the gauges, since metrics are recorded and read from several threads.
+
+    """
+
+    def __init__(self, window=WINDOW, slices=SLICES, bounds=BUCKETS, clock=time.monotonic):
+        """Creates an empty set of metrics.
+
+        Args:
+            window (float, optional): Length of the rolling window in seconds.
+            slices (int, optional): Number of slices the window is split into.
+            bounds (tuple, optional): Upper bounds of the histogram buckets.
+            clock (function, optional): Returns the current monotonic time.
+
+        Examples:
+            >>> metrics = Metrics()
+            >>> t = time.perf_counter()
+            >>> metrics.observe('serial_write', time.perf_counter() - t)
+
+        """
+        self._window = window
+        self._slices = slices
+        self._bounds = bounds
+        self._clock = clock
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        """Returns the rolling histogram with a name, creating it if needed."""
+        histogram = self._histograms.get(name)
+        if(histogram is None):
+            with self._lock:
+                histogram = self._histograms.setdefault(name, RollingHistogram(self._window, self._slices, self._bounds, self._clock))
+
+        return histogram
+
+    def observe(self, name, value):
+        """Records an observation in the histogram with a name."""
+        self.histogram(name).observe(value)
+
+    def set_gauge(self, name, value):
+        """Sets the gauge with a name to a value (in seconds), replacing its previous value."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def _items(self):
+        """Returns sorted copies of the histograms and gauges, so they can be read while other threads add to them."""
+        with self._lock:
+            return sorted(self._histograms.items()), sorted(self._gauges.items())
+
+    def snapshot(self):
+        """Summarizes every histogram over the rolling window, and every gauge.
+
+        Returns:
+            dict: Maps histogram names to the count, mean, p50, p99 and max of the observations, and gauge names to their value ('value').
+
+        """
+        histograms, gauges = self._items()
+        result = {}
+        for name, rolling in histograms:
+            h = rolling.merged()
+            result[name] = {
+                'count': h.count,
+                'mean': h.sum / h.count if h.count else 0,
+                'p50': h.percentile(50),
+                'p99': h.percentile(99),
+                'max': h.max,
+            }
+
+        for name, value in gauges:
+            result[name] = {'value': value}
+
+        return result
+
+    def to_json(self):
+        """Returns the snapshot as a JSON string, e.g., to publish on a metrics link."""
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='gritsbot', labels=None):
+        """Formats every histogram in the Prometheus text exposition format.
+
+        Args:
+            prefix (str, optional): Prefix for the metric names.
+            labels (dict, optional): Labels to add to every sample (e.g., {'robot': '1'}).
+
+        Returns:
+            str: The formatted metrics.
+
+        """
+        base = ','.join('{0}="{1}"'.format(k, v) for k, v in sorted((labels or {}).items()))
+        histograms, gauges = self._items()
+        lines = []
+
+        for name, rolling in histograms:
+            h = rolling.merged()
+            metric = '{0}_{1}_seconds'.format(prefix, name)
+            lines.append('# TYPE {} histogram'.format(metric))
+
+            cumulative = 0
+            for i, c in enumerate(h.counts):
+                cumulative += c
+                le = repr(h.bounds[i]) if i < len(h.bounds) else '+Inf'
+                lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(metric, base + ',' if base else '', le, cumulative))
+
+            suffix = '{' + base + '}' if base else ''
+            lines.append('{0}_sum{1} {2}'.format(metric, suffix, repr(h.sum)))
+            lines.append('{0}_count{1} {2}'.format(metric, suffix, h.count))
+
+        for name, value in gauges:
+            metric = '{0}_{1}_seconds'.format(prefix, name)
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{0}{1} {2}'.format(metric, '{' + base + '}' if base else '', repr(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='gritsbot', labels=None):
+        """Atomically writes the metrics to a file, e.g., for the node exporter's textfile collector.
+
+        Args:
+            path (str): Path of the file.
+            prefix (str, optional): Prefix for the metric names.
+            labels (dict, optional): Labels to add to every sample.
+
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus(prefix=prefix, labels=labels))
+        os.replace(tmp, path)
@@ -0,0 +1,134 @@
+import logging
+
+global logger
+logger = logging.getLogger('root')
+
+
+class PolledInterface:
+    """An interface on the microcontroller that is read periodically.
+
+    Attributes:
+        name (str): Name of the interface.
+        period (float): Time between reads in seconds.
+        handler (function): Bound once at creation and handed to the control loop with each read, so that scheduling a read allocates nothing.
+        _build (function): Adds the read to a request.
+        _decode (function): Turns the status and body of the response into status data.
+        _next_due (float): Time at which the next read is due, or None if the interface has never been read.
+
+    """
+
+    def __init__(self, name, period, build=None, decode=None):
+        """Creates the polled interface.
+
+        Args:
+            name (str): Name of the interface.
+            period (float): Time between reads in seconds.
+            build (function, optional): Called with a Request; must add exactly one request to it.  Defaults to a read of the interface.
+            decode (function, optional): Called with the status and body of the response; returns a dict of status data.  Defaults to taking the
+                value of the interface from the body.
+
+        Examples:
+            >>> PolledInterface('batt_volt', 1)
+            >>> PolledInterface('imu', 0.01, decode=lambda status, body: {'accel': body['imu'][:3]})
+
+        """
+        self.name = name
+        self.period = period
+        self._build = build if build is not None else self._default_build
+        self._decode = decode if decode is not None else self._default_decode
+        self._next_due = None
+        self.handler = self._decode
+
+    def due(self, now):
+        """Returns whether a read is due and, if it is, schedules the next one.
+
+        Args:
+            now (float): The current monotonic time.
+
+        Returns:
+            bool: Whether a read is due.
+
+        """
+        if(self._next_due is not None and now < self._next_due):
+            return False
+
+        # Stay on the original schedule, unless reads were missed entirely
+        self._next_due = now + self.period if self._next_due is None else self._next_due + self.period
+        if(self._next_due <= now):
+            self._next_due = now + self.period
+
+        return True
+
+    def build(self, request):
+        """Adds the read to a request."""
+        self._build(request)
+
+    def _default_build(self, request):
+        request.add_read_request(self.name)
+
+    def _default_decode(self, status, body):
+        if(self.name in body):
+            return {self.name: body[self.name]}
+        else:
+            logger.critical('Request for ({0}) not in body ({1}) after request.'.format(self.name, body))
+            return {}
+
+
+class PollScheduler:
+    """Registry of polled interfaces that packs every read due in a cycle into the cycle's single request.
+
+    Each interface is read at its own period, so fast sensors (e.g., encoders at 100 Hz) and slow ones (e.g., the battery at 1 Hz) share one serial
+    transaction per cycle.
+
+    Attributes:
+        _interfaces (list): The registered interfaces, in the order their reads are added to requests.
+
+    """
+
+    def __init__(self, interfaces=()):
+        """Creates the scheduler.
+
+        Args:
+            interfaces (iterable, optional): Polled interfaces to register.
+
+        Examples:
+            >>> PollScheduler([PolledInterface('batt_volt', 1), PolledInterface('charge_status', 1)])
+
+        """
+        self._interfaces = list(interfaces)
+
+    def register(self, interface):
+        """Registers a polled interface.
+
+        Args:
+            interface (PolledInterface): The interface to register.
+
+        Raises:
+            ValueError: If an interface with the same name is already registered.
+
+        """
+        if(any(x.name == interface.name for x in self._interfaces)):
+            raise ValueError('Interface ({}) is already registered.'.format(interface.name))
+
+        self._interfaces.append(interface)
+
+    def add_due(self, request, handlers, now):
+        """Adds the reads that are due to a request, and their handlers to the list of handlers.
+
+        Args:
+            request (Request): The request for this cycle.
+            handlers (list): Handlers for the request, one per request entry.
+            now (float): The current monotonic time.
+
+        Returns:
+            int: Number of reads added.
+
+        """
+        added = 0
+        for interface in self._interfaces:
+            if(interface.due(now)):
+                interface.build(request)
+                handlers.append(interface.handler)
+                added += 1
+
+        return added
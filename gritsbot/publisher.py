@@ -0,0 +1,97 @@
+import logging
+import threading
+import gritsbot.mailbox as mailbox
+
+global logger
+logger = logging.getLogger('root')
+
+
+class BackgroundPublisher:
+    """Serializes and publishes outbound data from a sender thread, so that network I/O never stalls the control loop.
+
+    Each kind of outbound data (e.g., status) has a channel: a single slot and a handler that serializes and publishes what is in it.  The control
+    loop offers the latest value and moves on; the sender thread hands it to the handler.  If the sender falls behind (e.g., during a broker
+    hiccup), newer values overwrite older ones in the slot, so stale values are dropped rather than queued.
+
+    Attributes:
+        _channels (dict): Maps channel names to (mailbox.Mailbox, handler).  Replaced rather than modified, so the sender can iterate it safely.
+        _wake (threading.Event): Set when a value is offered or the sender is stopping.
+        _stopping (bool): Whether the sender should exit once the slots are drained.
+        _thread (threading.Thread): The sender thread.
+        _sent (int): Number of values handled.
+        _failed (int): Number of values whose handler raised an exception.
+
+    """
+
+    def __init__(self):
+        """Creates the publisher and starts its sender thread.
+
+        Examples:
+            >>> publisher = BackgroundPublisher()
+            >>> publisher.register('status', status_publisher.update)
+            >>> publisher.offer('status', dict(status_data), time.monotonic())
+
+        """
+        self._channels = {}
+        self._wake = threading.Event()
+        self._stopping = False
+        self._sent = 0
+        self._failed = 0
+
+        self._thread = threading.Thread(target=self._sender_task, daemon=True)
+        self._thread.start()
+
+    def register(self, name, handler):
+        """Adds a channel.
+
+        Args:
+            name (str): Name of the channel.
+            handler (function): Called from the sender thread with the arguments of each value offered on the channel.  Publishes them (e.g.,
+                StatusPublisher.update).
+
+        """
+        self._channels = dict(self._channels, **{name: (mailbox.Mailbox(), handler)})
+
+    def offer(self, name, *value):
+        """Hands the latest value of a channel to the sender, replacing any value it hasn't handled yet.  Doesn't block on the network.
+
+        Args:
+            name (str): Name of the channel.
+            *value: The arguments for the channel's handler.  They must not be modified afterwards (e.g., pass a copy of a dict that changes).
+
+        """
+        self._channels[name][0].put(value)
+        self._wake.set()
+
+    def stats(self):
+        """Returns the number of values handled ('sent'), dropped because a newer value replaced them ('dropped') and that failed ('failed')."""
+        dropped = sum(slot.stats()['superseded'] for slot, _ in self._channels.values())
+        return {'sent': self._sent, 'dropped': dropped, 'failed': self._failed}
+
+    def stop(self):
+        """Handles the values already offered and stops the sender thread."""
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+
+    def _sender_task(self):
+        while(True):
+            self._wake.wait()
+            self._wake.clear()
+            stopping = self._stopping
+
+            for name, (slot, handler) in self._channels.items():
+                value = slot.take()
+                if(value is None):
+                    continue
+
+                try:
+                    handler(*value)
+                    self._sent += 1
+                except Exception as e:
+                    self._failed += 1
+                    logger.warning('Could not publish ({})'.format(name))
+                    logger.warning(repr(e))
+
+            if(stopping):
+                break
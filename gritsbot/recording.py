@@ -0,0 +1,375 @@
+import gritsbot.gritsbotserial as gritsbotserial
+import gritsbot.metrics as metrics
+import argparse
+import collections
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+global logger
+logger = logging.getLogger('root')
+
+# Constants
+MAGIC = b'GBRC'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHHI')  # magic, version, number of segments, segment size
+SEGMENT_HEADER = struct.Struct('<I')  # segment sequence number
+RECORD_HEADER = struct.Struct('<IdBH')  # segment sequence number, monotonic time, kind, payload length
+SEGMENT_SIZE = 65536
+RING_SIZE = 16*1024*1024
+FLUSH_INTERVAL = 0.5
+MAX_PENDING = 10000
+
+# Kinds of record
+INPUT = 1
+SERIAL_REQUEST = 2
+SERIAL_RESPONSE = 3
+KIND_NAMES = {INPUT: 'input', SERIAL_REQUEST: 'serial_request', SERIAL_RESPONSE: 'serial_response'}
+
+
+def _read_file_header(f):
+    f.seek(0)
+    data = f.read(FILE_HEADER.size)
+    if(len(data) < FILE_HEADER.size):
+        return None
+
+    magic, version, segments, segment_size = FILE_HEADER.unpack(data)
+    if(magic != MAGIC or version != VERSION):
+        return None
+
+    return segments, segment_size
+
+
+def _segment_sequences(f, segments, segment_size):
+    """Returns the sequence number of each segment (zero if it has never been written)."""
+    sequences = []
+    for i in range(segments):
+        f.seek(FILE_HEADER.size + i*segment_size)
+        data = f.read(SEGMENT_HEADER.size)
+        sequences.append(SEGMENT_HEADER.unpack(data)[0] if len(data) == SEGMENT_HEADER.size else 0)
+
+    return sequences
+
+
+class Recorder:
+    """Records inputs and serial traffic to a fixed-size ring file.
+
+    The file is split into segments.  Records are written to one segment until it is full and then to the next, wrapping around to overwrite the
+    oldest segment.  Each segment and each record is stamped with the segment's sequence number, so stale records left over in a reused segment are
+    told apart from new ones without erasing the segment first.  Records are queued by the caller and written by a background thread, so recording
+    doesn't block the control loop on the SD card.
+
+    Attributes:
+        _path (str): Path of the ring file.
+        _segments (int): Number of segments in the file.
+        _segment_size (int): Size of each segment in bytes.
+        _flush_interval (float): Time between writes to the file in seconds.
+        _clock (function): Returns the current monotonic time.
+        _pending (collections.deque): Records waiting to be written, as (time, kind, payload).
+        _file: The ring file.
+        _segment (int): Index of the segment being written.
+        _sequence (int): Sequence number of the segment being written.
+        _offset (int): Offset of the next record in the segment being written.
+        _stop (threading.Event): Set to stop the writer thread.
+        _thread (threading.Thread): The writer thread.
+        _recorded (int): Number of records written.
+        _dropped (int): Number of records dropped because too many were pending or they were too large.
+
+    """
+
+    def __init__(self, path, size=RING_SIZE, segment_size=SEGMENT_SIZE, flush_interval=FLUSH_INTERVAL, clock=time.monotonic):
+        """Opens (or creates) a ring file and starts recording to it.
+
+        An existing ring file with the same layout is appended to, after its newest segment.  Anything else at the path is replaced.
+
+        Args:
+            path (str): Path of the ring file.
+            size (int, optional): Size of the ring file in bytes.
+            segment_size (int, optional): Size of each segment in bytes.  Bounds the size of a record.
+            flush_interval (float, optional): Time between writes to the file in seconds.
+            clock (function, optional): Returns the current monotonic time.
+
+        Raises:
+            ValueError: If the file would have fewer than two segments.
+
+        Examples:
+            >>> recorder = Recorder('/var/log/gritsbot.rec', size=16*1024*1024)
+            >>> recorder.record(recording.INPUT, payload)
+            >>> recorder.stop()
+
+        """
+        self._path = path
+        self._segment_size = segment_size
+        self._segments = (size - FILE_HEADER.size) // segment_size
+        self._flush_interval = flush_interval
+        self._clock = clock
+
+        if(self._segments < 2):
+            raise ValueError('Ring file of {0} bytes has fewer than two segments of {1} bytes.'.format(size, segment_size))
+
+        self._pending = collections.deque()
+        self._recorded = 0
+        self._dropped = 0
+
+        self._file = None
+        if(os.path.exists(path)):
+            self._file = open(path, 'r+b')
+            if(_read_file_header(self._file) != (self._segments, self._segment_size)):
+                self._file.close()
+                self._file = None
+
+        if(self._file is None):
+            self._file = open(path, 'w+b')
+            self._file.write(FILE_HEADER.pack(MAGIC, VERSION, self._segments, self._segment_size))
+            self._file.truncate(FILE_HEADER.size + self._segments*self._segment_size)
+            sequences = [0]*self._segments
+        else:
+            sequences = _segment_sequences(self._file, self._segments, self._segment_size)
+
+        newest = max(range(self._segments), key=lambda i: sequences[i])
+        self._sequence = sequences[newest]
+        self._segment = newest
+        self._start_segment((newest + 1) % self._segments if self._sequence > 0 else 0)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._writer_task, daemon=True)
+        self._thread.start()
+
+    def record(self, kind, payload):
+        """Queues a record to be written.  Thread safe.
+
+        Args:
+            kind (int): The kind of record (e.g., INPUT).
+            payload: The raw payload (bytes), or a JSON-encodable object that is encoded when written.
+
+        """
+        if(len(self._pending) >= MAX_PENDING):
+            self._dropped += 1
+            return
+
+        self._pending.append((self._clock(), kind, payload))
+
+    def stats(self):
+        """Returns the number of records written ('recorded') and dropped ('dropped')."""
+        return {'recorded': self._recorded, 'dropped': self._dropped}
+
+    def stop(self):
+        """Writes the pending records and closes the ring file."""
+        self._stop.set()
+        self._thread.join()
+        self._file.close()
+
+    def _start_segment(self, segment):
+        self._segment = segment
+        self._sequence += 1
+        self._offset = SEGMENT_HEADER.size
+        self._file.seek(FILE_HEADER.size + segment*self._segment_size)
+        self._file.write(SEGMENT_HEADER.pack(self._sequence))
+
+    def _write(self, timestamp, kind, payload):
+        if(not isinstance(payload, (bytes, bytearray))):
+            payload = json.dumps(payload).encode(encoding='UTF-8')
+
+        size = RECORD_HEADER.size + len(payload)
+        if(size > self._segment_size - SEGMENT_HEADER.size):
+            self._dropped += 1
+            return
+
+        if(self._offset + size > self._segment_size):
+            # Mark the end of this segment, unless it is exactly full
+            if(self._offset + RECORD_HEADER.size <= self._segment_size):
+                self._file.write(RECORD_HEADER.pack(0, 0, 0, 0))
+            self._start_segment((self._segment + 1) % self._segments)
+
+        self._file.write(RECORD_HEADER.pack(self._sequence, timestamp, kind, len(payload)))
+        self._file.write(payload)
+        self._offset += size
+        self._recorded += 1
+
+    def _writer_task(self):
+        while(True):
+            stopping = self._stop.wait(self._flush_interval)
+
+            try:
+                while(self._pending):
+                    self._write(*self._pending.popleft())
+                self._file.flush()
+            except Exception as e:
+                logger.critical('Could not write recording ({})'.format(self._path))
+                logger.critical(repr(e))
+
+            if(stopping):
+                break
+
+
+def read_records(path):
+    """Reads the records in a ring file, oldest first.
+
+    Args:
+        path (str): Path of the ring file.
+
+    Raises:
+        ValueError: If the file is not a ring file.
+
+    Returns:
+        generator: Yields (time, kind, payload) for each record, where payload is the raw bytes.
+
+    """
+    with open(path, 'rb') as f:
+        layout = _read_file_header(f)
+        if(layout is None):
+            raise ValueError('File ({}) is not a recording.'.format(path))
+
+        segments, segment_size = layout
+        sequences = _segment_sequences(f, segments, segment_size)
+
+        for segment in sorted((i for i in range(segments) if sequences[i] > 0), key=lambda i: sequences[i]):
+            f.seek(FILE_HEADER.size + segment*segment_size)
+            data = f.read(segment_size)
+            offset = SEGMENT_HEADER.size
+
+            while(offset + RECORD_HEADER.size <= len(data)):
+                sequence, timestamp, kind, length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if(sequence != sequences[segment] or offset + length > len(data)):
+                    break
+
+                yield timestamp, kind, data[offset:offset + length]
+                offset += length
+
+
+def paced(records, speed=1.0, sleep=time.sleep, clock=time.monotonic):
+    """Yields records at their recorded pace.
+
+    Args:
+        records (iterable): (time, kind, payload) records, oldest first.
+        speed (float, optional): How many times faster than recorded to replay, or None to replay as fast as possible.
+        sleep (function, optional): Sleeps for a time in seconds.
+        clock (function, optional): Returns the current monotonic time.
+
+    Returns:
+        generator: Yields the records, each once its time has come.
+
+    """
+    start = None
+    for record in records:
+        if(speed is not None):
+            # Times restart when the robot reboots
+            if(start is None or record[0] < start[0]):
+                start = (record[0], clock())
+            delay = start[1] + (record[0] - start[0])/speed - clock()
+            if(delay > 0):
+                sleep(delay)
+
+        yield record
+
+
+def replay_serial(records, serial, speed=1.0):
+    """Replays the recorded serial requests to a serial connection.
+
+    Args:
+        records (iterable): (time, kind, payload) records, oldest first.
+        serial (GritsbotSerial): A started serial connection.  Give it Metrics to measure the round trips.
+        speed (float, optional): How many times faster than recorded to replay, or None to replay as fast as possible.
+
+    Returns:
+        dict: Number of requests replayed ('requests') and how many got no response ('failed').
+
+    """
+    result = {'requests': 0, 'failed': 0}
+    for _, kind, payload in paced((x for x in records if x[1] == SERIAL_REQUEST), speed):
+        result['requests'] += 1
+        if(serial.serial_request(json.loads(payload.decode(encoding='UTF-8'))) is None):
+            result['failed'] += 1
+
+    return result
+
+
+def replay_inputs(records, put, speed=1.0, step=None):
+    """Replays the recorded inputs, e.g., into a firmware Controller.
+
+    Args:
+        records (iterable): (time, kind, payload) records, oldest first.
+        put (function): Called with each raw input payload (e.g., Controller.on_input).
+        speed (float, optional): How many times faster than recorded to replay, or None to replay as fast as possible.
+        step (function, optional): Called after each input, e.g., to run a control cycle when replaying as fast as possible.
+
+    Returns:
+        int: Number of inputs replayed.
+
+    """
+    count = 0
+    for _, kind, payload in paced((x for x in records if x[1] == INPUT), speed):
+        put(payload)
+        if(step is not None):
+            step()
+        count += 1
+
+    return count
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Dumps or replays a recording of the inputs and serial traffic of a robot')
+    parser.add_argument('command', choices=['dump', 'serial', 'firmware'],
+                        help='Print the records, replay the serial requests, or replay the inputs through the firmware control loop')
+    parser.add_argument('path', help='Path of the recording')
+    parser.add_argument('-speed', type=float, help='How many times faster than recorded to replay (0 for as fast as possible)', default=1)
+    parser.add_argument('-serial_dev', help='Serial device to replay to (defaults to a simulated device)', default=None)
+    parser.add_argument('-codec', choices=['binary', 'json'], help='Preferred serial codec (falls back to JSON)', default='json')
+
+    args = parser.parse_args()
+    speed = args.speed if args.speed > 0 else None
+
+    if(args.command == 'dump'):
+        for timestamp, kind, payload in read_records(args.path):
+            print('{0:.6f} {1} {2}'.format(timestamp, KIND_NAMES.get(kind, kind), payload.decode(encoding='UTF-8', errors='replace')))
+        return
+
+    device = None
+    serial_dev = args.serial_dev
+    if(serial_dev is None):
+        import gritsbot.simulator as simulator
+        device = simulator.SimulatedGritsbot()
+        device.start()
+        serial_dev = device.device
+
+    codecs = [gritsbotserial.JsonCodec()]
+    if(args.codec == 'binary'):
+        codecs.insert(0, gritsbotserial.BinaryCodec())
+
+    replay_metrics = metrics.Metrics(window=3600)
+    serial = gritsbotserial.GritsbotSerial(serial_dev=serial_dev, codecs=codecs, metrics=replay_metrics, watch=False)
+    serial.start()
+
+    try:
+        start = time.monotonic()
+        if(args.command == 'serial'):
+            print(replay_serial(read_records(args.path), serial, speed))
+        else:
+            import gritsbot.firmware as firmware
+            controller = firmware.Controller(serial, lambda link, payload: None, 'replay', firmware.parse_args(['replay']),
+                                             replay_metrics)
+            if(speed is None):
+                print(replay_inputs(read_records(args.path), controller.on_input, None, lambda: controller.cycle(time.monotonic())))
+            else:
+                thread = threading.Thread(target=controller.run, daemon=True)
+                thread.start()
+                print(replay_inputs(read_records(args.path), controller.on_input, speed))
+                controller.stop()
+                thread.join()
+        print('Replayed in {:.3f} s'.format(time.monotonic() - start))
+
+        for name, summary in replay_metrics.snapshot().items():
+            print('{0:>20}: {1}'.format(name, ', '.join('{0} {1:.6g}'.format(k, v) for k, v in summary.items())))
+    finally:
+        serial.stop()
+        if(device is not None):
+            device.stop()
+
+
+if __name__ == '__main__':
+    main()
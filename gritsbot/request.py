@@ -0,0 +1,87 @@
+# Responses
+# Battery voltage response
+# response = {'status': 1, 'body': {'bat_volt': 4.3}}
+
+
+class Request:
+    """Represents serial requests to the microcontroller.
+
+    The serial communications operate on a request/response architecture.  For example, the request is of a form (when JSON encoded)
+
+    .. code-block:: python
+
+        {'request': ['read', 'write', 'read'], 'iface': [iface1, iface2, iface3], body: [body1, body2, body3]}
+
+    Attributes:
+        request (list): A list of requests (or actions) to perform.  Must be 'read' or 'write'.
+        iface (list): A list of interfaces on which to perform the request
+        body (list): A list of bodies for the requests.  These are empty if the request is a read.
+
+    """
+
+    def __init__(self):
+        """Initializes a request with optional iface, request, and body parameters.
+
+        Returns:
+            The created request.
+
+        """
+        self.iface = []
+        self.request = []
+        self.body = []
+
+    def add_write_request(self, iface, body):
+        """Adds a write to the request.
+
+        Args:
+            iface (str): The interface to write.
+            body (dict): A JSON-encodable body to be written.
+
+        Returns:
+            The modified request containing the new interface and body.
+
+        Examples:
+            >>> r = Request().add_write_request('motor', {'v': 0.1, 'w': 0.0})
+
+        """
+
+        self.iface.append(iface)
+        self.request.append('write')
+        self.body.append(body)
+
+        return self
+
+    def add_read_request(self, iface):
+        """Adds a read to the request.
+
+        Args:
+            iface (str): Interface from which to read.
+
+        Returns:
+            The request with the added read.
+
+        """
+
+        self.iface.append(iface)
+        self.request.append('read')
+        self.body.append({})
+
+        return self
+
+    def to_json_encodable(self):
+        """Turns the request into a JSON-encodable dict.
+
+        Raises:
+            Exception: If an underlying body element is not JSON-encodable.
+
+        Returns:
+            dict: A JSON-encodable dict representing the request.
+
+        """
+
+        req = {'request': self.request, 'iface': self.iface}
+
+        if(self.body):
+            req['body'] = self.body
+
+        return req
@@ -0,0 +1,171 @@
+import math
+import time
+
+# Constants
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+
+
+class PeriodicScheduler:
+    """Paces a loop against fixed deadlines on the monotonic clock.
+
+    Cycle k of the loop is due at start + k*period, so the loop does not drift and is not affected by changes to the wall clock.  The loop calls wait()
+    at the top of each cycle.  If the previous cycle ran past the next deadline (an overrun), the overrun policy decides what happens next:
+
+    * SKIP: the missed deadlines are dropped and the loop runs once, immediately, on the most recent deadline.
+    * CATCH_UP: the missed deadlines are run back-to-back, without sleeping, until the loop is back on schedule.
+
+    wait() may also be given an event (e.g., set when a new input arrives), which ends the wait early.  The extra cycle this starts doesn't move the
+    deadlines, so periodic work keeps its schedule.
+
+    Attributes:
+        _period (float): Period of the loop in seconds.
+        _overrun_policy (str): SKIP or CATCH_UP.
+        _clock (function): Returns the current monotonic time.
+        _sleep (function): Sleeps for a number of seconds.
+        _deadline (float): Deadline of the next cycle, or None if the loop hasn't started.
+        _started (float): When the cycle that is running started (its deadline, or when the event woke it up).
+        _cycles (int): Number of cycles run.
+        _overruns (int): Number of cycles that ran past the following deadline and for longer than a period.
+        _skipped (int): Number of deadlines dropped by the SKIP policy.
+        _jitter_sum (float): Sum of the wake-up lateness of all cycles.
+        _jitter_max (float): Largest wake-up lateness of any cycle.
+        _total_cycles (int): Number of cycles run since the scheduler was created.  Not reset.
+        _total_overruns (int): Number of overruns since the scheduler was created.  Not reset.
+        _woken (int): Number of waits ended early by the event.
+
+    """
+
+    def __init__(self, period, overrun_policy=SKIP, clock=time.monotonic, sleep=time.sleep):
+        """Creates the scheduler.
+
+        Args:
+            period (float): Period of the loop in seconds.
+            overrun_policy (str, optional): SKIP or CATCH_UP.
+            clock (function, optional): Returns the current monotonic time.
+            sleep (function, optional): Sleeps for a number of seconds.
+
+        Raises:
+            ValueError: If the overrun policy is unknown.
+
+        Examples:
+            >>> scheduler = PeriodicScheduler(0.016, overrun_policy=SKIP)
+            >>> while True:
+            ...     now = scheduler.wait()
+
+        """
+        if(overrun_policy not in (SKIP, CATCH_UP)):
+            raise ValueError('Unknown overrun policy ({})'.format(overrun_policy))
+
+        self._period = period
+        self._overrun_policy = overrun_policy
+        self._clock = clock
+        self._sleep = sleep
+        self._deadline = None
+        self._started = None
+        self._total_cycles = 0
+        self._total_overruns = 0
+        self.reset_stats()
+
+    @property
+    def period(self):
+        """float: Period of the loop in seconds."""
+        return self._period
+
+    def set_period(self, period):
+        """Changes the period of the loop.  The next cycle is due one new period after the cycle that is running started.
+
+        Args:
+            period (float): The new period in seconds.
+
+        """
+        if(self._started is not None):
+            self._deadline = self._started + period
+        self._period = period
+
+    def wait(self, wake=None):
+        """Waits until the next cycle is due or, if given an event, until it is set, whichever comes first.
+
+        Args:
+            wake (threading.Event, optional): Ends the wait early when set.  It is cleared when the wait ends.
+
+        Returns:
+            float: The deadline of the cycle that is starting or, if the event ended the wait early, the current time, on the monotonic clock.
+
+        """
+        now = self._clock()
+
+        started = self._deadline is not None
+        if(not started):
+            self._deadline = now
+
+        deadline = self._deadline
+
+        if(now < deadline):
+            if(wake is not None):
+                woken = wake.wait(deadline - now)
+                wake.clear()
+                now = self._clock()
+                if(woken and now < deadline):
+                    self._woken += 1
+                    self._started = now
+                    return now
+            else:
+                self._sleep(deadline - now)
+                now = self._clock()
+        else:
+            # The cycle is already due, so any input that arrived meanwhile is taken by it
+            if(wake is not None):
+                wake.clear()
+
+            # The previous cycle overran if it ran for longer than a period.  A cycle started early by the event may run past the regular
+            # deadline without that.
+            if(started and now > deadline and now > self._started + self._period):
+                self._overruns += 1
+                self._total_overruns += 1
+                if(self._overrun_policy == SKIP):
+                    missed = int(math.floor((now - deadline) / self._period))
+                    self._skipped += missed
+                    deadline += missed*self._period
+
+        jitter = max(0, now - deadline)
+        self._jitter_sum += jitter
+        self._jitter_max = max(self._jitter_max, jitter)
+        self._last_jitter = jitter
+        self._cycles += 1
+        self._total_cycles += 1
+
+        self._deadline = deadline + self._period
+        self._started = deadline
+        return deadline
+
+    def stats(self):
+        """Returns counters for the cycles run since the last reset.
+
+        Returns:
+            dict: Number of cycles, overruns and skipped deadlines, extra cycles started by the wake event ('woken'), and the mean, max and last
+            wake-up jitter in seconds.  Also the total number of cycles and overruns since the scheduler was created ('total_cycles' and
+            'total_overruns'), which are not reset.
+
+        """
+        return {
+            'cycles': self._cycles,
+            'overruns': self._overruns,
+            'skipped': self._skipped,
+            'woken': self._woken,
+            'jitter_mean': self._jitter_sum / self._cycles if self._cycles else 0,
+            'jitter_max': self._jitter_max,
+            'jitter_last': self._last_jitter,
+            'total_cycles': self._total_cycles,
+            'total_overruns': self._total_overruns,
+        }
+
+    def reset_stats(self):
+        """Resets the counters returned by stats(), except the totals."""
+        self._cycles = 0
+        self._overruns = 0
+        self._skipped = 0
+        self._woken = 0
+        self._jitter_sum = 0
+        self._jitter_max = 0
+        self._last_jitter = 0
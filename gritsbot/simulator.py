@@ -0,0 +1,360 @@
+import gritsbot.gritsbotserial as gritsbotserial
+import argparse
+import json
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+global logger
+logger = logging.getLogger('root')
+
+# Constants
+BITS_PER_BYTE = 10  # 8N1 framing
+SELECT_TIMEOUT = 0.05
+
+
+class SimulatedGritsbot:
+    """Serves the microcontroller's request/response protocol over a pseudo-terminal.
+
+    The simulated device answers requests of the form produced by request.Request.to_json_encodable(), in JSON or with the binary codec, so that
+    GritsbotSerial and the control loop can be exercised without a robot.  Responses can be delayed, jittered, dropped or split, and the device can be
+    unplugged and replugged.
+
+    If link is given, it is kept as a symlink to the current pseudo-terminal, so clients can reconnect to the same path after a replug.
+
+    Attributes:
+        motor (dict): Last motor command ({'v': ..., 'w': ...}).
+        left_led (list): Last left LED color.
+        right_led (list): Last right LED color.
+        batt_volt (float): Battery voltage reported by the device.
+        charge_status (bool): Charging status reported by the device.
+        requests (int): Number of requests received.
+        dropped (int): Number of responses dropped.
+        split (int): Number of responses split across writes.
+
+    """
+
+    def __init__(self, link=None, baud_rate=500000, latency=0.0005, jitter=0.0, drop_rate=0.0, split_rate=0.0, split_delay=0.002,
+                 codecs=('json', 'binary'), echo_seq=True, batt_volt=4.1, charge_status=False, seed=None):
+        """Creates the simulated device.
+
+        Args:
+            link (str, optional): Path of a symlink to maintain to the pseudo-terminal.
+            baud_rate (int, optional): Simulated baud rate.  Responses are delayed by the time to send each byte.  Zero disables the delay.
+            latency (float, optional): Time for the device to process a request, in seconds.
+            jitter (float, optional): Maximum uniform jitter added to or subtracted from the latency, in seconds.
+            drop_rate (float, optional): Probability that a response is never sent.
+            split_rate (float, optional): Probability that a response is sent in two writes.
+            split_delay (float, optional): Delay between the two writes of a split response, in seconds.
+            codecs (tuple, optional): Codecs reported to the host.  JSON is always understood.
+            echo_seq (bool, optional): Whether to echo the 'seq' of pipelined requests.
+            batt_volt (float, optional): Battery voltage to report.
+            charge_status (bool, optional): Charging status to report.
+            seed (int, optional): Seed for the random faults.
+
+        """
+        self._link = link
+        self._baud_rate = baud_rate
+        self._latency = latency
+        self._jitter = jitter
+        self._drop_rate = drop_rate
+        self._split_rate = split_rate
+        self._split_delay = split_delay
+        self._codecs = list(codecs)
+        self._echo_seq = echo_seq
+        self._random = random.Random(seed)
+        self._by_id = {x.iface_id: (name, x) for name, x in gritsbotserial.BINARY_INTERFACES.items()}
+
+        self.motor = {'v': 0, 'w': 0}
+        self.left_led = [0, 0, 0]
+        self.right_led = [0, 0, 0]
+        self.batt_volt = batt_volt
+        self.charge_status = charge_status
+        self.requests = 0
+        self.dropped = 0
+        self.split = 0
+
+        self._lock = threading.Lock()
+        self._master = None
+        self._slave = None
+        self._device = None
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def device(self):
+        """str: Path that clients should open (the symlink, if one was given)."""
+        return self._link if self._link else self._device
+
+    def start(self):
+        """Plugs in the device and starts serving requests."""
+        self.replug()
+        self._thread = threading.Thread(target=self._serve_task, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Unplugs the device and stops serving requests."""
+        self._stopped = True
+        self.unplug()
+        if(self._thread is not None):
+            self._thread.join()
+
+    def unplug(self, duration=None):
+        """Simulates unplugging the cable.  Clients get an I/O error on their next read or write.
+
+        Args:
+            duration (float, optional): If given, the device is replugged after this many seconds.
+
+        """
+        with self._lock:
+            if(self._master is not None):
+                os.close(self._master)
+                os.close(self._slave)
+                self._master = None
+                self._slave = None
+
+            if(self._link is not None and os.path.lexists(self._link)):
+                os.remove(self._link)
+
+        if(duration is not None):
+            timer = threading.Timer(duration, self.replug)
+            timer.daemon = True
+            timer.start()
+
+    def replug(self):
+        """Simulates plugging the cable back in, on a new pseudo-terminal."""
+        with self._lock:
+            if(self._stopped or self._master is not None):
+                return
+
+            self._master, self._slave = os.openpty()
+            tty.setraw(self._master)
+            tty.setraw(self._slave)
+            self._device = os.ttyname(self._slave)
+
+            if(self._link is not None):
+                if(os.path.lexists(self._link)):
+                    os.remove(self._link)
+                os.symlink(self._device, self._link)
+
+        logger.info('Simulated device plugged in at ({})'.format(self._device))
+
+    def handle_request(self, req):
+        """Performs a decoded request against the simulated state.
+
+        Args:
+            req (dict): Request of the form produced by request.Request.to_json_encodable().
+
+        Returns:
+            dict: The response, with one status and body per request.
+
+        """
+        statuses = []
+        bodies = []
+        bodies_in = req.get('body', [{}]*len(req['request']))
+
+        for request, iface, body in zip(req['request'], req['iface'], bodies_in):
+            status = 1
+            out = {}
+
+            if(request == 'write' and iface == 'motor'):
+                self.motor = {'v': body['v'], 'w': body['w']}
+            elif(request == 'write' and iface == 'left_led'):
+                self.left_led = list(body['rgb'])
+            elif(request == 'write' and iface == 'right_led'):
+                self.right_led = list(body['rgb'])
+            elif(request == 'read' and iface == 'batt_volt'):
+                out = {'batt_volt': self.batt_volt}
+            elif(request == 'read' and iface == 'charge_status'):
+                out = {'charge_status': self.charge_status}
+            elif(request == 'read' and iface == 'codec'):
+                out = {'codec': self._codecs}
+            else:
+                status = 0
+
+            statuses.append(status)
+            bodies.append(out)
+
+        response = {'status': statuses, 'body': bodies}
+        if(self._echo_seq and 'seq' in req):
+            response['seq'] = req['seq']
+
+        return response
+
+    def _decode_binary_request(self, payload):
+        """Decodes a binary codec request payload into the JSON form."""
+        flags = payload[0]
+        offset = 1
+        req = {'request': [], 'iface': [], 'body': []}
+
+        if(flags & gritsbotserial.BINARY_SEQ_FLAG):
+            req['seq'] = struct.unpack_from('<H', payload, offset)[0]
+            offset += 2
+
+        count = payload[offset]
+        offset += 1
+
+        for _ in range(count):
+            iface_byte = payload[offset]
+            offset += 1
+            name, desc = self._by_id[iface_byte & ~gritsbotserial.BINARY_WRITE_FLAG]
+
+            req['iface'].append(name)
+            if(iface_byte & gritsbotserial.BINARY_WRITE_FLAG):
+                fields = desc.write_format.unpack_from(payload, offset)
+                offset += desc.write_format.size
+                req['request'].append('write')
+                req['body'].append({'v': fields[0], 'w': fields[1]} if name == 'motor' else {'rgb': list(fields)})
+            else:
+                req['request'].append('read')
+                req['body'].append({})
+
+        return req
+
+    def _encode_binary_response(self, req, response):
+        """Encodes a response to a binary codec request."""
+        payload = bytearray()
+
+        if('seq' in response):
+            payload.append(gritsbotserial.BINARY_SEQ_FLAG)
+            payload.extend(struct.pack('<H', response['seq']))
+        else:
+            payload.append(0)
+
+        payload.append(len(response['status']))
+        for request, iface, status, body in zip(req['request'], req['iface'], response['status'], response['body']):
+            desc = gritsbotserial.BINARY_INTERFACES[iface]
+            if(request == 'write'):
+                payload.extend((desc.iface_id | gritsbotserial.BINARY_WRITE_FLAG, status))
+            else:
+                payload.extend((desc.iface_id, status))
+                payload.extend(desc.read_format.pack(body.get(iface, 0)))
+
+        return gritsbotserial.BINARY_HEADER.pack(gritsbotserial.BINARY_MAGIC, len(payload)) + payload + bytes([sum(payload) & 0xFF])
+
+    def _respond(self, master, data):
+        """Writes a response, applying the configured latency, baud delay and faults."""
+        delay = self._latency + self._random.uniform(-self._jitter, self._jitter)
+        if(self._baud_rate > 0):
+            delay += len(data) * BITS_PER_BYTE / self._baud_rate
+        time.sleep(max(0, delay))
+
+        if(self._random.random() < self._drop_rate):
+            self.dropped += 1
+            return
+
+        try:
+            if(self._random.random() < self._split_rate and len(data) > 1):
+                self.split += 1
+                cut = self._random.randint(1, len(data) - 1)
+                os.write(master, data[:cut])
+                time.sleep(self._split_delay)
+                os.write(master, data[cut:])
+            else:
+                os.write(master, data)
+        except OSError:
+            # Unplugged while responding
+            pass
+
+    def _serve_task(self):
+        """Reads, decodes and answers requests.  Only meant to be run by the internal thread!"""
+        json_frames = gritsbotserial.FrameBuffer()
+        binary_frames = gritsbotserial.BinaryFrameBuffer()
+        active = None
+        master = None
+
+        while(not self._stopped):
+            with self._lock:
+                if(self._master != master):
+                    # Replugged, so anything buffered belongs to the old connection
+                    master = self._master
+                    json_frames.clear()
+                    binary_frames.clear()
+                    active = None
+
+            if(master is None):
+                time.sleep(SELECT_TIMEOUT)
+                continue
+
+            try:
+                ready, _, _ = select.select([master], [], [], SELECT_TIMEOUT)
+                if(not ready):
+                    continue
+                data = os.read(master, 4096)
+            except OSError:
+                continue
+
+            # Pick the framing from the first byte of each request, since the host may switch codecs after negotiation
+            while(data):
+                if(active is None):
+                    starts = [i for i in (data.find(b'{'), data.find(bytes([gritsbotserial.BINARY_MAGIC]))) if i >= 0]
+                    if(not starts):
+                        break
+                    start = min(starts)
+                    active = json_frames if data[start] == ord('{') else binary_frames
+                    data = data[start:]
+
+                active.feed(data)
+                data = b''
+
+                frame = active.next_frame()
+                while(frame is not None):
+                    self.requests += 1
+                    try:
+                        if(active is json_frames):
+                            req = json.loads(frame.decode('ASCII'))
+                            response = self.handle_request(req)
+                            self._respond(master, json.dumps(response).encode('ASCII'))
+                        else:
+                            req = self._decode_binary_request(frame)
+                            response = self.handle_request(req)
+                            self._respond(master, self._encode_binary_response(req, response))
+                    except Exception as e:
+                        logger.warning('Simulated device could not handle request ({})'.format(frame))
+                        logger.warning(repr(e))
+                    frame = active.next_frame()
+
+                if(len(active) == 0):
+                    active = None
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-link', help='Symlink to maintain to the simulated serial device', default='/tmp/ttyGRITS0')
+    parser.add_argument('-baud_rate', type=int, help='Simulated baud rate (0 to disable the per-byte delay)', default=500000)
+    parser.add_argument('-latency', type=float, help='Response latency in seconds', default=0.0005)
+    parser.add_argument('-jitter', type=float, help='Maximum response jitter in seconds', default=0.0)
+    parser.add_argument('-drop_rate', type=float, help='Probability of dropping a response', default=0.0)
+    parser.add_argument('-split_rate', type=float, help='Probability of splitting a response', default=0.0)
+    parser.add_argument('-unplug_every', type=float, help='Unplug the device periodically (seconds)', default=None)
+    parser.add_argument('-unplug_for', type=float, help='How long each unplug lasts (seconds)', default=1.0)
+
+    args = parser.parse_args()
+
+    device = SimulatedGritsbot(link=args.link, baud_rate=args.baud_rate, latency=args.latency, jitter=args.jitter,
+                               drop_rate=args.drop_rate, split_rate=args.split_rate)
+    device.start()
+    print('Simulated gritsbot at ({})'.format(device.device))
+
+    try:
+        while True:
+            if(args.unplug_every is None):
+                time.sleep(1)
+            else:
+                time.sleep(args.unplug_every)
+                logger.info('Unplugging simulated device for ({}) seconds'.format(args.unplug_for))
+                device.unplug(duration=args.unplug_for)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import json
+import numbers
+
+
+class StatusPublisher:
+    """Publishes status data when it changes, and otherwise at a heartbeat.
+
+    Numeric fields may have a deadband, so noise (e.g., in the battery voltage) doesn't count as a change.  The serialized payload is cached and only
+    rebuilt when the data differ from what was last serialized.
+
+    Attributes:
+        _put (function): Called with the link and the serialized payload to publish.
+        _link (str): The link to publish on.
+        _heartbeat (float): Maximum time between publishes in seconds.
+        _deadband (dict): Maps field names to the smallest change that counts as a change.
+        _published_data (dict): The data as last published, or None if nothing has been published.
+        _published_time (float): When the data were last published.
+        _payload_data (dict): The data that _payload was serialized from.
+        _payload (str): The cached serialized payload.
+        _published (int): Number of publishes.
+        _suppressed (int): Number of updates that were not published.
+
+    """
+
+    def __init__(self, put, link, heartbeat=1, deadband=None):
+        """Creates the status publisher.
+
+        Args:
+            put (function): Called with the link and the serialized payload to publish (e.g., a vizier node's put).
+            link (str): The link to publish on.
+            heartbeat (float, optional): Maximum time between publishes in seconds.
+            deadband (dict, optional): Maps numeric field names to the smallest change that counts as a change.
+
+        Examples:
+            >>> StatusPublisher(robot_node.put, '1/status', heartbeat=1, deadband={'batt_volt': 0.02})
+
+        """
+        self._put = put
+        self._link = link
+        self._heartbeat = heartbeat
+        self._deadband = dict(deadband) if deadband else {}
+
+        self._published_data = None
+        self._published_time = None
+        self._payload_data = None
+        self._payload = None
+        self._published = 0
+        self._suppressed = 0
+
+    def changed(self, data):
+        """Returns whether data differ from the last published data by more than the deadbands.
+
+        Args:
+            data (dict): The current status data.
+
+        Returns:
+            bool: Whether the data have changed.
+
+        """
+        last = self._published_data
+        if(last is None or last.keys() != data.keys()):
+            return True
+
+        for key, value in data.items():
+            old = last[key]
+            deadband = self._deadband.get(key)
+            if(deadband is not None and isinstance(value, numbers.Number) and isinstance(old, numbers.Number)
+               and not isinstance(value, bool)):
+                if(abs(value - old) > deadband):
+                    return True
+            elif(value != old):
+                return True
+
+        return False
+
+    def payload(self, data):
+        """Returns the serialized payload for data, reusing the cached payload if the data haven't changed.
+
+        Args:
+            data (dict): The current status data.
+
+        Returns:
+            str: The JSON payload.
+
+        """
+        if(self._payload is None or data != self._payload_data):
+            self._payload_data = dict(data)
+            self._payload = json.dumps(data)
+
+        return self._payload
+
+    def update(self, data, now):
+        """Publishes data if they have changed or the heartbeat is due.
+
+        Args:
+            data (dict): The current status data.
+            now (float): The current monotonic time.
+
+        Returns:
+            bool: Whether the data were published.
+
+        """
+        if(not self.changed(data) and now - self._published_time < self._heartbeat):
+            self._suppressed += 1
+            return False
+
+        self._put(self._link, self.payload(data))
+        self._published_data = dict(data)
+        self._published_time = now
+        self._published += 1
+        return True
+
+    def stats(self):
+        """Returns the number of updates published ('published') and suppressed ('suppressed')."""
+        return {'published': self._published, 'suppressed': self._suppressed}
@@ -0,0 +1,196 @@
+import collections
+import numbers
+import time
+
+# Constants
+OFFSET_WINDOW = 60
+
+
+class ClockOffset:
+    """Estimates the offset from a remote clock to the local monotonic clock, from one-way messages.
+
+    Each message stamped with its remote send time gives local receive time - remote send time = offset + transit delay.  The smallest such value
+    over a sliding window is taken as the offset, so the fastest recent delivery is treated as having had no delay.  Latencies measured against the
+    estimate are therefore relative to the fastest delivery, which for a local network is within a millisecond or so of the true latency.  The
+    window lets the estimate follow drift between the clocks.
+
+    Attributes:
+        _window (float): Length of the sliding window in seconds.
+        _samples (collections.deque): (local receive time, sample) pairs with increasing samples, so the first is the minimum of the window.
+
+    """
+
+    def __init__(self, window=OFFSET_WINDOW):
+        """Creates the estimator.
+
+        Args:
+            window (float, optional): Length of the sliding window in seconds.
+
+        """
+        self._window = window
+        self._samples = collections.deque()
+
+    def add(self, sent, received):
+        """Adds a message to the estimate.
+
+        Args:
+            sent (float): Remote time at which the message was sent.
+            received (float): Local monotonic time at which the message was received.
+
+        Returns:
+            float: The current estimate of the offset.
+
+        """
+        sample = received - sent
+
+        while(self._samples and self._samples[-1][1] >= sample):
+            self._samples.pop()
+        self._samples.append((received, sample))
+
+        while(received - self._samples[0][0] > self._window):
+            self._samples.popleft()
+
+        return self._samples[0][1]
+
+    @property
+    def offset(self):
+        """The current estimate of the offset, or None if there are no samples."""
+        return self._samples[0][1] if self._samples else None
+
+
+class CommandTracer:
+    """Traces commands from the matlab_api link to the microcontroller.
+
+    Commands may carry the time they were sent ('t', in seconds on the sender's clock, e.g., time.time()) and a sequence number ('seq').  Both are
+    optional.  Commands may come from several links (e.g., matlab_api and a broadcast link), each with its own sender, so sequence numbers and
+    clock offsets are tracked per link.  The tracer records, in Metrics:
+
+    * command_transit: From sending to receipt by the robot (only for commands with 't').
+    * command_queue: From receipt to being taken by the control loop.
+    * command_write: From being taken to the serial write.
+    * command_ack: From the serial write to the microcontroller's response.
+    * command_age: From sending (or receipt, without 't') to the microcontroller's response.
+
+    Commands older than a maximum age when taken are rejected, so that a robot never acts on a stale command after a network stall.
+
+    Attributes:
+        _metrics (Metrics): Where the latencies are recorded.
+        _max_age (float): Commands older than this when taken are rejected, or None to accept every command.
+        _clock (function): Returns the current monotonic time.
+        _window (float): Length of the window for the clock offset estimates in seconds.
+        _links (dict): Maps each link to [sequence number of its last command with one (or None), ClockOffset from its sender's clock].
+        _current (tuple): Origin (in robot time) and take time of the command accepted last, until it is written.
+        _accepted (int): Number of commands accepted.
+        _rejected (int): Number of commands rejected for being too old.
+        _skipped (int): Number of sequence numbers skipped (e.g., superseded before being taken, or lost).
+        _reordered (int): Number of commands with a sequence number at or below the last one.
+
+    """
+
+    def __init__(self, metrics, max_age=None, window=OFFSET_WINDOW, clock=time.monotonic):
+        """Creates the tracer.
+
+        Args:
+            metrics (Metrics): Where the latencies are recorded.
+            max_age (float, optional): Commands older than this many seconds when taken are rejected.  Defaults to accepting every command.
+            window (float, optional): Length of the window for the clock offset estimate in seconds.
+            clock (function, optional): Returns the current monotonic time.  Must be the clock the receive times and serial write times come from.
+
+        Examples:
+            >>> tracer = CommandTracer(loop_metrics, max_age=0.1)
+            >>> if(tracer.accept(input_msg, inputs.received_time, link='matlab_api')):
+            ...     tracer.written(serial.submit(msg))
+
+        """
+        self._metrics = metrics
+        self._max_age = max_age
+        self._clock = clock
+        self._window = window
+        self._links = {}
+        self._current = None
+
+        self._accepted = 0
+        self._rejected = 0
+        self._skipped = 0
+        self._reordered = 0
+
+    def accept(self, msg, received, link=None):
+        """Records that a command was taken by the control loop, and checks its age.
+
+        Args:
+            msg (dict): The decoded command.
+            received (float): When the command was received, on the tracer's clock.
+            link (str, optional): The link the command came from.  Sequence numbers and send times are only compared with earlier commands from
+                the same link.
+
+        Returns:
+            bool: Whether the command should be acted on.
+
+        """
+        now = self._clock()
+        self._current = None
+
+        state = self._links.get(link)
+        if(state is None):
+            state = self._links[link] = [None, ClockOffset(self._window)]
+
+        seq = msg.get('seq')
+        if(isinstance(seq, int)):
+            last_seq = state[0]
+            if(last_seq is not None):
+                if(seq > last_seq):
+                    self._skipped += seq - last_seq - 1
+                else:
+                    self._reordered += 1
+            state[0] = seq
+
+        sent = msg.get('t')
+        if(isinstance(sent, numbers.Real) and not isinstance(sent, bool)):
+            origin = sent + state[1].add(sent, received)
+            self._metrics.observe('command_transit', received - origin)
+        else:
+            origin = received
+
+        if(self._max_age is not None and now - origin > self._max_age):
+            self._rejected += 1
+            return False
+
+        self._metrics.observe('command_queue', now - received)
+        self._current = (origin, now)
+        self._accepted += 1
+        return True
+
+    def written(self, future):
+        """Records that the command accepted last was written to the microcontroller.
+
+        The write is timed from the future's write_time, when the request actually went to the serial port, rather than from when submit returned.
+        Without pipelining, submit only returns once the response has arrived, so timing from then would count the whole round trip as the write.
+
+        Args:
+            future (concurrent.futures.Future): The serial request carrying the command (e.g., from GritsbotSerial.submit).  The ack is recorded
+                when it completes.
+
+        """
+        if(self._current is None):
+            return
+
+        write_time = getattr(future, 'write_time', None)
+        if(write_time is None):
+            write_time = self._clock()
+        origin, taken = self._current
+        self._current = None
+        self._metrics.observe('command_write', write_time - taken)
+
+        def acked(f):
+            if(f.cancelled() or f.exception() is not None or f.result() is None):
+                return
+            ack = self._clock()
+            self._metrics.observe('command_ack', ack - write_time)
+            self._metrics.observe('command_age', ack - origin)
+
+        future.add_done_callback(acked)
+
+    def stats(self):
+        """Returns the number of commands accepted, rejected, skipped and reordered, and the clock offset estimate of each link ('offset')."""
+        return {'accepted': self._accepted, 'rejected': self._rejected, 'skipped': self._skipped, 'reordered': self._reordered,
+                'offset': {link: state[1].offset for link, state in self._links.items()}}
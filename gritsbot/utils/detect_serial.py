@@ -1,8 +1,171 @@
 import serial.tools.list_ports
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+global logger
+logger = logging.getLogger('root')
+
+# Constants
+DEFAULT_PATTERN = 'ttyACM'
+POLL_INTERVAL = 0.5
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def find_port(vid=None, pid=None, serial_number=None, pattern=DEFAULT_PATTERN):
+    """Finds a serial port by USB vendor ID, product ID and serial number.
+
+    Any criterion that is None is ignored.  If no criteria are given, the first port whose device path contains pattern is returned.
+
+    Args:
+        vid (int, optional): USB vendor ID.
+        pid (int, optional): USB product ID.
+        serial_number (str, optional): USB serial number.
+        pattern (str, optional): Substring of the device path to match when no USB criteria are given.
+
+    Returns:
+        str: The device path of the port, or None if no port matches.
+
+    Examples:
+        >>> find_port(vid=0x16c0, pid=0x0483)
+        '/dev/ttyACM0'
+
+    """
+    by_usb = vid is not None or pid is not None or serial_number is not None
+
+    for port in sorted(serial.tools.list_ports.comports(), key=lambda x: x.device):
+        if(by_usb):
+            if((vid is None or port.vid == vid) and (pid is None or port.pid == pid)
+               and (serial_number is None or port.serial_number == serial_number)):
+                return port.device
+        elif(pattern in port.device):
+            return port.device
+
+    return None
+
+
+class DeviceWatcher:
+    """Watches a directory (by default, /dev) for devices being added or removed.
+
+    Uses inotify where available, so events are reported as they happen; otherwise, the directory is polled.  The callback is called from the
+    watcher's thread with the name of the entry and whether it was added (True) or removed (False).  Attribute changes are reported as additions,
+    since udev may only make a new device accessible after creating it.
+
+    Attributes:
+        _callback (function): Called with (name, added) for each event.
+        _directory (str): The directory to watch.
+        _poll_interval (float): Interval for polling, and for checking whether the watcher has been stopped.
+        _thread (threading.Thread): Runs the watch task.
+        _stopped (bool): Whether the watcher has been stopped.
+
+    """
+
+    def __init__(self, callback, directory='/dev', poll_interval=POLL_INTERVAL):
+        self._callback = callback
+        self._directory = directory
+        self._poll_interval = poll_interval
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """Starts watching the directory."""
+        self._thread = threading.Thread(target=self._watch_task, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops watching the directory."""
+        self._stopped = True
+        if(self._thread is not None and self._thread is not threading.current_thread()):
+            self._thread.join()
+
+    def _inotify_fd(self):
+        """Returns a non-blocking inotify descriptor watching the directory, or None if inotify is unavailable."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if(fd < 0):
+                return None
+
+            mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+            if(libc.inotify_add_watch(fd, os.fsencode(self._directory), mask) < 0):
+                os.close(fd)
+                return None
+
+            return fd
+        except Exception:
+            return None
+
+    def _watch_task(self):
+        """Reports events to the callback.  Only meant to be run by the internal thread!"""
+        fd = self._inotify_fd()
+
+        if(fd is None):
+            logger.info('inotify unavailable; polling ({}) for devices.'.format(self._directory))
+            self._poll_task()
+            return
+
+        try:
+            while(not self._stopped):
+                ready, _, _ = select.select([fd], [], [], self._poll_interval)
+                if(not ready):
+                    continue
+
+                try:
+                    data = os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+
+                offset = 0
+                while(offset + INOTIFY_EVENT.size <= len(data)):
+                    _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                    name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0').decode()
+                    offset += INOTIFY_EVENT.size + length
+                    self._callback(name, not (mask & (IN_DELETE | IN_MOVED_FROM)))
+        finally:
+            os.close(fd)
+
+    def _poll_task(self):
+        """Reports events by diffing the directory listing."""
+        previous = set(os.listdir(self._directory))
+
+        while(not self._stopped):
+            time.sleep(self._poll_interval)
+            current = set(os.listdir(self._directory))
+
+            for name in current - previous:
+                self._callback(name, True)
+            for name in previous - current:
+                self._callback(name, False)
+
+            previous = current
 
 
 def main():
-    print([comport.device for comport in serial.tools.list_ports.comports() if 'ttyACM' in comport.device][0])
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-vid', type=lambda x: int(x, 0), help='USB vendor ID of the serial device', default=None)
+    parser.add_argument('-pid', type=lambda x: int(x, 0), help='USB product ID of the serial device', default=None)
+    parser.add_argument('-serial_number', help='USB serial number of the serial device', default=None)
+
+    args = parser.parse_args()
+
+    print(find_port(vid=args.vid, pid=args.pid, serial_number=args.serial_number))
+
 
 if __name__ == '__main__':
     main()
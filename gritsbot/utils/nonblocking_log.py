@@ -0,0 +1,211 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Constants
+SUMMARY_INTERVAL = 5
+MAX_QUEUE_SIZE = 1000
+
+
+class RateLimitFilter(logging.Filter):
+    """Collapses repeated log messages from the same call site.
+
+    Only messages at or above a level are limited, so periodic informational output is untouched.  The first message from a call site (logger,
+    level, file and line) passes.  Further messages from that call site within interval seconds are suppressed and counted; the next one after the
+    interval passes with a summary of how many were suppressed.  Messages that are formatted with different values (e.g., a malformed response)
+    still count as repeats, since they come from the same call site.  So that the end of a burst is reported too, flush() should be called every
+    interval; it returns a summary for each call site whose interval has ended with messages suppressed.
+
+    Attributes:
+        _interval (float): Length of the suppression interval in seconds.
+        _level (int): Messages below this level are never suppressed.
+        _clock (function): Returns the current monotonic time.
+        _sites (dict): Maps call sites to the start of their interval, the number of messages suppressed in it and the last of them.
+        _lock (threading.Lock): Protects the call sites, since messages may come from several threads.
+
+    """
+
+    def __init__(self, interval=SUMMARY_INTERVAL, level=logging.WARNING, clock=time.monotonic):
+        """Creates the filter.
+
+        Args:
+            interval (float, optional): Length of the suppression interval in seconds.
+            level (int, optional): Messages below this level are never suppressed.
+            clock (function, optional): Returns the current monotonic time.
+
+        """
+        super().__init__()
+        self._interval = interval
+        self._level = level
+        self._clock = clock
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if(record.levelno < self._level):
+            return True
+
+        site = (record.name, record.levelno, record.pathname, record.lineno)
+        now = self._clock()
+
+        with self._lock:
+            entry = self._sites.get(site)
+
+            if(entry is not None and now - entry[0] < self._interval):
+                entry[1] += 1
+                entry[2] = record
+                return False
+
+            self._sites[site] = [now, 0, None]
+
+        if(entry is not None and entry[1] > 0):
+            record.msg = '{0} ({1} more occurrences in the last {2:.1f} s)'.format(record.getMessage(), entry[1], now - entry[0])
+            record.args = None
+
+        return True
+
+    def flush(self, force=False):
+        """Summarizes the messages suppressed at each call site whose interval has ended, and starts a new interval there.
+
+        Args:
+            force (bool, optional): Whether to summarize every call site with suppressed messages, even if its interval hasn't ended (e.g., at
+                shutdown).
+
+        Returns:
+            list: A record for each summary, based on the last message suppressed at the call site.
+
+        """
+        now = self._clock()
+        summaries = []
+
+        with self._lock:
+            for entry in self._sites.values():
+                if(entry[1] > 0 and (force or now - entry[0] >= self._interval)):
+                    summary = logging.makeLogRecord(entry[2].__dict__)
+                    summary.msg = '{0} (repeated {1} times in the last {2:.1f} s)'.format(entry[2].getMessage(), entry[1], now - entry[0])
+                    summary.args = None
+                    summaries.append(summary)
+                    entry[0], entry[1], entry[2] = now, 0, None
+
+        return summaries
+
+    def pending(self):
+        """Returns the number of suppressed messages not yet summarized, for each call site with any.
+
+        Returns:
+            dict: Maps (logger name, level, file, line) to the number of suppressed messages.
+
+        """
+        with self._lock:
+            return {site: entry[1] for site, entry in self._sites.items() if entry[1] > 0}
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking or raising when the queue is full.
+
+    Attributes:
+        dropped (int): Number of records dropped because the queue was full.
+
+    """
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class NonBlockingLogging:
+    """Moves the output of loggers to background threads.
+
+    Each logger's handlers are replaced by a queue handler, with a rate limit, and the original handlers are run by a queue listener in a background
+    thread.  Logging on the hot path then only costs formatting the message and a put to a queue.  Every interval, and when stopped, the messages
+    suppressed by the rate limits are summarized.
+
+    Attributes:
+        _loggers (list): (logger, original handlers, queue handler, listener, rate limit) for each logger that had handlers.
+        _interval (float): Interval for collapsing repeated messages in seconds.
+        _stop (threading.Event): Set to stop the flush thread.
+        _thread (threading.Thread): Summarizes suppressed messages every interval.
+
+    """
+
+    def __init__(self, loggers, interval=SUMMARY_INTERVAL, max_queue_size=MAX_QUEUE_SIZE):
+        """Moves the output of loggers to background threads.
+
+        Loggers without handlers of their own are left alone; their records propagate to an ancestor (e.g., the root logger), which should then be
+        passed too.
+
+        Args:
+            loggers (list): Loggers whose output to move.
+            interval (float, optional): Interval for collapsing repeated messages in seconds.
+            max_queue_size (int, optional): Number of records queued before records are dropped.
+
+        Examples:
+            >>> logs = NonBlockingLogging([logging.getLogger(), log.get_logger()], interval=5)
+            >>> logs.stop()
+
+        """
+        self._interval = interval
+        self._loggers = []
+
+        seen = set()
+        for logger in loggers:
+            if(id(logger) in seen or not logger.handlers):
+                continue
+            seen.add(id(logger))
+
+            handlers = list(logger.handlers)
+            # Each handler has its own rate limit, so a record passing through several handlers (e.g., by propagation) counts once at each
+            rate_limit = RateLimitFilter(interval)
+            queue_handler = DroppingQueueHandler(queue.Queue(max_queue_size))
+            queue_handler.addFilter(rate_limit)
+            listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+            listener.start()
+
+            self._loggers.append((logger, handlers, queue_handler, listener, rate_limit))
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_task, daemon=True)
+        self._thread.start()
+
+        atexit.register(self.stop)
+
+    def _flush(self, loggers, force=False):
+        for _, _, queue_handler, _, rate_limit in loggers:
+            for summary in rate_limit.flush(force=force):
+                queue_handler.enqueue(queue_handler.prepare(summary))
+
+    def _flush_task(self):
+        while(not self._stop.wait(self._interval)):
+            self._flush(self._loggers)
+
+    def stats(self):
+        """Returns the number of records dropped ('dropped') and suppressed messages not yet summarized ('suppressed')."""
+        return {'dropped': sum(x[2].dropped for x in self._loggers), 'suppressed': sum(sum(x[4].pending().values()) for x in self._loggers)}
+
+    def stop(self):
+        """Summarizes suppressed messages, writes any queued records and gives the loggers back their original handlers."""
+        self._stop.set()
+        if(self._thread is not threading.current_thread()):
+            self._thread.join()
+
+        loggers, self._loggers = self._loggers, []
+        self._flush(loggers, force=True)
+
+        for logger, handlers, queue_handler, listener, _ in loggers:
+            listener.stop()
+            logger.removeHandler(queue_handler)
+            for handler in handlers:
+                logger.addHandler(handler)
@@ -0,0 +1,218 @@
+import argparse
+import concurrent.futures
+import getpass
+import json
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_PARALLELISM = 16
+DEFAULT_TIMEOUT = 30
+DEFAULT_PERSIST = 600
+DEFAULT_CONTROL_DIR = os.path.join(os.path.expanduser('~'), '.ssh', 'gritsbot-cm')
+OUTPUT_LINES = 3
+
+
+def _ssh_base(host, user='pi', password=None, control_dir=DEFAULT_CONTROL_DIR, connect_timeout=5):
+    """Builds the ssh command line options shared by every connection to a robot, up to (not including) the destination."""
+    cmd = ['ssh', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no', '-o', 'LogLevel=ERROR',
+           '-o', 'ConnectTimeout={}'.format(connect_timeout),
+           '-o', 'ControlPath={}'.format(os.path.join(control_dir, '%r@%h:%p'))]
+
+    if(password is not None):
+        cmd = ['sshpass', '-e'] + cmd
+
+    return cmd
+
+
+def master_command(host, user='pi', password=None, control_dir=DEFAULT_CONTROL_DIR, persist=DEFAULT_PERSIST, connect_timeout=5):
+    """Builds the ssh command line that opens a master connection to a robot in the background.
+
+    The master stays up for persist seconds after its last use.  It backgrounds itself once authenticated, so it must be run without capturing its
+    output: the background process keeps any pipe it was given open.
+
+    Args:
+        host (str): Address of the robot.
+        user (str, optional): User to log in as.
+        password (str, optional): Password to log in with (passed to sshpass through the environment, not the command line).
+        control_dir (str, optional): Directory for the master connections' sockets.
+        persist (int, optional): Time in seconds that an idle master connection stays up.
+        connect_timeout (int, optional): Time in seconds to wait for the connection.
+
+    Returns:
+        list: The command line.
+
+    """
+    return _ssh_base(host, user=user, password=password, control_dir=control_dir, connect_timeout=connect_timeout) + \
+        ['-o', 'ControlMaster=yes', '-o', 'ControlPersist={}'.format(persist), '-N', '-f', '{0}@{1}'.format(user, host)]
+
+
+def check_command(host, user='pi', control_dir=DEFAULT_CONTROL_DIR, **kwargs):
+    """Builds the ssh command line that checks whether a master connection to a robot is up (exit status 0 if so)."""
+    return ['ssh', '-o', 'ControlPath={}'.format(os.path.join(control_dir, '%r@%h:%p')), '-O', 'check', '{0}@{1}'.format(user, host)]
+
+
+def ssh_command(host, command, user='pi', password=None, control_dir=DEFAULT_CONTROL_DIR, connect_timeout=5):
+    """Builds the ssh command line to run a command on a robot.
+
+    Connections are multiplexed: the command goes over the robot's master connection (see master_command), if it is up, skipping the TCP and SSH
+    handshakes and authentication.  Otherwise, it connects on its own.  The command never opens a master itself, so its output can be captured.
+
+    Args:
+        host (str): Address of the robot.
+        command (str): The command to run.
+        user (str, optional): User to log in as.
+        password (str, optional): Password to log in with (passed to sshpass through the environment, not the command line).
+        control_dir (str, optional): Directory for the master connections' sockets.
+        connect_timeout (int, optional): Time in seconds to wait for the connection.
+
+    Returns:
+        list: The command line.
+
+    """
+    return _ssh_base(host, user=user, password=password, control_dir=control_dir, connect_timeout=connect_timeout) + \
+        ['-o', 'ControlMaster=no', '{0}@{1}'.format(user, host), command]
+
+
+def open_master(host, timeout=DEFAULT_TIMEOUT, password=None, env=None, **kwargs):
+    """Opens a master connection to a robot, unless one is already up.
+
+    Args:
+        host (str): Address of the robot.
+        timeout (float, optional): Time in seconds to wait for the master to be up.
+        password (str, optional): Password to log in with.
+        env (dict, optional): Environment for ssh (e.g., with SSHPASS).
+        **kwargs: Passed to master_command.
+
+    Returns:
+        bool: Whether a master connection is up.
+
+    """
+    try:
+        check = subprocess.run(check_command(host, **kwargs), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               timeout=timeout)
+        if(check.returncode == 0):
+            return True
+
+        master = subprocess.run(master_command(host, password=password, **kwargs), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, timeout=timeout, env=env)
+        return master.returncode == 0
+    except (subprocess.TimeoutExpired, OSError):
+        return False
+
+
+def run_one(robot_id, host, command, timeout=DEFAULT_TIMEOUT, password=None, **kwargs):
+    """Runs a command on one robot.
+
+    Args:
+        robot_id (str): ID of the robot.
+        host (str): Address of the robot.
+        command (str): The command to run.
+        timeout (float, optional): Time in seconds after which the command is killed, including opening the master connection.
+        password (str, optional): Password to log in with.
+        **kwargs: Passed to ssh_command (e.g., user), and to master_command (which also takes persist).
+
+    Returns:
+        dict: The robot's ID ('id') and address ('host'), the exit status ('status', None if it timed out or couldn't be run), the time taken in
+        seconds ('time') and the combined output ('output').
+
+    """
+    env = None
+    if(password is not None):
+        env = dict(os.environ, SSHPASS=password)
+
+    start = time.monotonic()
+    # If the master can't be opened, the command connects on its own and reports why it failed
+    open_master(host, timeout=timeout, password=password, env=env, **kwargs)
+    kwargs.pop('persist', None)
+
+    try:
+        result = subprocess.run(ssh_command(host, command, password=password, **kwargs), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=max(0, timeout - (time.monotonic() - start)), env=env)
+        status = result.returncode
+        output = result.stdout.decode(errors='replace')
+    except subprocess.TimeoutExpired as e:
+        status = None
+        output = (e.output or b'').decode(errors='replace') + '[timed out after {} s]'.format(timeout)
+    except OSError as e:
+        status = None
+        output = repr(e)
+
+    return {'id': robot_id, 'host': host, 'status': status, 'time': time.monotonic() - start, 'output': output}
+
+
+def run_fleet(id_to_ip, command, parallelism=DEFAULT_PARALLELISM, **kwargs):
+    """Runs a command on many robots, at most parallelism at a time.
+
+    Args:
+        id_to_ip (dict): Maps robot IDs to addresses.
+        command (str): The command to run.
+        parallelism (int, optional): Maximum number of robots to run the command on at once.
+        **kwargs: Passed to run_one (e.g., timeout, password, user).
+
+    Returns:
+        list: The result of each robot (see run_one), sorted by ID.
+
+    Examples:
+        >>> results = run_fleet({'1': '192.168.1.11', '2': '192.168.1.12'}, 'uptime', parallelism=8, timeout=10)
+        >>> print(format_results(results))
+
+    """
+    control_dir = kwargs.get('control_dir', DEFAULT_CONTROL_DIR)
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        futures = [executor.submit(run_one, robot_id, host, command, **kwargs) for robot_id, host in id_to_ip.items()]
+        results = [f.result() for f in futures]
+
+    return sorted(results, key=lambda x: (len(x['id']), x['id']))
+
+
+def format_results(results, lines=OUTPUT_LINES):
+    """Formats results as a table with one row per robot, followed by a summary.
+
+    Args:
+        results (list): Results from run_fleet.
+        lines (int, optional): Number of lines of output to show for each robot (the last ones).
+
+    Returns:
+        str: The table.
+
+    """
+    rows = ['{0:>4} {1:>16} {2:>7} {3:>7}  {4}'.format('id', 'host', 'status', 'time', 'output')]
+    for r in results:
+        output = ' | '.join(r['output'].strip().splitlines()[-lines:]) if lines > 0 else ''
+        status = 'timeout' if r['status'] is None else r['status']
+        rows.append('{0:>4} {1:>16} {2:>7} {3:>6.2f}s  {4}'.format(r['id'], r['host'], status, r['time'], output))
+
+    failed = [r['id'] for r in results if r['status'] != 0]
+    rows.append('{0} of {1} succeeded{2}'.format(len(results) - len(failed), len(results),
+                                                 '; failed: {}'.format(', '.join(failed)) if failed else ''))
+    return '\n'.join(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a command on robots over SSH, in parallel')
+    parser.add_argument('hosts', help='JSON file mapping robot IDs to addresses (e.g., the output of get_ip_by_mac -o)')
+    parser.add_argument('command', help='Command to run on each robot')
+    parser.add_argument('-j', type=int, help='Maximum number of robots to run the command on at once', default=DEFAULT_PARALLELISM)
+    parser.add_argument('-timeout', type=float, help='Time in seconds after which the command is killed on a robot', default=DEFAULT_TIMEOUT)
+    parser.add_argument('-user', help='User to log in as', default='pi')
+    parser.add_argument('-ask_password', action='store_true', help='Ask for a password (otherwise keys or existing connections are used)')
+
+    args = parser.parse_args()
+
+    with open(args.hosts, 'r') as f:
+        id_to_ip = json.load(f)
+
+    password = getpass.getpass('Enter secrets for robots: ') if args.ask_password else None
+    results = run_fleet(id_to_ip, args.command, parallelism=args.j, timeout=args.timeout, user=args.user, password=password)
+    print(format_results(results))
+
+    if(any(r['status'] != 0 for r in results)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
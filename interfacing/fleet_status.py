@@ -0,0 +1,228 @@
+import argparse
+import json
+import math
+import threading
+import time
+import logging
+import numpy as np
+
+global logger
+logger = logging.getLogger('root')
+
+DEFAULT_STALE_AGE = 3
+DEFAULT_LOW_VOLTAGE = 3.7
+
+# Loop metrics kept for each robot, as (metric, statistic) from the robot's metrics link
+METRICS = (('cycle', 'p99'), ('command_age', 'p99'), ('serial_roundtrip', 'p99'))
+
+
+class FleetStatusTable:
+    """Latest status of every robot, in arrays indexed by robot.
+
+    Each field is a NumPy array with one entry per robot, so fleet queries (e.g., every robot under 3.7 V) are vectorized comparisons rather than
+    loops over dicts, and an update is a dict lookup and an array store.  Missing values are NaN.
+
+    Attributes:
+        ids (list): Robot IDs, in row order.
+        _rows (dict): Maps robot IDs to rows.
+        _lock (threading.Lock): Protects the arrays, since updates come from the node's threads.
+        batt_volt (numpy.ndarray): Battery voltage of each robot.
+        charge_status (numpy.ndarray): Whether each robot is charging.
+        last_seen (numpy.ndarray): Wall time of each robot's last status message.
+        metrics (dict): Maps names (e.g., 'cycle_p99') to arrays of loop metrics.
+
+    """
+
+    def __init__(self, robot_ids):
+        """Creates an empty table.
+
+        Args:
+            robot_ids (iterable): IDs of the robots.
+
+        Examples:
+            >>> table = FleetStatusTable(mac_list.values())
+            >>> table.update_status('1', {'batt_volt': 3.6, 'charge_status': False})
+            >>> table.below('batt_volt', 3.7)
+            ['1']
+
+        """
+        self.ids = sorted(set(robot_ids), key=lambda x: (len(x), x))
+        self._rows = {robot_id: i for i, robot_id in enumerate(self.ids)}
+        self._lock = threading.Lock()
+
+        n = len(self.ids)
+        self.batt_volt = np.full(n, np.nan)
+        self.charge_status = np.zeros(n, dtype=bool)
+        self.last_seen = np.full(n, np.nan)
+        self.metrics = {'{0}_{1}'.format(*x): np.full(n, np.nan) for x in METRICS}
+
+    def update_status(self, robot_id, status, now=None):
+        """Stores a robot's status message.
+
+        Args:
+            robot_id (str): ID of the robot.
+            status (dict): The decoded status message.
+            now (float, optional): Wall time of the message.  Defaults to the current time.
+
+        Returns:
+            bool: Whether the robot is in the table.
+
+        """
+        row = self._rows.get(robot_id)
+        if(row is None):
+            return False
+
+        with self._lock:
+            if('batt_volt' in status):
+                self.batt_volt[row] = status['batt_volt']
+            if('charge_status' in status):
+                self.charge_status[row] = bool(status['charge_status'])
+            self.last_seen[row] = time.time() if now is None else now
+
+        return True
+
+    def update_metrics(self, robot_id, snapshot):
+        """Stores a robot's loop metrics.
+
+        Args:
+            robot_id (str): ID of the robot.
+            snapshot (dict): The decoded metrics message (see gritsbot.metrics.Metrics.snapshot).
+
+        Returns:
+            bool: Whether the robot is in the table.
+
+        """
+        row = self._rows.get(robot_id)
+        if(row is None):
+            return False
+
+        with self._lock:
+            for metric, statistic in METRICS:
+                if(metric in snapshot):
+                    self.metrics['{0}_{1}'.format(metric, statistic)][row] = snapshot[metric][statistic]
+
+        return True
+
+    def _select(self, mask):
+        return [self.ids[i] for i in np.flatnonzero(mask)]
+
+    def below(self, field, value):
+        """Returns the IDs of the robots whose field (e.g., 'batt_volt' or 'cycle_p99') is below a value.  Robots without a value are left out."""
+        column = self.batt_volt if field == 'batt_volt' else self.metrics[field]
+        with self._lock:
+            return self._select(column < value)
+
+    def above(self, field, value):
+        """Returns the IDs of the robots whose field is above a value.  Robots without a value are left out."""
+        column = self.batt_volt if field == 'batt_volt' else self.metrics[field]
+        with self._lock:
+            return self._select(column > value)
+
+    def charging(self):
+        """Returns the IDs of the robots that are charging."""
+        with self._lock:
+            return self._select(self.charge_status)
+
+    def stale(self, max_age, now=None):
+        """Returns the IDs of the robots not heard from in max_age seconds, including those never heard from."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._select(~(now - self.last_seen <= max_age))
+
+    def snapshot(self, now=None):
+        """Returns the whole table as one compact, column-oriented dict, with missing values as None.
+
+        Args:
+            now (float, optional): Wall time to compute ages from.  Defaults to the current time.
+
+        Returns:
+            dict: The robot IDs ('ids'), and a list with one entry per robot for each field.  Ages are in seconds.
+
+        """
+        now = time.time() if now is None else now
+
+        def column(values):
+            return [None if math.isnan(x) else round(x, 6) for x in values.tolist()]
+
+        with self._lock:
+            result = {
+                'time': now,
+                'ids': self.ids,
+                'batt_volt': column(self.batt_volt),
+                'charge_status': self.charge_status.tolist(),
+                'age': column(now - self.last_seen),
+            }
+            for name, values in self.metrics.items():
+                result[name] = column(values)
+
+        return result
+
+
+def create_node_descriptor(robot_ids):
+    """Returns a node descriptor for the aggregator, requesting every robot's status and metrics links.
+
+    Args:
+        robot_ids (iterable): IDs of the robots.
+
+    Returns:
+        dict: A node descriptor of the vizier format.
+
+    """
+    requests = []
+    for robot_id in robot_ids:
+        requests.append({'link': robot_id + '/status', 'type': 'DATA', 'required': False})
+        requests.append({'link': robot_id + '/metrics', 'type': 'DATA', 'required': False})
+
+    return {'end_point': 'fleet_status', 'links': {'/snapshot': {'type': 'DATA'}}, 'requests': requests}
+
+
+def main():
+    # Imported here, so that the table can be used (e.g., tested) without vizier
+    import vizier.node as node
+    import vizier.log as log
+    global logger
+    logger = log.get_logger()
+
+    parser = argparse.ArgumentParser(description='Keeps the latest status of every robot and publishes it as one snapshot')
+    parser.add_argument('mac_list', help='Path to JSON file containing MAC to ID mapping')
+    parser.add_argument('-port', type=int, help='MQTT Port', default=8080)
+    parser.add_argument('-host', help='MQTT Host IP', default='localhost')
+    parser.add_argument('-period', type=float, help='How often to publish the snapshot on fleet_status/snapshot', default=1)
+    parser.add_argument('-stale_age', type=float, help='Robots not heard from for this long are reported as stale', default=DEFAULT_STALE_AGE)
+    parser.add_argument('-low_voltage', type=float, help='Robots under this battery voltage are reported', default=DEFAULT_LOW_VOLTAGE)
+
+    args = parser.parse_args()
+
+    with open(args.mac_list, 'r') as f:
+        robot_ids = list(json.load(f).values())
+
+    table = FleetStatusTable(robot_ids)
+
+    fleet_node = node.Node(args.host, args.port, create_node_descriptor(table.ids))
+    fleet_node.start()
+
+    def subscribe(robot_id, link, update):
+        def on_message(payload):
+            try:
+                update(robot_id, json.loads(payload.decode(encoding='UTF-8')))
+            except Exception as e:
+                logger.warning('Malformed message on ({0}): {1}'.format(robot_id + link, repr(e)))
+
+        fleet_node.subscribe_with_callback(robot_id + link, on_message)
+
+    for robot_id in table.ids:
+        subscribe(robot_id, '/status', table.update_status)
+        subscribe(robot_id, '/metrics', table.update_metrics)
+
+    try:
+        while True:
+            time.sleep(args.period)
+            fleet_node.put('fleet_status/snapshot', json.dumps(table.snapshot()))
+            logger.info('Low battery ({0}), stale ({1}), charging ({2})'.format(table.below('batt_volt', args.low_voltage),
+                                                                              table.stale(args.stale_age), table.charging()))
+    finally:
+        fleet_node.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,248 @@ import subprocess
 import re
 import json
 import getpass
+import os
+import select
+import sys
+import time
 import numpy as np
+import fleet_exec
+
+# Compiled once, rather than for every line of every scan
+MAC_REGEX = re.compile(r'([0-9A-F]{2}[:-]){5}([0-9A-F]{2})', re.I)
+IP_REGEX = re.compile(r'((2[0-5]|1[0-9]|[0-9])?[0-9]\.){3}((2[0-5]|1[0-9]|[0-9])?[0-9])')
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'gritsbot', 'mac_to_ip.json')
+DEFAULT_TTL = 3600
+RESCAN_DELAY = 2
+NEIGHBORS_IDLE = 1
+NEIGHBORS_TIMEOUT = 10
+
+
+def parse_line(line):
+    """Finds a MAC and IP address in a line of arp-scan or neighbour table (ip neigh) output.
+
+    Args:
+        line (str): The line.
+
+    Returns:
+        tuple: The MAC address (lower case, with colons) and the IP address, or None if the line doesn't contain both.
+
+    """
+
+    mac = MAC_REGEX.search(line)
+    if(mac is None):
+        return None
+
+    ip = IP_REGEX.search(line)
+    if(ip is None):
+        return None
+
+    return mac.group().lower().replace('-', ':'), ip.group()
+
+
+def collect(lines, mac_to_id, mac_to_ip, done):
+    """Adds the robots found in lines of output to mac_to_ip, stopping as soon as done.
+
+    Lines are consumed as they arrive, so a scan can be stopped as soon as every robot needed has been found.
+
+    Args:
+        lines (iterable): Lines of arp-scan or neighbour table output.
+        mac_to_id (dict): Maps robot MAC addresses (lower case) to IDs.
+        mac_to_ip (dict): Maps the MAC addresses of the robots found to their IPs.  Updated in place.
+        done (function): Called with mac_to_ip; returns whether enough robots have been found.
+
+    Returns:
+        bool: Whether enough robots have been found.
+
+    """
+
+    if(done(mac_to_ip)):
+        return True
+
+    for line in lines:
+        found = parse_line(line)
+        if(found is not None and found[0] in mac_to_id):
+            mac_to_ip[found[0]] = found[1]
+            if(done(mac_to_ip)):
+                return True
+
+    return False
+
+
+def read_lines(stream, idle=NEIGHBORS_IDLE, timeout=NEIGHBORS_TIMEOUT):
+    """Yields lines from a stream as they arrive, until it ends, stays quiet for idle seconds or timeout seconds have passed.
+
+    Streams that never end (e.g., ip monitor neigh piped to stdin) are read with select, so a robot that never shows up doesn't block forever.
+    Iterables without a file descriptor (e.g., lists) are just iterated.
+
+    Args:
+        stream: A file object or an iterable of lines.
+        idle (float, optional): Time in seconds without input after which reading stops.
+        timeout (float, optional): Time in seconds after which reading stops.
+
+    Yields:
+        str: Each line.
+
+    """
+
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        yield from stream
+        return
+
+    deadline = time.monotonic() + timeout
+    pending = b''
+    while(True):
+        wait = min(idle, deadline - time.monotonic())
+        if(wait <= 0):
+            break
+
+        ready, _, _ = select.select([fd], [], [], wait)
+        if(not ready):
+            break
+
+        # Read the descriptor directly, since data sitting in the file object's buffer would be invisible to select
+        data = os.read(fd, 65536)
+        if(not data):
+            break
+
+        pending += data
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode(errors='replace')
+
+    if(pending):
+        yield pending.decode(errors='replace')
+
+
+def run_streaming(cmd, mac_to_id, mac_to_ip, done):
+    """Runs a command and collects robots from its output as it is produced.  The command is stopped once enough robots have been found.
+
+    Args:
+        cmd (list): The command.
+        mac_to_id (dict): Maps robot MAC addresses (lower case) to IDs.
+        mac_to_ip (dict): Maps the MAC addresses of the robots found to their IPs.  Updated in place.
+        done (function): Called with mac_to_ip; returns whether enough robots have been found.
+
+    Returns:
+        bool: Whether enough robots have been found.
+
+    """
+
+    try:
+        pid = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError as e:
+        print('Could not run ({0}): {1}'.format(' '.join(cmd), repr(e)))
+        return done(mac_to_ip)
+
+    try:
+        return collect(pid.stdout, mac_to_id, mac_to_ip, done)
+    finally:
+        if(pid.poll() is None):
+            pid.terminate()
+        pid.wait()
+
+
+def load_cache(path, ttl, now):
+    """Loads the MAC to IP cache, dropping entries older than the TTL.
+
+    Returns:
+        dict: Maps MAC addresses to IPs.
+
+    """
+
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return {mac: entry[0] for mac, entry in cache.items() if now - entry[1] <= ttl}
+
+
+def save_cache(path, mac_to_ip, now):
+    """Saves the robots found to the MAC to IP cache, stamped with the current time.  Other entries keep their old time, and so expire."""
+
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    cache.update({mac: [ip, now] for mac, ip in mac_to_ip.items()})
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print('Could not save cache ({0}): {1}'.format(path, repr(e)))
+
+
+def discover(mac_to_id, interface, needed=None, cache_path=DEFAULT_CACHE, ttl=DEFAULT_TTL, neighbors=None, neighbors_timeout=NEIGHBORS_TIMEOUT):
+    """Finds the IP addresses of the robots, doing as little scanning as possible.
+
+    Discovery proceeds in stages, stopping as soon as enough robots have been found:
+
+    1. Streamed neighbour table input (e.g., from ip monitor neigh), if given.
+    2. The kernel's neighbour table (ip neigh).
+    3. Targeted probes (arp-scan of just those addresses) of robots in the cache or neighbour table, to check they are still there.
+    4. Full scans of the subnet (arp-scan -l), stopped as soon as the missing robots are found, and retried with a delay if needed robots are
+       still missing.
+
+    Args:
+        mac_to_id (dict): Maps robot MAC addresses to IDs.
+        interface (str): Network interface on which to make queries.
+        needed (int, optional): Number of robots that must be found.  Defaults to a single full pass.
+        cache_path (str, optional): Path of the MAC to IP cache, or None to not use a cache.
+        ttl (float, optional): Age in seconds after which cache entries are ignored.
+        neighbors (iterable, optional): Lines of neighbour table or ARP input (e.g., a file object), consumed as they arrive until enough robots
+            are found, the input ends or stays quiet for NEIGHBORS_IDLE seconds, or neighbors_timeout seconds have passed.
+        neighbors_timeout (float, optional): Longest time in seconds to read neighbors for.
+
+    Returns:
+        dict: Maps the MAC addresses of the robots found to their IPs.
+
+    """
+
+    mac_to_id = {mac.lower(): robot_id for mac, robot_id in mac_to_id.items()}
+    wanted = len(mac_to_id) if needed is None else needed
+
+    def done(found):
+        return len(found) >= wanted
+
+    now = time.time()
+    candidates = load_cache(cache_path, ttl, now) if cache_path is not None else {}
+    candidates = {mac: ip for mac, ip in candidates.items() if mac in mac_to_id}
+
+    # Neighbour information the host already has costs no traffic
+    if(neighbors is not None):
+        collect(read_lines(neighbors, timeout=neighbors_timeout), mac_to_id, candidates, done)
+    run_streaming(['ip', 'neigh', 'show', 'dev', interface], mac_to_id, candidates, lambda found: False)
+
+    # Check that the candidates are (still) there, with one probe each rather than a scan of the subnet
+    mac_to_ip = {}
+    if(candidates):
+        run_streaming(['arp-scan', '-I', interface, '-t', '100', '-r', '2'] + sorted(set(candidates.values())), mac_to_id, mac_to_ip, done)
+
+    # Only scan the subnet for robots that are still missing
+    while(not done(mac_to_ip)):
+        print('Found {0} of {1} robots, scanning for the rest...'.format(len(mac_to_ip), wanted))
+        run_streaming(['arp-scan', '-I', interface, '-l', '-t', '100', '-r', '5'], mac_to_id, mac_to_ip, done)
+
+        if(needed is None or done(mac_to_ip)):
+            break
+
+        # Don't flood the network
+        time.sleep(RESCAN_DELAY)
+
+    if(cache_path is not None):
+        save_cache(cache_path, mac_to_ip, time.time())
+
+    return mac_to_ip
 
 
 def main():
@@ -11,7 +252,17 @@ def main():
     parser.add_argument('mac_list', help='Path to JSON file containing MAC to ID mapping')
     parser.add_argument('interface', help='Network interface on which to make query')
     parser.add_argument('-c', help='Optional command for address', default=None)
+    parser.add_argument('-j', type=int, help='Maximum number of robots to run the command on at once', default=fleet_exec.DEFAULT_PARALLELISM)
+    parser.add_argument('-timeout', type=float, help='Time in seconds after which the command is killed on a robot',
+                        default=fleet_exec.DEFAULT_TIMEOUT)
+    parser.add_argument('-o', help='Optional JSON file to write the ID to IP mapping to (e.g., for fleet_exec)', default=None)
     parser.add_argument('-n', help='Optional number of robots needed to be found', default=None)
+    parser.add_argument('-cache', help='Path of the MAC to IP cache', default=DEFAULT_CACHE)
+    parser.add_argument('-ttl', type=float, help='Age in seconds after which cached addresses are rescanned', default=DEFAULT_TTL)
+    parser.add_argument('-no_cache', action='store_true', help='Neither read nor write the cache')
+    parser.add_argument('-neighbors', help='File of neighbour table or ARP lines to read first (- for stdin, e.g., from ip monitor neigh)',
+                        default=None)
+    parser.add_argument('-neighbors_timeout', type=float, help='Longest time in seconds to read -neighbors for', default=NEIGHBORS_TIMEOUT)
 
     args = parser.parse_args()
     interface = args.interface
@@ -23,58 +274,39 @@ def main():
         print(repr(e))
         print('Could not open file ({})'.format(args.mac_list))
 
-    checkNumberRobots = True   
+    neighbors = None
+    if(args.neighbors == '-'):
+        neighbors = sys.stdin
+    elif(args.neighbors is not None):
+        neighbors = open(args.neighbors, 'r')
 
-    while(checkNumberRobots):
-        pid = subprocess.Popen(['arp-scan', '-I', interface, '-l', '-t', '100', '-r', '5'], stdout=subprocess.PIPE)
-        out = pid.communicate()[0].decode()
-        lines = out.split('\n')
+    needed = None if args.n is None else int(args.n)
+    mac_to_ip = discover(mac_to_id, interface, needed=needed, cache_path=None if args.no_cache else args.cache, ttl=args.ttl,
+                         neighbors=neighbors, neighbors_timeout=args.neighbors_timeout)
 
-        mac_to_ip = {}
+    # Make ID to IP mapping
+    mac_to_id = {mac.lower(): robot_id for mac, robot_id in mac_to_id.items()}
+    id_to_ip = dict({mac_to_id[x]: y for x, y in mac_to_ip.items()})
 
-        for line in lines:
+    print(id_to_ip)
+    print('Number of robots found: ', len(id_to_ip))
 
-            # Look for MAC address in the line
-            mac = re.search(r'([0-9A-F]{2}[:-]){5}([0-9A-F]{2})', line, re.I)
-            if(mac is None):
-                continue
-            # Else
-            mac = mac.group()
-
-            ip = re.search(r'((2[0-5]|1[0-9]|[0-9])?[0-9]\.){3}((2[0-5]|1[0-9]|[0-9])?[0-9])', line, re.I)
-            if(ip is None):
-                continue
-            # Else
-            ip = ip.group()
-            mac_to_ip[mac] = ip
-
-        # Make ID to IP mapping
-        id_to_ip = dict({mac_to_id[x]: y for x, y in mac_to_ip.items() if x in mac_to_id})
-
-        print(id_to_ip)
-        print('Number of robots found: ', len(id_to_ip))
-        
-        if((args.n is None) or (len(id_to_ip) is int(args.n))):
-           checkNumberRobots = False
-        else:
-            print('Number of robots needed, provided by user: ', args.n)
-            print('All robots not found, retrying...') 
+    if(args.o is not None):
+        with open(args.o, 'w') as f:
+            json.dump(id_to_ip, f)
 
     if(args.c is None):
         return
 
     print('Enter secrets for robots')
     password = getpass.getpass()
-    # -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no
-    # Else, send command to robots
-    cmds = [['sshpass', '-p', password, 'ssh', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no', 'pi@'+x, args.c] for x in id_to_ip.values()]
-    #cmds = [['sshpass', '-p', password, 'scp', '-o', 'StrictHostKeyChecking=no', '/home/robotarium-workstation/restart_docker.sh', 'pi@'+x+':~'] for x in id_to_ip.values()]
-    pids = []
-    for cmd in cmds:
-        pids.append(subprocess.Popen(cmd))
-
-    for pid in pids:
-        pid.communicate()
+
+    # Else, send command to robots, a bounded number at a time, over connections that are kept open for later commands
+    results = fleet_exec.run_fleet(id_to_ip, args.c, parallelism=args.j, timeout=args.timeout, password=password)
+    print(fleet_exec.format_results(results))
+
+    if(any(r['status'] != 0 for r in results)):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -3,4 +3,4 @@ if [[ $1 -eq 0 ]] ; then
     exit 0
 fi
 
-sudo python3 get_ip_by_mac.py ../config/mac_list.json wlp5s0 -c "./restart_docker.sh" -n $1
+sudo python3 get_ip_by_mac.py ../config/mac_list.json wlp5s0 -c "./restart_docker.sh" -n $1 -timeout 120
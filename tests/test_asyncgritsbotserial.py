@@ -0,0 +1,74 @@
+import asyncio
+import time
+import pytest
+import gritsbot.asyncgritsbotserial as asyncgritsbotserial
+import gritsbot.simulator as simulator
+
+READ = {'request': ['read'], 'iface': ['batt_volt']}
+
+
+@pytest.fixture
+def device():
+    d = simulator.SimulatedGritsbot(seed=1, latency=0.2)
+    d.start()
+    yield d
+    d.stop()
+
+
+def run(device, test):
+    """Runs a test coroutine against a started AsyncGritsbotSerial on a new event loop."""
+
+    async def main():
+        serial = asyncgritsbotserial.AsyncGritsbotSerial(serial_dev=device.device)
+        await serial.start()
+        try:
+            await test(serial)
+        finally:
+            await serial.stop()
+
+    asyncio.run(main())
+
+
+def test_request_times_out_and_discards_late_response(device):
+
+    async def test(serial):
+        with pytest.raises(asyncio.TimeoutError):
+            await serial.request(READ, timeout=0.05)
+
+        # The late response arrives with no request outstanding, so it isn't taken as the next response
+        await asyncio.sleep(0.3)
+        assert (await serial.request(READ, timeout=1))['body'] == [{'batt_volt': 4.1}]
+
+    run(device, test)
+
+
+def test_cancelled_request_releases_the_line(device):
+
+    async def test(serial):
+        task = asyncio.ensure_future(serial.request(READ, timeout=1))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        await asyncio.sleep(0.3)
+        assert (await serial.request(READ, timeout=1))['body'] == [{'batt_volt': 4.1}]
+
+    run(device, test)
+
+
+def test_waiting_for_earlier_requests_counts_against_the_timeout(device):
+
+    async def test(serial):
+        slow = asyncio.ensure_future(serial.request(READ, timeout=1))
+        await asyncio.sleep(0)
+
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await serial.request(READ, timeout=0.05)
+        assert time.monotonic() - start < 0.15
+
+        assert (await slow)['body'] == [{'batt_volt': 4.1}]
+        assert (await serial.request(READ, timeout=1))['body'] == [{'batt_volt': 4.1}]
+
+    run(device, test)
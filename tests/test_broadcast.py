@@ -0,0 +1,47 @@
+import pytest
+import gritsbot.broadcast as broadcast
+
+COMMANDS = {
+    '1': {'v': 0.1, 'w': -0.2},
+    '3': {'left_led': [255, 0, 0], 'right_led': [0, 0, 255]},
+    '12': {'v': 0.0, 'w': 0.5, 'left_led': [1, 2, 3]},
+}
+
+
+def test_round_trip():
+    payload = broadcast.encode(COMMANDS, t=1000.5, seq=7)
+
+    for robot_id, command in COMMANDS.items():
+        expected = dict(command, t=1000.5, seq=7)
+        assert broadcast.SlotExtractor(robot_id).extract(payload) == expected
+
+
+def test_send_time_is_optional_and_sequence_numbers_wrap():
+    command = broadcast.SlotExtractor(1).extract(broadcast.encode(COMMANDS, seq=2**32 + 5))
+    assert 't' not in command
+    assert command['seq'] == 5
+
+
+def test_robot_without_a_slot():
+    assert broadcast.SlotExtractor('2').extract(broadcast.encode(COMMANDS)) is None
+    assert broadcast.SlotExtractor('2').extract(broadcast.encode({})) is None
+
+
+def test_slot_hint_out_of_range_after_robots_leave():
+    extractor = broadcast.SlotExtractor('12')
+    assert extractor.extract(broadcast.encode(COMMANDS))['w'] == 0.5
+
+    # The robot was in the last slot; now there are fewer slots and it is in the first
+    assert extractor.extract(broadcast.encode({'12': {'v': 0.3, 'w': 0}}))['v'] == 0.3
+    assert extractor.extract(broadcast.encode({'1': {'v': 0.3, 'w': 0}})) is None
+
+
+@pytest.mark.parametrize('payload', [
+    b'',
+    broadcast.encode(COMMANDS)[:broadcast.HEADER.size - 1],
+    broadcast.encode(COMMANDS)[:-1],
+    bytes([broadcast.VERSION + 1]) + broadcast.encode(COMMANDS)[1:],
+])
+def test_malformed_messages(payload):
+    with pytest.raises(ValueError):
+        broadcast.SlotExtractor('1').extract(payload)
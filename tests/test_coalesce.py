@@ -0,0 +1,36 @@
+import gritsbot.coalesce as coalesce
+from gritsbot.request import Request
+
+
+def write(coalescer, body, now, iface='motor'):
+    request = Request()
+    handlers = []
+    added = coalescer.add_write(request, handlers, iface, body, None, now)
+    assert len(handlers) == len(request.iface) == (1 if added else 0)
+    return added
+
+
+def test_suppresses_unchanged_writes_until_keepalive():
+    coalescer = coalesce.WriteCoalescer(keepalive={'motor': 0.1})
+
+    assert write(coalescer, {'v': 0.1, 'w': 0}, 0)
+    assert not write(coalescer, {'v': 0.1, 'w': 0}, 0.05)
+    assert write(coalescer, {'v': 0.2, 'w': 0}, 0.06)
+    assert write(coalescer, {'v': 0.2, 'w': 0}, 0.16)
+    assert coalescer.stats() == {'sent': 3, 'suppressed': 1}
+
+
+def test_interfaces_without_keepalive_are_written_only_on_change():
+    coalescer = coalesce.WriteCoalescer(keepalive={'motor': 0.1})
+
+    assert write(coalescer, {'rgb': [1, 2, 3]}, 0, iface='left_led')
+    assert not write(coalescer, {'rgb': [1, 2, 3]}, 100, iface='left_led')
+
+
+def test_invalidate_forces_next_write():
+    coalescer = coalesce.WriteCoalescer()
+    assert write(coalescer, {'v': 0.1, 'w': 0}, 0)
+    assert not write(coalescer, {'v': 0.1, 'w': 0}, 1)
+
+    coalescer.invalidate()
+    assert write(coalescer, {'v': 0.1, 'w': 0}, 2)
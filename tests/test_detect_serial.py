@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+import types
+import pytest
+import gritsbot.utils.detect_serial as detect_serial
+
+PORTS = [
+    types.SimpleNamespace(device='/dev/ttyUSB0', vid=0x0403, pid=0x6001, serial_number='FT1'),
+    types.SimpleNamespace(device='/dev/ttyACM1', vid=0x16c0, pid=0x0483, serial_number='5678'),
+    types.SimpleNamespace(device='/dev/ttyACM0', vid=0x16c0, pid=0x0483, serial_number='1234'),
+    types.SimpleNamespace(device='/dev/ttyS0', vid=None, pid=None, serial_number=None),
+]
+
+
+@pytest.fixture
+def ports(monkeypatch):
+    monkeypatch.setattr(detect_serial.serial.tools.list_ports, 'comports', lambda: list(PORTS))
+
+
+@pytest.mark.parametrize('criteria, expected', [
+    ({}, '/dev/ttyACM0'),
+    ({'pattern': 'ttyUSB'}, '/dev/ttyUSB0'),
+    ({'vid': 0x16c0, 'pid': 0x0483}, '/dev/ttyACM0'),
+    ({'vid': 0x16c0, 'serial_number': '5678'}, '/dev/ttyACM1'),
+    ({'pid': 0x6001}, '/dev/ttyUSB0'),
+    ({'vid': 0x16c0, 'pid': 0x6001}, None),
+    ({'serial_number': 'nope', 'pattern': 'ttyACM'}, None),
+])
+def test_find_port(ports, criteria, expected):
+    assert detect_serial.find_port(**criteria) == expected
+
+
+def inotify_event(name, mask):
+    name = name.encode()
+    # The kernel pads names with NULs to align the next event
+    padded = name + b'\0'*(16 - len(name) % 16)
+    return detect_serial.INOTIFY_EVENT.pack(1, mask, 0, len(padded)) + padded
+
+
+def watch(monkeypatch, tmp_path, fd=None):
+    events = []
+    seen = threading.Condition()
+
+    def callback(name, added):
+        with seen:
+            events.append((name, added))
+            seen.notify_all()
+
+    def wait_for(n):
+        with seen:
+            assert seen.wait_for(lambda: len(events) >= n, timeout=5)
+        return events
+
+    monkeypatch.setattr(detect_serial.DeviceWatcher, '_inotify_fd', lambda self: fd)
+    watcher = detect_serial.DeviceWatcher(callback, directory=str(tmp_path), poll_interval=0.01)
+    watcher.start()
+    return watcher, wait_for
+
+
+def test_watcher_reports_inotify_events(monkeypatch, tmp_path):
+    read_fd, write_fd = os.pipe()
+    watcher, wait_for = watch(monkeypatch, tmp_path, fd=read_fd)
+
+    # Several events may arrive in one read
+    os.write(write_fd, inotify_event('ttyACM0', detect_serial.IN_CREATE) + inotify_event('ttyACM0', detect_serial.IN_ATTRIB))
+    os.write(write_fd, inotify_event('ttyACM0', detect_serial.IN_DELETE) + inotify_event('gritsbot', detect_serial.IN_MOVED_FROM)
+             + inotify_event('gritsbot', detect_serial.IN_MOVED_TO))
+
+    assert wait_for(5) == [('ttyACM0', True), ('ttyACM0', True), ('ttyACM0', False), ('gritsbot', False), ('gritsbot', True)]
+    watcher.stop()
+    os.close(write_fd)
+
+    # The watcher closes its descriptor when stopped
+    with pytest.raises(OSError):
+        os.fstat(read_fd)
+
+
+def test_watcher_polls_without_inotify(monkeypatch, tmp_path):
+    (tmp_path / 'ttyACM0').touch()
+    watcher, wait_for = watch(monkeypatch, tmp_path)
+    time.sleep(0.1)  # Let the watcher take its first listing
+
+    (tmp_path / 'ttyACM1').touch()
+    assert wait_for(1) == [('ttyACM1', True)]
+    (tmp_path / 'ttyACM0').unlink()
+    assert wait_for(2) == [('ttyACM1', True), ('ttyACM0', False)]
+    watcher.stop()
@@ -0,0 +1,109 @@
+import json
+import time
+import pytest
+import gritsbot.broadcast as broadcast
+import gritsbot.firmware as firmware
+import gritsbot.gritsbotserial as gritsbotserial
+import gritsbot.metrics as metrics
+import gritsbot.recording as recording
+import gritsbot.simulator as simulator
+
+
+@pytest.fixture
+def controller():
+    """Makes Controllers for robot 1, each against its own simulated microcontroller, from firmware arguments.  Published data is kept in put."""
+    made = []
+
+    def make(*argv, **kwargs):
+        device = simulator.SimulatedGritsbot(seed=1)
+        device.start()
+        serial = gritsbotserial.GritsbotSerial(serial_dev=device.device, watch=False)
+        serial.start()
+
+        put = []
+        c = firmware.Controller(serial, lambda link, payload: put.append((link, payload)), '1', firmware.parse_args(['mac_list.json'] + list(argv)),
+                                metrics.Metrics(), **kwargs)
+        c.put = put
+        made.append((c, serial, device))
+        return c
+
+    yield make
+
+    for c, serial, device in made:
+        c._publisher.stop()
+        serial.stop()
+        device.stop()
+
+
+def test_binary_codec_rejects_unsupported_poll_interfaces():
+    args = firmware.parse_args(['mac_list.json', '-poll', 'batt_volt:1', '-codec', 'binary'])
+    assert args.codec == 'binary'
+
+    with pytest.raises(SystemExit):
+        firmware.parse_args(['mac_list.json', '-poll', 'encoders:0.01', '-codec', 'binary'])
+
+    assert firmware.parse_args(['mac_list.json', '-poll', 'encoders:0.01', '-codec', 'json']).codec == 'json'
+
+
+def test_commands_are_traced_per_link(controller):
+    c = controller('-broadcast_link', broadcast.DEFAULT_LINK)
+
+    # The workstation and the broadcaster number their commands independently
+    for seq, link in [(1, 'matlab_api'), (100, 'broadcast'), (2, 'matlab_api'), (101, 'broadcast'), (3, 'matlab_api')]:
+        if(link == 'broadcast'):
+            c.on_broadcast(broadcast.encode({'1': {'v': 0.1, 'w': 0}}, seq=seq))
+        else:
+            c.on_input(json.dumps({'v': 0.2, 'w': 0, 'seq': seq}).encode(encoding='UTF-8'))
+        c.cycle(time.monotonic())
+
+    stats = c._tracer.stats()
+    assert stats['accepted'] == 5
+    assert stats['skipped'] == 0
+    assert stats['reordered'] == 0
+
+
+def test_run_writes_the_rest_of_the_recording_when_stopped(controller, tmp_path):
+    path = str(tmp_path / 'robot.rec')
+    # Long enough between writes that nothing is written before the loop stops
+    c = controller(recorder=recording.Recorder(path, size=1024*1024, flush_interval=60))
+
+    c.on_input(b'{"v": 0.1, "w": 0}')
+    c.cycle(time.monotonic())
+    c.stop()
+    c.run()
+
+    kinds = [kind for _, kind, _ in recording.read_records(path)]
+    assert kinds == [recording.INPUT, recording.SERIAL_REQUEST, recording.SERIAL_RESPONSE]
+
+
+def test_loop_idles_without_commands_and_wakes_on_one(controller):
+    c = controller('-idle_after', '1', '-idle_update_rate', '0.2')
+    start = time.monotonic()
+
+    c.cycle(start + 0.5)
+    assert not c._idle
+    c.cycle(start + 1.5)
+    assert c._idle
+    assert c.loop_scheduler.period == 0.2
+
+    c.on_input(json.dumps({'v': 0.1, 'w': 0}).encode(encoding='UTF-8'))
+    c.cycle(start + 2)
+    assert not c._idle
+    assert c.loop_scheduler.period == 0.016
+
+    # Idles again a full idle_after after the last command
+    c.cycle(start + 2.5)
+    assert not c._idle
+    c.cycle(start + 3)
+    assert c._idle
+
+    # The command that woke the loop counts towards the idle wake-up latency
+    assert c.metrics.histogram('wake_latency_idle').merged().count == 1
+    assert c.metrics.histogram('wake_latency_active').merged().count == 0
+
+
+def test_idling_can_be_disabled(controller):
+    c = controller('-idle_after', '0')
+    c.cycle(time.monotonic() + 60)
+    assert not c._idle
+    assert c.loop_scheduler.period == 0.016
@@ -0,0 +1,53 @@
+import os
+import stat
+import time
+import pytest
+import fleet_exec
+
+# Stands in for ssh: a master connection backgrounds a process that keeps its standard output open, as some OpenSSH versions do
+FAKE_SSH = '''#!/bin/sh
+echo "$@" >> "$FAKE_SSH_DIR/calls"
+case " $* " in
+    *" -O check "*) test -e "$FAKE_SSH_DIR/master"; exit $?;;
+    *" ControlMaster=yes "*) touch "$FAKE_SSH_DIR/master"; sleep 5 & exit 0;;
+esac
+for arg; do last="$arg"; done
+echo "ran $last"
+'''
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    path = tmp_path / 'ssh'
+    path.write_text(FAKE_SSH)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FAKE_SSH_DIR', str(tmp_path))
+
+    def calls():
+        return (tmp_path / 'calls').read_text().splitlines()
+
+    return calls
+
+
+def test_master_is_opened_once_without_capturing_its_output(fake_ssh, tmp_path):
+    start = time.monotonic()
+    results = fleet_exec.run_fleet({'1': '10.0.0.1'}, 'uptime', timeout=3, control_dir=str(tmp_path / 'cm'))
+    assert time.monotonic() - start < 2
+    assert results[0]['status'] == 0
+    assert results[0]['output'] == 'ran uptime\n'
+
+    fleet_exec.run_one('1', '10.0.0.1', 'hostname', timeout=3, control_dir=str(tmp_path / 'cm'))
+    calls = fake_ssh()
+    assert ['-O check' in x for x in calls] == [True, False, False, True, False]
+    assert 'ControlMaster=yes' in calls[1] and '-N -f' in calls[1]
+    assert all('ControlMaster=no' in x for x in (calls[2], calls[4]))
+
+
+def test_format_results():
+    results = [{'id': '1', 'host': '10.0.0.1', 'status': 0, 'time': 0.1, 'output': 'a\nb\nc\nd\n'},
+               {'id': '2', 'host': '10.0.0.2', 'status': None, 'time': 3, 'output': '[timed out after 3 s]'}]
+    table = fleet_exec.format_results(results)
+    assert 'b | c | d' in table
+    assert 'timeout' in table
+    assert table.splitlines()[-1] == '1 of 2 succeeded; failed: 2'
@@ -0,0 +1,57 @@
+import fleet_status
+
+
+def make():
+    table = fleet_status.FleetStatusTable(['10', '2', '1', '2'])
+    table.update_status('1', {'batt_volt': 3.6, 'charge_status': False}, now=100)
+    table.update_status('2', {'batt_volt': 4.1, 'charge_status': True}, now=99)
+    return table
+
+
+def test_robots_are_ordered_by_id():
+    assert fleet_status.FleetStatusTable(['10', '2', '1', '2']).ids == ['1', '2', '10']
+
+
+def test_unknown_robots_are_ignored():
+    table = make()
+    assert not table.update_status('3', {'batt_volt': 3.0})
+    assert not table.update_metrics('3', {'cycle': {'p99': 0.1}})
+    assert table.below('batt_volt', 3.7) == ['1']
+
+
+def test_queries_leave_out_missing_values():
+    table = make()
+    assert table.below('batt_volt', 3.7) == ['1']
+    assert table.above('batt_volt', 3.0) == ['1', '2']
+    assert table.charging() == ['2']
+
+    # Robot 10 has never been heard from, so it is stale, but neither below nor above any voltage
+    assert table.stale(1.5, now=101) == ['2', '10']
+    assert table.stale(5, now=101) == ['10']
+
+
+def test_metrics_queries():
+    table = make()
+    table.update_metrics('2', {'cycle': {'p99': 0.02, 'p50': 0.01}, 'serial_roundtrip': {'p99': 0.004}})
+    table.update_metrics('10', {'cycle': {'p99': 0.005}})
+
+    assert table.above('cycle_p99', 0.01) == ['2']
+    assert table.below('cycle_p99', 0.01) == ['10']
+    assert table.below('command_age_p99', 1) == []
+
+
+def test_snapshot():
+    table = make()
+    table.update_metrics('1', {'cycle': {'p99': 0.0161}})
+    snapshot = table.snapshot(now=101)
+
+    assert snapshot['ids'] == ['1', '2', '10']
+    assert snapshot['batt_volt'] == [3.6, 4.1, None]
+    assert snapshot['charge_status'] == [False, True, False]
+    assert snapshot['age'] == [1, 2, None]
+    assert snapshot['cycle_p99'] == [0.0161, None, None]
+
+
+def test_node_descriptor_requests_every_robot():
+    descriptor = fleet_status.create_node_descriptor(['1', '2'])
+    assert [x['link'] for x in descriptor['requests']] == ['1/status', '1/metrics', '2/status', '2/metrics']
@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+import get_ip_by_mac
+
+MAC_TO_ID = {'b8:27:eb:00:00:01': '1', 'b8:27:eb:00:00:02': '2'}
+
+
+def test_collect_stops_when_done():
+    lines = iter(['192.168.1.11 dev wlan0 lladdr b8:27:eb:00:00:01 REACHABLE', 'never read'])
+    found = {}
+    assert get_ip_by_mac.collect(lines, MAC_TO_ID, found, lambda x: len(x) >= 1)
+    assert found == {'b8:27:eb:00:00:01': '192.168.1.11'}
+    assert next(lines) == 'never read'
+
+
+def test_read_lines_stops_on_a_stream_that_never_ends():
+    read_fd, write_fd = os.pipe()
+    try:
+        os.write(write_fd, b'192.168.1.11 dev wlan0 lladdr b8:27:eb:00:00:01 REACHABLE\n192.168.1.12 dev wl')
+        with os.fdopen(read_fd, 'r') as stream:
+            start = time.monotonic()
+            found = {}
+            # Robot 2 never shows up completely, and the writer never closes the pipe
+            assert not get_ip_by_mac.collect(get_ip_by_mac.read_lines(stream, idle=0.1, timeout=1), MAC_TO_ID, found, lambda x: len(x) >= 2)
+            assert time.monotonic() - start < 0.5
+            assert found == {'b8:27:eb:00:00:01': '192.168.1.11'}
+    finally:
+        os.close(write_fd)
+
+
+def test_read_lines_overall_timeout():
+    read_fd, write_fd = os.pipe()
+    stop = threading.Event()
+
+    def chatter():
+        while(not stop.wait(0.02)):
+            os.write(write_fd, b'unrelated\n')
+
+    thread = threading.Thread(target=chatter)
+    thread.start()
+    try:
+        with os.fdopen(read_fd, 'r') as stream:
+            start = time.monotonic()
+            lines = list(get_ip_by_mac.read_lines(stream, idle=0.1, timeout=0.3))
+            assert 0.25 < time.monotonic() - start < 0.5
+            assert lines and all(line == 'unrelated' for line in lines)
+    finally:
+        stop.set()
+        thread.join()
+        os.close(write_fd)
@@ -0,0 +1,252 @@
+import struct
+import time
+import pytest
+import gritsbot.gritsbotserial as gritsbotserial
+import gritsbot.simulator as simulator
+
+READ = {'request': ['read'], 'iface': ['batt_volt']}
+
+
+@pytest.fixture
+def device():
+    devices = []
+
+    def make(**kwargs):
+        d = simulator.SimulatedGritsbot(seed=1, **kwargs)
+        d.start()
+        devices.append(d)
+        return d
+
+    yield make
+
+    for d in devices:
+        d.stop()
+
+
+@pytest.fixture
+def connect():
+    connections = []
+
+    def make(d, **kwargs):
+        serial = gritsbotserial.GritsbotSerial(serial_dev=d.device, watch=False, **kwargs)
+        serial.start()
+        connections.append(serial)
+        return serial
+
+    yield make
+
+    for serial in connections:
+        serial.stop()
+
+
+def test_pipelined_submit_fails_fast_when_full(device, connect):
+    serial = connect(device(latency=0.2), pipelined=True, max_in_flight=2)
+
+    futures = [serial.submit(READ) for _ in range(2)]
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        serial.submit(READ)
+    assert time.monotonic() - start < 0.05
+    assert serial.stats()['rejected'] == 1
+
+    for future in futures:
+        assert future.result(timeout=2)['body'] == [{'batt_volt': 4.1}]
+
+
+def test_pipelined_request_expires_on_time(device, connect):
+    serial = connect(device(latency=0.5), pipelined=True)
+
+    start = time.monotonic()
+    future = serial.submit(READ, timeout=0.1)
+    with pytest.raises(RuntimeError):
+        future.result(timeout=2)
+    assert time.monotonic() - start < 0.3
+
+
+def run_mixed(serial, n, timeout=0.1):
+    """Submits alternating reads, keeping the pipeline as full as it allows, and returns (request, response) for each answered request."""
+    requests = [{'request': ['read'], 'iface': [iface]} for iface in ('batt_volt', 'charge_status')]
+    in_flight = []
+    answered = []
+
+    for i in range(n):
+        request = requests[i % 2]
+        while(True):
+            try:
+                in_flight.append((request, serial.submit(request, timeout=timeout)))
+                break
+            except RuntimeError:
+                request_, future = in_flight.pop(0)
+                try:
+                    answered.append((request_, future.result(timeout=1)))
+                except RuntimeError:
+                    pass
+
+    for request, future in in_flight:
+        try:
+            answered.append((request, future.result(timeout=1)))
+        except RuntimeError:
+            pass
+
+    return answered
+
+
+@pytest.mark.parametrize('echo_seq', [True, False])
+def test_pipelined_responses_match_requests_despite_drops(device, connect, echo_seq):
+    serial = connect(device(drop_rate=0.3, echo_seq=echo_seq), pipelined=True, max_in_flight=4)
+
+    answered = run_mixed(serial, 40)
+    assert answered
+    for request, response in answered:
+        assert list(response['body'][0]) == request['iface']
+
+
+def test_pipelined_without_seq_echo_keeps_one_in_flight(device, connect):
+    serial = connect(device(latency=0.2, echo_seq=False), pipelined=True, max_in_flight=4)
+
+    future = serial.submit(READ)
+    with pytest.raises(RuntimeError):
+        serial.submit(READ)
+    assert future.result(timeout=2)['body'] == [{'batt_volt': 4.1}]
+
+
+def test_binary_codec_rejects_unknown_interface():
+    with pytest.raises(ValueError):
+        gritsbotserial.BinaryCodec().encode({'request': ['read', 'read'], 'iface': ['batt_volt', 'encoders']})
+
+
+def test_frame_buffer_splits_frames_across_reads():
+    frames = gritsbotserial.FrameBuffer()
+
+    # Junk before a frame is skipped, and braces and escaped quotes inside strings don't end it
+    frames.feed(b'\r\nxx{"a": "}\\"{", "b": {"c"')
+    assert frames.next_frame() is None
+    frames.feed(b': 1}}{"d": 2}{"e"')
+
+    assert frames.next_frame() == b'{"a": "}\\"{", "b": {"c": 1}}'
+    assert frames.next_frame() == b'{"d": 2}'
+    assert frames.next_frame() is None
+    assert len(frames) == 4
+
+    frames.clear()
+    frames.feed(b'{"f": 3}')
+    assert frames.next_frame() == b'{"f": 3}'
+
+
+
+def binary_frame(payload):
+    return gritsbotserial.BINARY_HEADER.pack(gritsbotserial.BINARY_MAGIC, len(payload)) + payload + bytes([sum(payload) & 0xFF])
+
+
+def test_binary_codec_round_trip():
+    codec = gritsbotserial.BinaryCodec()
+    frames = codec.frame_buffer()
+
+    request = {'request': ['write', 'read'], 'iface': ['motor', 'batt_volt'], 'body': [{'v': 0.5, 'w': -1.0}, {}], 'seq': 513}
+    frames.feed(codec.encode(request))
+    payload = frames.next_frame()
+    assert payload == bytes([gritsbotserial.BINARY_SEQ_FLAG, 1, 2, 2, 0x81]) + struct.pack('<ff', 0.5, -1.0) + bytes([4])
+
+    response = bytes([gritsbotserial.BINARY_SEQ_FLAG, 1, 2, 2, 0x81, 1, 4, 1]) + struct.pack('<f', 4.0)
+    assert codec.decode(response) == {'seq': 513, 'status': [1, 1], 'body': [{}, {'batt_volt': 4.0}]}
+
+    with pytest.raises(ValueError):
+        codec.decode(response + b'\x00')
+
+
+def test_binary_frame_buffer_rejects_bad_checksums():
+    frames = gritsbotserial.BinaryFrameBuffer()
+    good = binary_frame(bytes([0, 1, 5, 1, 1]))
+    bad = bytearray(binary_frame(bytes([0, 1, 4, 1]) + struct.pack('<f', 4.0)))
+    bad[-1] ^= 0xFF
+
+    # A corrupted frame is skipped, and a good frame split across reads is found after it
+    frames.feed(b'\x00' + bytes(bad) + good[:3])
+    assert frames.next_frame() is None
+    frames.feed(good[3:])
+    assert frames.next_frame() == bytes([0, 1, 5, 1, 1])
+    assert frames.next_frame() is None
+    assert len(frames) == 0
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_submit_records_when_the_request_was_written(device, connect, pipelined):
+    serial = connect(device(latency=0.1), pipelined=pipelined)
+
+    start = time.monotonic()
+    future = serial.submit(READ)
+    assert future.result(timeout=2)['body'] == [{'batt_volt': 4.1}]
+    end = time.monotonic()
+
+    assert start <= future.write_time < start + 0.05
+    assert end - future.write_time >= 0.1
+
+
+def test_binary_codec_clamps_led_colours():
+    codec = gritsbotserial.BinaryCodec()
+    frames = codec.frame_buffer()
+
+    request = {'request': ['write', 'write'], 'iface': ['motor', 'left_led'], 'body': [{'v': 0.1, 'w': 0}, {'rgb': [300, -5, 127.6]}]}
+    frames.feed(codec.encode(request))
+    assert frames.next_frame()[-4:] == bytes([0x82, 255, 0, 128])
+
+
+def test_binary_reads_match_json(device, connect):
+    d = device()
+    responses = []
+    for codecs in ([gritsbotserial.JsonCodec()], [gritsbotserial.BinaryCodec(), gritsbotserial.JsonCodec()]):
+        serial = connect(d, codecs=codecs)
+        responses.append(serial.serial_request(READ))
+        serial.stop()
+
+    assert responses[0]['body'] == responses[1]['body'] == [{'batt_volt': 4.1}]
+
+
+@pytest.mark.parametrize('usb', [False, True])
+def test_device_events_for_other_devices_are_ignored(tmp_path, usb):
+    if(usb):
+        serial = gritsbotserial.GritsbotSerial(vid=0x16c0, pid=0x0483, watch=False)
+        relevant, other = 'ttyACM3', 'sda1'
+    else:
+        serial = gritsbotserial.GritsbotSerial(serial_dev=str(tmp_path / 'gritsbot'), watch=False)
+        relevant, other = 'gritsbot', 'ttyACM0'
+
+    serial._on_device_event(other, True)
+    assert not serial._device_added
+    serial._on_device_event(relevant, True)
+    assert serial._device_added
+
+
+def test_removing_the_device_restarts_the_connection():
+    serial = gritsbotserial.GritsbotSerial(vid=0x16c0, pid=0x0483, watch=False)
+    serial._device_path = '/dev/ttyACM0'
+    serial._needs_restart = False
+
+    # Another serial device going away doesn't matter
+    serial._on_device_event('ttyACM1', False)
+    assert not serial._needs_restart
+    serial._on_device_event('ttyACM0', False)
+    assert serial._needs_restart
+
+
+def test_reconnects_when_the_device_is_plugged_back_in(device, tmp_path):
+    d = device(link=str(tmp_path / 'gritsbot'))
+    serial = gritsbotserial.GritsbotSerial(serial_dev=d.device)
+    serial.start()
+    try:
+        assert serial.serial_request(READ)['body'] == [{'batt_volt': 4.1}]
+
+        d.unplug(duration=0.5)
+        start = time.monotonic()
+        response = {}
+        while('body' not in response and time.monotonic() - start < 5):
+            try:
+                response = serial.serial_request(READ, timeout=0.5) or {}
+            except Exception:
+                time.sleep(0.05)
+
+        assert response['body'] == [{'batt_volt': 4.1}]
+        # Without the watcher, the retry backoff would only find it after 0.75 s
+        assert time.monotonic() - start < 0.7
+    finally:
+        serial.stop()
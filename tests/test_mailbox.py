@@ -0,0 +1,30 @@
+import json
+import threading
+import gritsbot.mailbox as mailbox
+
+
+def test_keeps_only_newest_message(clock):
+    wake = threading.Event()
+    box = mailbox.Mailbox(decode=lambda x: json.loads(x.decode(encoding='UTF-8')), clock=clock, wake=wake)
+    assert box.take() is None
+    assert box.received_time is None
+
+    box.put(b'{"v": 0.1}')
+    assert wake.is_set()
+    clock.now = 1
+    box.put(b'{"v": 0.2}')
+    clock.now = 2
+
+    assert box.take() == {'v': 0.2}
+    assert box.received_time == 1
+    assert box.stats() == {'received': 2, 'superseded': 1}
+
+    # Taking from an empty mailbox keeps the time of the message taken last
+    assert box.take() is None
+    assert box.received_time == 1
+
+
+def test_take_raw_skips_decoding():
+    box = mailbox.Mailbox(decode=lambda x: json.loads(x.decode(encoding='UTF-8')))
+    box.put(b'not json')
+    assert box.take_raw() == b'not json'
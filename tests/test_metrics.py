@@ -0,0 +1,60 @@
+import threading
+import gritsbot.metrics as metrics
+
+
+def test_histogram_percentiles():
+    h = metrics.Histogram()
+    for _ in range(99):
+        h.observe(0.001)
+    h.observe(1)
+
+    assert h.count == 100
+    assert h.percentile(50) == metrics.BUCKETS[7]  # First bound at or above 1 ms
+    assert h.percentile(100) == metrics.BUCKETS[17]
+    assert h.max == 1
+
+
+def test_rolling_histogram_drops_old_slices(clock):
+    rolling = metrics.RollingHistogram(window=6, slices=6, clock=clock)
+
+    rolling.observe(0.001)
+    clock.now = 3
+    rolling.observe(0.002)
+    assert rolling.merged().count == 2
+
+    clock.now = 7
+    assert rolling.merged().count == 1
+
+
+def test_snapshot_and_prometheus_include_gauges(clock):
+    m = metrics.Metrics(clock=clock)
+    m.observe('cycle', 0.001)
+    m.set_gauge('startup_total', 0.5)
+
+    snapshot = m.snapshot()
+    assert snapshot['cycle']['count'] == 1
+    assert snapshot['startup_total'] == {'value': 0.5}
+
+    text = m.to_prometheus(labels={'robot': '1'})
+    assert 'gritsbot_cycle_seconds_count{robot="1"} 1' in text
+    assert 'gritsbot_startup_total_seconds{robot="1"} 0.5' in text
+
+
+def test_reading_while_other_threads_add_metrics():
+    m = metrics.Metrics()
+
+    def writer():
+        for i in range(2000):
+            m.observe('h{}'.format(i), 0.001)
+            m.set_gauge('g{}'.format(i), i)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        while(thread.is_alive()):
+            m.snapshot()
+            m.to_prometheus()
+    finally:
+        thread.join()
+
+    assert len(m.snapshot()) == 4000
@@ -0,0 +1,61 @@
+import socket
+import threading
+import time
+import pytest
+import gritsbot.benchmarks.mqtt_broker as mqtt_broker
+
+
+@pytest.fixture
+def broker():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    b = mqtt_broker.MqttBroker(port=port, max_queued=100)
+    thread = threading.Thread(target=b.serve_forever, daemon=True)
+    thread.start()
+
+    deadline = time.monotonic() + 5
+    while(True):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    yield b, port
+
+    b.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_slow_subscriber_does_not_stall_others(broker):
+    b, port = broker
+
+    # Subscribes, but never reads, so its socket fills up
+    slow = socket.socket()
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.connect(('127.0.0.1', port))
+    slow.sendall(mqtt_broker.encode_packet(mqtt_broker.CONNECT, 0, mqtt_broker.encode_string('MQTT') + bytes([4, 0x02]) +
+                                           mqtt_broker.U16.pack(0) + mqtt_broker.encode_string('slow')))
+    slow.sendall(mqtt_broker.encode_packet(mqtt_broker.SUBSCRIBE, 0x02, mqtt_broker.U16.pack(1) + mqtt_broker.encode_string('flood') + b'\x00'))
+
+    done = threading.Event()
+    fast = mqtt_broker.MqttClient(port=port, client_id='fast')
+    fast.subscribe('done', lambda topic, payload: done.set())
+    publisher = mqtt_broker.MqttClient(port=port, client_id='publisher')
+    time.sleep(0.2)
+
+    payload = bytes(1000)
+    for _ in range(5000):
+        publisher.publish('flood', payload)
+    publisher.publish('done', b'')
+
+    assert done.wait(5)
+    assert b._dropped > 0
+
+    slow.close()
+    fast.stop()
+    publisher.stop()
@@ -0,0 +1,70 @@
+import logging
+import gritsbot.utils.nonblocking_log as nonblocking_log
+
+
+def make_record(msg, lineno=10, level=logging.WARNING):
+    return logging.LogRecord('test', level, 'file.py', lineno, msg, None, None)
+
+
+def test_repeats_are_suppressed_and_summarized(clock):
+    rate_limit = nonblocking_log.RateLimitFilter(interval=5, clock=clock)
+
+    assert rate_limit.filter(make_record('Serial exception.'))
+    for _ in range(3):
+        clock.now += 1
+        assert not rate_limit.filter(make_record('Serial exception.'))
+    assert rate_limit.pending() == {('test', logging.WARNING, 'file.py', 10): 3}
+
+    clock.now += 3
+    record = make_record('Serial exception.')
+    assert rate_limit.filter(record)
+    assert '3 more occurrences' in record.getMessage()
+
+
+def test_info_and_other_sites_are_not_suppressed(clock):
+    rate_limit = nonblocking_log.RateLimitFilter(interval=5, clock=clock)
+
+    assert rate_limit.filter(make_record('a'))
+    assert rate_limit.filter(make_record('b', lineno=11))
+    assert rate_limit.filter(make_record('status', level=logging.INFO))
+    assert rate_limit.filter(make_record('status', level=logging.INFO))
+
+
+def test_flush_reports_the_end_of_a_burst(clock):
+    rate_limit = nonblocking_log.RateLimitFilter(interval=5, clock=clock)
+
+    rate_limit.filter(make_record('Serial exception.'))
+    for _ in range(4):
+        rate_limit.filter(make_record('Serial exception.'))
+
+    # The burst is still within its interval
+    clock.now += 1
+    assert rate_limit.flush() == []
+
+    # Nothing else comes from the call site, but the interval ends
+    clock.now += 5
+    summaries = rate_limit.flush()
+    assert len(summaries) == 1
+    assert summaries[0].getMessage() == 'Serial exception. (repeated 4 times in the last 6.0 s)'
+    assert summaries[0].levelno == logging.WARNING
+    assert rate_limit.pending() == {}
+    assert rate_limit.flush(force=True) == []
+
+
+def test_stop_summarizes_pending_messages():
+    logger = logging.getLogger('test_nonblocking_log')
+    logger.propagate = False
+    records = []
+
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    logger.addHandler(ListHandler())
+    logs = nonblocking_log.NonBlockingLogging([logger], interval=60)
+    for _ in range(5):
+        logger.warning('Serial exception.')
+    logs.stop()
+
+    assert records[0] == 'Serial exception.'
+    assert records[1].startswith('Serial exception. (repeated 4 times')
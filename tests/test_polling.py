@@ -0,0 +1,60 @@
+import pytest
+import gritsbot.polling as polling
+import gritsbot.request as request
+
+
+def poll(poller, now):
+    r = request.Request()
+    handlers = []
+    added = poller.add_due(r, handlers, now)
+    assert added == len(r.iface) == len(handlers)
+    return r.iface
+
+
+def test_interfaces_are_read_at_their_own_rates():
+    poller = polling.PollScheduler([polling.PolledInterface('batt_volt', 1), polling.PolledInterface('charge_status', 1)])
+    poller.register(polling.PolledInterface('encoders', 0.25))
+
+    reads = {}
+    for step in range(17):
+        for iface in poll(poller, step*0.125):
+            reads[iface] = reads.get(iface, 0) + 1
+
+    # Two seconds of cycles at 8 Hz
+    assert reads == {'batt_volt': 3, 'charge_status': 3, 'encoders': 9}
+
+
+def test_reads_are_added_in_registration_order():
+    poller = polling.PollScheduler([polling.PolledInterface('batt_volt', 1)])
+    poller.register(polling.PolledInterface('imu', 0.01))
+    poller.register(polling.PolledInterface('charge_status', 1))
+
+    assert poll(poller, 0) == ['batt_volt', 'imu', 'charge_status']
+    assert poll(poller, 0.5) == ['imu']
+    assert poll(poller, 1) == ['batt_volt', 'imu', 'charge_status']
+
+
+def test_handlers_decode_their_own_reads():
+    poller = polling.PollScheduler([polling.PolledInterface('batt_volt', 1),
+                                    polling.PolledInterface('imu', 1, decode=lambda status, body: {'accel': body['imu'][:3]})])
+    handlers = []
+    poller.add_due(request.Request(), handlers, 0)
+
+    body = {'batt_volt': 4.1, 'imu': [1, 2, 3, 4, 5, 6]}
+    assert [h(200, body) for h in handlers] == [{'batt_volt': 4.1}, {'accel': [1, 2, 3]}]
+
+
+def test_missed_reads_are_not_made_up():
+    interface = polling.PolledInterface('batt_volt', 1)
+    assert interface.due(0)
+    assert not interface.due(0.5)
+    assert interface.due(5.2)
+    # Rescheduled from the late read instead of running the missed ones
+    assert not interface.due(5.5)
+    assert interface.due(6.2)
+
+
+def test_register_rejects_duplicates():
+    poller = polling.PollScheduler([polling.PolledInterface('batt_volt', 1)])
+    with pytest.raises(ValueError):
+        poller.register(polling.PolledInterface('batt_volt', 2))
@@ -0,0 +1,67 @@
+import threading
+import gritsbot.publisher as publisher
+
+
+class BlockingHandler:
+    """Records what it is called with, and blocks the first call until released."""
+
+    def __init__(self):
+        self.calls = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, *value):
+        self.entered.set()
+        self.release.wait(5)
+        self.calls.append(value)
+
+
+def test_newer_values_replace_older_ones_while_the_sender_is_blocked():
+    p = publisher.BackgroundPublisher()
+    handler = BlockingHandler()
+    p.register('status', handler)
+
+    p.offer('status', 0)
+    assert handler.entered.wait(5)
+    for value in range(1, 6):
+        p.offer('status', value)
+
+    handler.release.set()
+    p.stop()
+    assert handler.calls == [(0,), (5,)]
+    assert p.stats() == {'sent': 2, 'dropped': 4, 'failed': 0}
+
+
+def test_stop_handles_values_already_offered():
+    p = publisher.BackgroundPublisher()
+    handler = BlockingHandler()
+    p.register('status', handler)
+    p.register('metrics', lambda *value: handler.calls.append(('metrics',) + value))
+
+    p.offer('status', 0)
+    assert handler.entered.wait(5)
+    p.offer('status', 1)
+    p.offer('metrics', 2)
+
+    # Stopping while the sender is busy still publishes what is waiting in the slots
+    stopper = threading.Thread(target=p.stop)
+    stopper.start()
+    handler.release.set()
+    stopper.join(5)
+    assert not stopper.is_alive()
+    assert handler.calls[0] == (0,)
+    assert set(handler.calls[1:]) == {(1,), ('metrics', 2)}
+    assert p.stats()['sent'] == 3
+
+
+def test_failing_handler_does_not_stop_the_sender():
+    p = publisher.BackgroundPublisher()
+    calls = []
+    p.register('status', lambda value: 1/value)
+    p.register('metrics', calls.append)
+
+    p.offer('status', 0)
+    p.offer('metrics', 1)
+    p.stop()
+    assert calls == [1]
+    assert p.stats() == {'sent': 1, 'dropped': 0, 'failed': 1}
@@ -0,0 +1,51 @@
+import gritsbot.recording as recording
+
+SEGMENT_SIZE = 256
+SIZE = recording.FILE_HEADER.size + 3*SEGMENT_SIZE
+
+
+def record(path, clock, numbers):
+    recorder = recording.Recorder(path, size=SIZE, segment_size=SEGMENT_SIZE, clock=clock)
+    for i in numbers:
+        clock.now = i
+        # Three of these fit in a segment
+        recorder.record(recording.INPUT, '{:050d}'.format(i).encode())
+    recorder.stop()
+    return recorder
+
+
+def read(path):
+    return [(int(t), kind, int(payload)) for t, kind, payload in recording.read_records(path)]
+
+
+def test_records_rotate_through_segments(tmp_path, clock):
+    path = str(tmp_path / 'ring.rec')
+    assert record(path, clock, range(7)).stats() == {'recorded': 7, 'dropped': 0}
+    assert read(path) == [(i, recording.INPUT, i) for i in range(7)]
+
+
+def test_ring_wraps_around_to_the_newest_records(tmp_path, clock):
+    path = str(tmp_path / 'ring.rec')
+    record(path, clock, range(20))
+
+    # The oldest segments have been overwritten, and stale records after the newest one in a reused segment are ignored
+    assert [x[2] for x in read(path)] == list(range(12, 20))
+
+
+def test_reopened_ring_appends_after_the_newest_segment(tmp_path, clock):
+    path = str(tmp_path / 'ring.rec')
+    record(path, clock, range(20))
+    record(path, clock, [20])
+
+    assert [x[2] for x in read(path)] == list(range(15, 21))
+
+
+def test_records_larger_than_a_segment_are_dropped(tmp_path, clock):
+    path = str(tmp_path / 'ring.rec')
+    recorder = recording.Recorder(path, size=SIZE, segment_size=SEGMENT_SIZE, clock=clock)
+    recorder.record(recording.SERIAL_REQUEST, bytes(SEGMENT_SIZE))
+    recorder.record(recording.SERIAL_RESPONSE, {'status': [1], 'body': [{}]})
+    recorder.stop()
+
+    assert recorder.stats() == {'recorded': 1, 'dropped': 1}
+    assert [(kind, payload) for _, kind, payload in recording.read_records(path)] == [(recording.SERIAL_RESPONSE, b'{"status": [1], "body": [{}]}')]
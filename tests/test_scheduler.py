@@ -0,0 +1,121 @@
+import threading
+import pytest
+import gritsbot.scheduler as scheduler
+
+
+class FakeEvent:
+    """A wake event whose wait() advances a fake clock instead of blocking."""
+
+    def __init__(self, clock, set_after=None):
+        self._clock = clock
+        self._set_after = set_after
+        self.flag = False
+
+    def wait(self, timeout):
+        if(self.flag):
+            return True
+        if(self._set_after is not None and self._set_after < timeout):
+            self._clock.now += self._set_after
+            self._set_after = None
+            self.flag = True
+            return True
+        self._clock.now += timeout
+        return False
+
+    def set(self):
+        self.flag = True
+
+    def clear(self):
+        self.flag = False
+
+
+def make(clock, period=0.016, policy=scheduler.SKIP):
+    return scheduler.PeriodicScheduler(period, overrun_policy=policy, clock=clock, sleep=clock.sleep)
+
+
+def test_deadlines_do_not_drift(clock):
+    s = make(clock)
+    deadlines = []
+    for _ in range(5):
+        deadlines.append(s.wait())
+        clock.now += 0.005
+
+    assert deadlines == pytest.approx([0, 0.016, 0.032, 0.048, 0.064])
+    assert s.stats()['overruns'] == 0
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        scheduler.PeriodicScheduler(0.016, overrun_policy='nope')
+
+
+@pytest.mark.parametrize('wake', [False, True])
+def test_skip_after_stall(wake, clock):
+    s = make(clock)
+    event = threading.Event() if wake else None
+    s.wait(event)
+    clock.now += 0.1  # Stall
+    if(event is not None):
+        event.set()
+
+    deadline = s.wait(event)
+    stats = s.stats()
+    assert deadline == pytest.approx(0.096)
+    assert stats['overruns'] == 1
+    assert stats['skipped'] == 5
+    assert stats['woken'] == 0
+    if(event is not None):
+        assert not event.is_set()
+
+    # Back on schedule after the skipped deadlines
+    assert s.wait(event) == pytest.approx(0.112)
+
+
+@pytest.mark.parametrize('wake', [False, True])
+def test_catch_up_after_stall(wake, clock):
+    s = make(clock, policy=scheduler.CATCH_UP)
+    event = threading.Event() if wake else None
+    s.wait(event)
+    clock.now += 0.05
+
+    deadlines = [s.wait(event) for _ in range(3)]
+    assert deadlines == pytest.approx([0.016, 0.032, 0.048])
+    assert s.stats()['overruns'] == 3
+    assert s.stats()['skipped'] == 0
+
+
+def test_wake_starts_extra_cycle_without_moving_deadlines(clock):
+    s = make(clock)
+    s.wait()
+    event = FakeEvent(clock, set_after=0.004)
+
+    assert s.wait(event) == pytest.approx(0.004)
+    assert not event.flag
+    assert s.stats()['woken'] == 1
+
+    # The periodic deadline is unchanged
+    assert s.wait(event) == pytest.approx(0.016)
+    assert s.stats()['cycles'] == 2
+
+
+def test_set_period_rebases_on_running_cycle(clock):
+    s = make(clock, period=0.2)
+    s.wait()
+    event = FakeEvent(clock, set_after=0.05)
+    assert s.wait(event) == pytest.approx(0.05)
+
+    s.set_period(0.016)
+    assert s.wait() == pytest.approx(0.066)
+    assert s.stats()['overruns'] == 0
+
+
+@pytest.mark.parametrize('runs', [0.015, 0.03])
+def test_woken_cycle_overruns_only_after_a_period(runs, clock):
+    s = make(clock)
+    s.wait()
+    event = FakeEvent(clock, set_after=0.01)
+    assert s.wait(event) == pytest.approx(0.01)
+    clock.now += runs  # Past the deadline at 0.016
+
+    s.wait(event)
+    assert s.stats()['overruns'] == (1 if runs > 0.016 else 0)
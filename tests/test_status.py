@@ -0,0 +1,46 @@
+import json
+import gritsbot.status as status
+
+
+def make():
+    put = []
+    return put, status.StatusPublisher(lambda link, payload: put.append((link, json.loads(payload))), '1/status', heartbeat=1,
+                                       deadband={'batt_volt': 0.02})
+
+
+def test_change_beyond_deadband_publishes_immediately():
+    put, publisher = make()
+    assert publisher.update({'batt_volt': 4.1, 'charge_status': False}, 0)
+
+    assert publisher.update({'batt_volt': 4.05, 'charge_status': False}, 0.1)
+    assert publisher.update({'batt_volt': 4.05, 'charge_status': True}, 0.2)
+    assert put == [('1/status', {'batt_volt': 4.1, 'charge_status': False}), ('1/status', {'batt_volt': 4.05, 'charge_status': False}),
+                   ('1/status', {'batt_volt': 4.05, 'charge_status': True})]
+
+
+def test_change_within_deadband_waits_for_heartbeat():
+    put, publisher = make()
+    publisher.update({'batt_volt': 4.1, 'charge_status': False}, 0)
+
+    assert not publisher.update({'batt_volt': 4.11, 'charge_status': False}, 0.5)
+    assert not publisher.update({'batt_volt': 4.09, 'charge_status': False}, 0.99)
+    assert publisher.update({'batt_volt': 4.09, 'charge_status': False}, 1.0)
+    assert put[-1] == ('1/status', {'batt_volt': 4.09, 'charge_status': False})
+    assert publisher.stats() == {'published': 2, 'suppressed': 2}
+
+
+def test_deadband_is_measured_from_the_last_publish():
+    put, publisher = make()
+    publisher.update({'batt_volt': 4.1}, 0)
+
+    # Slow drift, each step inside the deadband, is published once it adds up
+    assert not publisher.update({'batt_volt': 4.09}, 0.1)
+    assert not publisher.update({'batt_volt': 4.085}, 0.2)
+    assert publisher.update({'batt_volt': 4.075}, 0.3)
+    assert len(put) == 2
+
+
+def test_payload_is_cached():
+    _, publisher = make()
+    data = {'batt_volt': 4.1}
+    assert publisher.payload(data) is publisher.payload(dict(data))
@@ -0,0 +1,54 @@
+import concurrent.futures
+import pytest
+import gritsbot.metrics as metrics
+import gritsbot.tracing as tracing
+
+
+def test_sequence_numbers_are_tracked_per_link(clock):
+    tracer = tracing.CommandTracer(metrics.Metrics(clock=clock), clock=clock)
+
+    # Each link numbers its commands independently, and the control loop takes them interleaved
+    for seq, link in [(1, 'matlab_api'), (100, 'broadcast'), (2, 'matlab_api'), (101, 'broadcast'), (4, 'matlab_api')]:
+        assert tracer.accept({'seq': seq}, clock.now, link=link)
+
+    stats = tracer.stats()
+    assert stats['accepted'] == 5
+    assert stats['skipped'] == 1
+    assert stats['reordered'] == 0
+
+
+def test_clock_offsets_are_estimated_per_link(clock):
+    tracer = tracing.CommandTracer(metrics.Metrics(clock=clock), max_age=0.1, clock=clock)
+
+    clock.now = 10
+    assert tracer.accept({'t': 1009.99}, clock.now, link='matlab_api')
+    assert tracer.accept({'t': 5009.99}, clock.now, link='broadcast')
+
+    # A command sent 50 ms ago is fresh, whichever sender's clock it was stamped with
+    clock.now = 11
+    assert tracer.accept({'t': 1010.95}, clock.now, link='matlab_api')
+    assert tracer.accept({'t': 5010.95}, clock.now, link='broadcast')
+
+    offsets = tracer.stats()['offset']
+    assert offsets['matlab_api'] == pytest.approx(-999.99)
+    assert offsets['broadcast'] == pytest.approx(-4999.99)
+
+
+def test_write_and_ack_are_timed_from_the_serial_write(clock):
+    m = metrics.Metrics(clock=clock)
+    tracer = tracing.CommandTracer(m, clock=clock)
+
+    clock.now = 1
+    assert tracer.accept({'v': 0.1, 'w': 0}, 0.999)
+
+    # Without pipelining, the request is written at 1.002 and submit only returns with the response at 1.010
+    future = concurrent.futures.Future()
+    future.write_time = 1.002
+    clock.now = 1.010
+    future.set_result({'status': [1], 'body': [{}]})
+    tracer.written(future)
+
+    snapshot = m.snapshot()
+    assert snapshot['command_write']['mean'] == pytest.approx(0.002)
+    assert snapshot['command_ack']['mean'] == pytest.approx(0.008)
+    assert snapshot['command_age']['mean'] == pytest.approx(0.011)